@@ -0,0 +1,129 @@
+""" A compact alternative to XML-RPC for the get/put/delete operations of Server.
+    Every request and response is a single length-prefixed frame sent over a persistent TCP
+    connection, so a value costs its own size on the wire instead of base64 inside an XML document
+    inside a new HTTP request.
+    Request frame:  op (1 byte), key length (4 bytes), value length (4 bytes), key, value
+    Response frame: status (1 byte), value length (4 bytes), value
+    All the integers are unsigned and big endian.
+"""
+import socket
+import struct
+from SocketServer import ThreadingMixIn, TCPServer, StreamRequestHandler
+from Queue import Empty, LifoQueue
+from xmlrpclib import Binary
+
+REQUEST = struct.Struct('!BII')
+RESPONSE = struct.Struct('!BI')
+GET, PUT, DELETE = 1, 2, 3 # request ops
+OK, MISSING, ERROR = 0, 1, 2 # response statuses
+
+
+class BinaryRequestHandler(StreamRequestHandler):
+    """ Serves the frames of one client connection until the client closes it. """
+    def setup(self):
+        StreamRequestHandler.setup(self)
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def handle(self):
+        while True:
+            header = self.rfile.read(REQUEST.size)
+            if len(header) < REQUEST.size: # the client closed the connection
+                return
+            op, key_length, value_length = REQUEST.unpack(header)
+            key = self.rfile.read(key_length)
+            value = self.rfile.read(value_length)
+            status, result = self.server.dispatch(op, key, value)
+            self.wfile.write(RESPONSE.pack(status, len(result)) + result)
+
+
+class BinaryServer(ThreadingMixIn, TCPServer):
+    """ Serves the binary protocol on top of the get/put/delete methods of a Server instance, so
+        that both protocols see the same data with the same semantics. """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, store):
+        TCPServer.__init__(self, address, BinaryRequestHandler)
+        self.store = store
+
+    def dispatch(self, op, key, value): # returns (status, value) for a request
+        if op == GET:
+            result = self.store.get(Binary(key))
+            return (OK, result.data) if result else (MISSING, '')
+        elif op == PUT:
+            self.store.put(Binary(key), Binary(value))
+            return OK, ''
+        elif op == DELETE:
+            return (OK if self.store.delete(Binary(key)) else MISSING), ''
+        return ERROR, 'unknown op {0}'.format(op)
+
+
+class BinaryProxy(object):
+    """ Client side of the binary protocol, a drop in replacement for the ServerProxy of a Server:
+        get/put/delete take and return the same values as their XML-RPC versions and go over
+        persistent connections, one per concurrent request, every other method is forwarded to the
+        XML-RPC proxy `fallback`. on_request, if given, is called before every request sent.
+        OBJECT ATTRIBUTES:
+        self.bytes_sent, self.bytes_received: the bytes of all the frames exchanged so far
+    """
+    def __init__(self, host_name, port, fallback, on_request=None):
+        self.address = (host_name, port)
+        self.fallback = fallback
+        self.on_request = on_request
+        self.connections = LifoQueue() # the idle connections
+        self.bytes_sent = self.bytes_received = 0
+
+    def __getattr__(self, name):
+        return getattr(self.fallback, name)
+
+    def _connect(self):
+        connection = socket.create_connection(self.address)
+        connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return connection
+
+    @staticmethod
+    def _receive(connection, length):
+        chunks, remaining = [], length
+        while remaining:
+            chunk = connection.recv(remaining)
+            if not chunk:
+                raise socket.error('connection closed by the server')
+            chunks.append(chunk)
+            remaining -= len(chunk)
+        return ''.join(chunks)
+
+    def _request(self, op, key, value=''):
+        frame = REQUEST.pack(op, len(key), len(value)) + key + value
+        if self.on_request:
+            self.on_request()
+        for attempt in (0, 1): # reconnect once if the server dropped the connection
+            try:
+                connection = self.connections.get_nowait()
+            except Empty:
+                connection = self._connect()
+            try:
+                connection.sendall(frame)
+                status, length = RESPONSE.unpack(self._receive(connection, RESPONSE.size))
+                result = self._receive(connection, length)
+                break
+            except socket.error:
+                connection.close()
+                if attempt:
+                    raise
+        self.connections.put(connection)
+        self.bytes_sent += len(frame)
+        self.bytes_received += RESPONSE.size + len(result)
+        if status == ERROR:
+            raise RuntimeError(result)
+        return status, result
+
+    def get(self, key):
+        status, value = self._request(GET, key.data)
+        return Binary(value) if status == OK else False
+
+    def put(self, key, value):
+        self._request(PUT, key.data, value.data)
+        return True
+
+    def delete(self, key):
+        return self._request(DELETE, key.data)[0] == OK
@@ -0,0 +1,68 @@
+""" Adaptive compression of the blocks of file content, used on the wire and at rest.
+    Every encoded block starts with one byte naming how the rest of it is stored: RAW (as is) or
+    ZLIB (compressed at LEVEL). Before compressing, a sample of the block is probed: the number of
+    distinct byte values in it bounds the entropy of its bytes, and blocks that look like random
+    data (already compressed or encrypted content) are stored raw without trying. A block whose
+    compressed form doesn't save at least 1/MIN_SAVING of it is stored raw too.
+        value = encode(block)
+        block = decode(value)
+"""
+import zlib
+from threading import Lock
+
+RAW, ZLIB = 'r', 'z' # the first byte of an encoded block
+LEVEL = 1 # the fastest zlib level: most of the saving on text at a fraction of the cost of the default 6
+SAMPLE_SIZE = 512 # bytes of a block looked at by the probe
+RANDOM_BYTE_SET = 200 # 512 uniformly random bytes have about 221 distinct values, text about 50
+MIN_SAVING = 8
+
+stats = dict(blocks=0, bytes=0, stored_bytes=0, compressed=0, probed_raw=0) # the blocks encoded so far
+stats_lock = Lock()
+
+
+class Error(ValueError): # an encoded block that can't be decoded
+    pass
+
+
+def compressible(block): # the entropy probe, false for blocks that look like random bytes
+    if len(block) <= SAMPLE_SIZE:
+        return True # a short block is compressed outright, that costs about as much as probing it
+    sample = block[::len(block) // SAMPLE_SIZE][:SAMPLE_SIZE] # spread over the whole block
+    return len(set(sample)) < RANDOM_BYTE_SET
+
+
+def encode(block):
+    worth_trying = compressible(block)
+    value = None
+    if worth_trying:
+        compressed = zlib.compress(block, LEVEL)
+        if len(compressed) <= len(block) - len(block) // MIN_SAVING:
+            value = ZLIB + compressed
+    if value is None:
+        value = RAW + block
+    with stats_lock:
+        stats['blocks'] += 1
+        stats['bytes'] += len(block)
+        stats['stored_bytes'] += len(value)
+        stats['compressed'] += value[0] == ZLIB
+        stats['probed_raw'] += not worth_trying
+    return value
+
+
+def decode(value):
+    if value[:1] == RAW:
+        return value[1:]
+    if value[:1] == ZLIB:
+        try:
+            return zlib.decompress(value[1:])
+        except zlib.error:
+            raise Error('corrupt compressed block')
+    raise Error('unknown block encoding {0!r}'.format(value[:1]))
+
+
+def render_stats(): # one line for /.fsstats
+    with stats_lock:
+        counts = dict(stats)
+    return 'compression: {0} blocks, {1} bytes, {2} stored, ratio {3:.2f}, {4} compressed, {5} probed incompressible\n'.format(
+        counts['blocks'], counts['bytes'], counts['stored_bytes'],
+        counts['bytes'] / float(counts['stored_bytes'] or 1), counts['compressed'], counts['probed_raw'])
@@ -1,111 +1,826 @@
 #!/usr/bin/env python
 
 import os
-from itertools import count
-from errno import ENOENT
+from argparse import ArgumentParser
+from collections import OrderedDict
+from hashlib import sha1
+from itertools import chain, count
+from multiprocessing.pool import ThreadPool
+from Queue import Queue
+from threading import Lock, RLock, Thread
+from zlib import crc32
+from errno import EIO, ENOENT, ENOTDIR
 from stat import S_IFDIR, S_IFLNK, S_IFREG
-from sys import argv, exit
+from sys import exit
 from time import time
 from pickle import dumps, loads
-from xmlrpclib import Binary, ServerProxy
-from fuse import FUSE, FuseOSError, Operations, LoggingMixIn
+from xmlrpclib import Binary, Fault, ServerProxy
+from fuse import FuseOSError, Operations, LoggingMixIn
+from BinaryProtocol import BinaryProxy
+from ProxyPool import ProxyPool
+import BlockCodec
+from OperationStats import StatsFUSE, StatsMixIn, count_round_trip, on_behalf
 
 if not hasattr(__builtins__, 'bytes'):
     bytes = str
 
-rpc = ServerProxy('http://localhost:8080')
+rpc = ServerProxy('http://localhost:8080') # holds the metadata and the directory entries (a ProxyPool when mounted)
+data_servers = [] # the blocks of regular files are striped across these servers (rpc if empty)
+replicas = 1 # every block is stored on this many data servers
+block_pool = None # threads used to talk to several data servers at once
+block_pool_lock = Lock()
+repairs = Queue() # replicas found corrupt or missing by reads, rewritten by the repairer thread
+replica_stats = dict(bad_replicas=0, repaired=0)
+dedup_stats = dict(blocks=0, bytes=0, uploaded_bytes=0) # the blocks pushed as content-addressed chunks
+dedup_stats_lock = Lock()
+
+# how long the kernel may cache what it learns from the file system, see --profile. 'attr_cache' is the
+# ttl of the client's own attribute cache, 'dentry_cache' False turns the client's dentry cache off, the
+# other keys are mount options. Otherwise the dentry cache keeps its entries as long as the kernel does,
+# for entry_timeout and negative_timeout seconds. test/check_coherence.py checks two mounts against each other
+PROFILES = {
+    # ask the file system every time, for mounts sharing the server with writers
+    'conservative': dict(attr_timeout=0, entry_timeout=0, negative_timeout=0, attr_cache=0, dentry_cache=False),
+    # other mounts may write: cache briefly, and drop the cached content of a file when an open finds
+    # that its mtime or size changed
+    'read-mostly': dict(attr_timeout=5, entry_timeout=5, negative_timeout=1, auto_cache=True,
+                        attr_cache=1),
+    # only this mount writes, so every change goes through this kernel, which keeps its caches up to date
+    'single-writer': dict(attr_timeout=60, entry_timeout=60, negative_timeout=60, kernel_cache=True,
+                          attr_cache=60),
+}
+
+
+def get_block_pool():
+    global block_pool
+    with block_pool_lock:
+        if block_pool is None:
+            block_pool = ThreadPool(2 * max(len(data_servers), 1) * replicas)
+    return block_pool
+
+
+def apply_profile(profile): # sets up the client caches for a profile, returns its mount options
+    options = dict(PROFILES.get(profile, {}))
+    attr_cache.ttl = options.pop('attr_cache', attr_cache.ttl)
+    dentry_cache.ttl = options.get('entry_timeout', dentry_cache.ttl) # FUSE defaults to 1 and 0 seconds
+    dentry_cache.negative_ttl = options.get('negative_timeout', dentry_cache.negative_ttl)
+    if not options.pop('dentry_cache', True):
+        dentry_cache.capacity = 0 # every lookup walks from the root
+    return options
+
+
+def parallel(function, items): # map(function, items), in parallel if there are several data servers
+    if len(items) < 2:
+        return map(function, items)
+    return get_block_pool().map(on_behalf(function), items)
+
+
+def repair_replicas(): # body of the repairer thread, see File.pull_blocks
+    while True:
+        serial_num, checksums, found, bad, responses, remaining = repairs.get()
+        for _ in range(remaining): # the responses that arrived after the read was answered
+            server, pulled = responses.get()
+            bad.extend((server, block_num) for block_num, block in pulled
+                       if not File.valid(block, checksums.get(block_num)))
+        replica_stats['bad_replicas'] += len(bad)
+        for server, block_num in bad:
+            if block_num not in found: # no good copy to repair from
+                continue
+            try:
+                server.put(File.block_key(serial_num,block_num,checksums.get(block_num)),Binary(found[block_num]))
+                replica_stats['repaired'] += 1
+            except Exception: # the server is down, a later read will try again
+                pass
+
+
+repairer = Thread(target=repair_replicas)
+repairer.daemon = True
+repairer.start()
+
+
+class DentryCache(object):
+    """ Client side cache of path -> serial number translations, used by File.lookup to skip
+        the walk from the root. Positive entries map a path to the serial number of its file,
+        negative entries (serial number None) record paths that are known not to exist.
+        Other mounts may change the namespace, so positive entries are used for ttl seconds and
+        negative ones for negative_ttl seconds, like the kernel does with entry_timeout and
+        negative_timeout (see PROFILES). A ttl of 0 keeps no entries of that kind.
+        The cache holds at most max_size entries and evicts the least recently used one.
+        OBJECT ATTRIBUTES:
+        self.hits, self.negative_hits, self.misses: lookup counters, used for sizing the cache
+    """
+    def __init__(self, max_size=4096, ttl=1.0, negative_ttl=0.0):
+        self.capacity = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.data = OrderedDict() # dict<path, (expiry time, serial number)>
+        self.hits = self.negative_hits = self.misses = 0
+        self.lock = Lock() # FUSE calls the file system from several threads
+
+    def __getitem__(self, path): # raises KeyError if the path is not cached
+        with self.lock:
+            try:
+                expiry, serial_num = self.data.pop(path)
+                if expiry < time():
+                    raise KeyError(path)
+            except KeyError:
+                self.misses += 1
+                raise
+            self.data[path] = (expiry, serial_num) # move the entry to the most recently used end
+            if serial_num is None: self.negative_hits += 1
+            else: self.hits += 1
+            return serial_num
+
+    def __setitem__(self, path, serial_num):
+        ttl = self.negative_ttl if serial_num is None else self.ttl
+        with self.lock:
+            if path in self.data:
+                del self.data[path]
+            if not ttl or not self.capacity:
+                return
+            if len(self.data) >= self.capacity: # if we reached max capacity,
+                self.data.popitem(last=False)   # then pop the least recently used
+            self.data[path] = (time() + ttl, serial_num)
+
+    def __delitem__(self, path):
+        with self.lock:
+            if path in self.data:
+                del self.data[path]
+
+    def ancestor(self, path): # returns (path, serial) of the deepest cached directory above path
+        while path != '/':
+            path = os.path.dirname(path)
+            with self.lock:
+                expiry, serial_num = self.data.get(path, (None, None))
+            if serial_num is not None and expiry >= time():
+                return path, serial_num
+        return None
+
+    def invalidate(self, path): # removes the entry of path and all the entries below it
+        prefix = path.rstrip('/') + '/'
+        with self.lock:
+            self.data.pop(path, None)
+            for cached_path in [p for p in self.data if p.startswith(prefix)]:
+                del self.data[cached_path]
+
+    def stats(self):
+        with self.lock:
+            return dict(hits=self.hits, negative_hits=self.negative_hits, misses=self.misses,
+                        size=len(self.data), capacity=self.capacity, ttl=self.ttl, negative_ttl=self.negative_ttl)
+
+
+dentry_cache = DentryCache()
+
+
+class AttributeCache(object):
+    """ Client side cache of the properties of files by serial number, filled by getattr and
+        readdir and used by getattr for ttl seconds. The files whose metadata this client changes
+        are dropped from it (see File.push), changes made by other clients are seen after at
+        most ttl seconds. A ttl of 0 disables it.
+    """
+    def __init__(self, ttl=1.0, max_size=4096):
+        self.ttl = ttl
+        self.capacity = max_size
+        self.data = OrderedDict() # dict<serial number, (expiry time, properties)>
+        self.hits = self.misses = 0
+        self.lock = Lock()
+
+    def get(self, serial_num): # returns the cached properties of a file, or None
+        with self.lock:
+            entry = self.data.get(serial_num)
+            if entry is None or entry[0] < time():
+                self.misses += 1
+                return None
+            self.hits += 1
+            return entry[1]
+
+    def __setitem__(self, serial_num, properties):
+        if not self.ttl:
+            return
+        with self.lock:
+            self.data.pop(serial_num, None)
+            if len(self.data) >= self.capacity:
+                self.data.popitem(last=False) # the oldest entry expires first
+            self.data[serial_num] = (time() + self.ttl, properties)
+
+    def invalidate(self, serial_num):
+        with self.lock:
+            self.data.pop(serial_num, None)
+
+    def stats(self):
+        with self.lock:
+            return dict(hits=self.hits, misses=self.misses, size=len(self.data), ttl=self.ttl)
+
+
+attr_cache = AttributeCache()
+
+
+class SerialAllocator(object):
+    """ Hands out the serial numbers of new files. The server leases them in ranges of lease_size
+        (see Server.lease_serials), so allocating one doesn't need a round trip and the mounts
+        sharing a server never give two files the same serial number. 0 is the root.
+    """
+    def __init__(self, lease_size=1024):
+        self.lease_size = lease_size
+        self.serials = iter(())
+        self.lock = Lock()
+
+    def next(self):
+        with self.lock:
+            for serial_num in self.serials:
+                return serial_num
+            if 'lease_serials' in File.server_methods:
+                first = rpc.lease_serials(self.lease_size)
+                self.serials = iter(xrange(first, first + self.lease_size))
+            else: # the serial numbers are only unique within this mount
+                self.serials = count(1)
+            return self.serials.next()
+
 
 class File(object):
     """ Represents a file (regular file, directory, or soft link) on the file system.
+        A file is stored on the server as two separate records, so that operations on the
+        attributes never transfer the content: the metadata (name and properties) under the key
+        '<serial number>' and the data under '<serial number>:data' (see File.push/File.push_data).
         OBJECT ATTRIBUTES:
         self.name: the name/basename of the file (str)
         self.properties: contains all the attr and xattr the OS uses to categorize the files,
             this includes their type too (dict).
         self.file_type: returns the type of the file (directory, regular, or link)
-        self.data: can contain different objects, depending on the type of the file (reg,dir,link):
+        self.data: can contain different objects, depending on the type of the file (reg,dir,link).
+            For files pulled from the server it is only pulled on first access.
             Directory file: self.data is a dict<name,serial number>
-            Regular file: self.data contains the content of the file as str
+            Regular file: self.data is unused, the content of the file is stored on the server in
+                blocks of properties['st_blksize'] bytes (see File.push_blocks), content-addressed
+                if properties['dedup'] is set and encoded by BlockCodec if properties['compress'] is set
             Link file: self.data contains a FULL path (from the OS root) stored as a str
     """
-    _id = count(0) # used for serial number generation
+    _id = SerialAllocator() # used for serial number generation
+    server_methods = set() # the methods the server offers besides get/put/delete
+    checksums_lock = Lock() # serializes the updates of the block checksums, see update_checksums
 
-    def __init__(self,absolute_path,properties,data):
+    def __init__(self,absolute_path,properties,data,serial_num=None):
         if absolute_path == '/': self.name = absolute_path
         else: self.name = os.path.basename(absolute_path)
         self.properties = properties
         self.data = data
-        self.serial_number = self._id.next() # generate a unique serial number for every file
+        if serial_num is None: serial_num = self._id.next() # generate a unique serial number for every file
+        self.serial_number = serial_num
 
     file_type = property(lambda self: self.properties['st_mode'] & 0770000)
 
+    def _get_data(self): # pulls the data of the file the first time it is needed
+        if not hasattr(self, '_data'):
+            self._data = bytes() if self.file_type == S_IFREG else File.pull_data(self.serial_number)
+        return self._data
+
+    data = property(_get_data, lambda self, data: setattr(self, '_data', data))
+
     def __str__(self): # function used for debugging
         representation = "[[ File: name: {0}, data: {1}, ser num: {2} ]]".format(
             self.name, repr(self.data), self.serial_number)
         return representation
 
     @staticmethod
-    def push(serial_num,file): # pushes a file to the rpc server and associates it with a serial number in ht
-        rpc.put(Binary(str(serial_num)),Binary(dumps(file)))
+    def push(serial_num,file): # pushes the metadata of a file to the rpc server
+        rpc.put(Binary(str(serial_num)),File.record(file))
+        attr_cache.invalidate(serial_num)
+
+    @staticmethod
+    def record(file): # the metadata record of a file, as stored on the server
+        return Binary(dumps(dict(name=file.name, properties=file.properties)))
+
+    @staticmethod
+    def push_data(serial_num,file): # pushes the data of a directory or a link to the rpc server
+        rpc.put(File.data_key(serial_num),Binary(dumps(file.data)))
 
     @staticmethod
     def delete(serial_num):
         rpc.delete(Binary(str(serial_num)))
+        rpc.delete(File.data_key(serial_num))
+        rpc.delete(File.checksums_key(serial_num))
 
     @staticmethod
-    def pull(serial_num): # returns the file that corresponds to the serial number
+    def pull(serial_num): # returns the file that corresponds to the serial number, without its data
         try:
             binary_value = rpc.get(Binary(str(serial_num)))
         except:
             raise FuseOSError(ENOENT)
-        pickled_obj = binary_value.data
-        file = loads(pickled_obj)
-        if file == None: # File has been removed
+        if not binary_value: # no such key on the server
+            raise FuseOSError(ENOENT)
+        return File.from_record(serial_num,loads(binary_value.data))
+
+    @staticmethod
+    def from_record(serial_num,record): # makes a File out of a metadata record pulled from the server
+        if record == None: # File has been removed
             print "The file at node {0} has been removed.".format(serial_num)
             raise FuseOSError(ENOENT)
+        file = File.__new__(File) # not File(), the file already has a serial number
+        file.name, file.properties, file.serial_number = record['name'], record['properties'], serial_num
         return file
 
+    @staticmethod
+    def data_key(serial_num): # the server key of the data of a directory or a link
+        return Binary('{0}:data'.format(serial_num))
+
+    @staticmethod
+    def pull_data(serial_num):
+        binary_value = rpc.get(File.data_key(serial_num))
+        if not binary_value:
+            raise FuseOSError(ENOENT)
+        return loads(binary_value.data)
+
+    @staticmethod
+    def block_key(serial_num,block_num,checksum=None): # the server key of a block of a regular file
+        if File.is_digest(checksum): # a content-addressed chunk, see Server.ref_chunks
+            return Binary('#' + checksum)
+        return Binary('{0}:{1}'.format(serial_num,block_num))
+
+    @staticmethod
+    def block_servers(serial_num,block_num,checksum=None): # the data servers holding the replicas of a block
+        servers = data_servers or [rpc]
+        count = len(servers)
+        first = int(checksum[:8], 16) if File.is_digest(checksum) else serial_num + block_num
+        return [servers[(first + i) % count] for i in range(min(replicas, count))]
+
+    @staticmethod
+    def group_by_server(serial_num,block_nums,checksums={}): # returns a list of (data server, [block numbers])
+        groups = {}
+        for block_num in block_nums:
+            for server in File.block_servers(serial_num,block_num,checksums.get(block_num)):
+                groups.setdefault(id(server), (server, []))[1].append(block_num)
+        return groups.values()
+
+    @staticmethod
+    def checksum(block,dedup=False): # the sha1 digest of the block for the content-addressed files, else its crc
+        if dedup:
+            return sha1(block).hexdigest()
+        return crc32(block) & 0xffffffff
+
+    @staticmethod
+    def is_digest(checksum):
+        return isinstance(checksum, basestring)
+
+    @staticmethod
+    def valid(block,checksum): # block is None for a missing replica
+        if checksum is None: # never written (a hole), or written before checksums were kept
+            return True
+        return block is not None and File.checksum(block,File.is_digest(checksum)) == checksum
+
+    @staticmethod
+    def stored_blocks(blocks,compress): # a dict<block number, str> of blocks as stored on the servers
+        if not compress:
+            return blocks
+        return dict((block_num, BlockCodec.encode(block)) for block_num, block in blocks.items())
+
+    @staticmethod
+    def pull_blocks(serial_num,block_nums,checksums,compressed=False):
+        """ Pulls several blocks. Every data server holding a replica of some of the blocks is sent
+            one get_many, all at once, and the first copy of a block that matches its checksum in
+            checksums (dict<block number, checksum>, of the blocks as stored) is used. Replicas found
+            corrupt or missing, including in the responses that arrive after we are done, are
+            rewritten with a good copy by the repairer thread. Returns the blocks in the order of
+            block_nums, decoded if they are compressed, or raises EIO if a block has no good replica. """
+        responses = Queue()
+        def pull_group(server_group):
+            server, group = server_group
+            keys = [File.block_key(serial_num,block_num,checksums.get(block_num)) for block_num in group]
+            try:
+                if 'get_many' in File.server_methods:
+                    values = server.get_many(keys)
+                else:
+                    values = [server.get(key) for key in keys]
+                blocks = [binary_value.data if binary_value else None for binary_value in values]
+            except Exception: # the server is down, all its replicas are missing
+                blocks = [None] * len(group)
+            responses.put((server, zip(group, blocks)))
+        groups = File.group_by_server(serial_num,block_nums,checksums)
+        if len(groups) == 1: # a single server to ask, no need for another thread
+            pull_group(groups[0])
+        else:
+            for server_group in groups:
+                get_block_pool().apply_async(on_behalf(pull_group), (server_group,))
+        found, bad, remaining = {}, [], len(groups)
+        while remaining and len(found) < len(set(block_nums)):
+            server, pulled = responses.get()
+            remaining -= 1
+            for block_num, block in pulled:
+                if not File.valid(block, checksums.get(block_num)):
+                    bad.append((server, block_num))
+                elif block_num not in found:
+                    found[block_num] = block or bytes() # a missing block without checksum is a hole
+        if bad or remaining:
+            repairs.put((serial_num, checksums, found, bad, responses, remaining))
+        if len(found) < len(set(block_nums)):
+            raise FuseOSError(EIO)
+        if not compressed:
+            return [found[block_num] for block_num in block_nums]
+        try: # found keeps the blocks as stored, the repairer copies them from it
+            return [BlockCodec.decode(found[block_num]) if found[block_num] else bytes() for block_num in block_nums]
+        except BlockCodec.Error: # a block written before checksums were kept got corrupt
+            raise FuseOSError(EIO)
+
+    @staticmethod
+    def push_blocks(serial_num,blocks,digests=None):
+        """ Pushes every block of a dict<block number, str> to all its replicas. With digests (the
+            dict<block number, sha1 digest> of the blocks of a content-addressed file), the blocks
+            are chunks: each server is asked to reference the chunks it has already, and only the
+            ones it doesn't have are sent. """
+        def push_group(server_group):
+            server, group = server_group
+            if digests is not None:
+                File.push_chunks(server,[(File.block_key(serial_num,block_num,digests[block_num]),blocks[block_num])
+                                         for block_num in group])
+                return
+            items = [(File.block_key(serial_num,block_num),Binary(blocks[block_num])) for block_num in group]
+            if 'put_many' in File.server_methods:
+                server.put_many(items)
+            else:
+                for key, value in items:
+                    server.put(key, value)
+        parallel(push_group, File.group_by_server(serial_num,blocks.keys(),digests or {}))
+
+    @staticmethod
+    def push_chunks(server,chunks): # adds a reference to every chunk of a list of (key, block) on server
+        missing = server.ref_chunks([key for key, _ in chunks])
+        uploads, again = {}, [] # a chunk held by several blocks of the list is sent once, then referenced
+        for key in missing:
+            if key.data in uploads:
+                again.append(key)
+            else:
+                uploads[key.data] = key
+        blocks = dict((key.data, block) for key, block in chunks)
+        if uploads:
+            if server.put_chunks([(key, Binary(blocks[data])) for data, key in uploads.items()]) is not True:
+                raise FuseOSError(EIO)
+        if again:
+            server.ref_chunks(again)
+        with dedup_stats_lock:
+            dedup_stats['blocks'] += len(chunks)
+            dedup_stats['bytes'] += sum(len(block) for _, block in chunks)
+            dedup_stats['uploaded_bytes'] += sum(len(blocks[data]) for data in uploads)
+
+    @staticmethod
+    def release_chunks(checksums): # removes a reference to the chunks of the digests among checksums
+        groups = {}
+        for digest in [checksum for checksum in checksums if File.is_digest(checksum)]:
+            for server in File.block_servers(0,0,digest):
+                groups.setdefault(id(server), (server, []))[1].append(File.block_key(0,0,digest))
+        def release_group(server_keys):
+            server, keys = server_keys
+            server.unref_chunks(keys)
+        parallel(release_group, groups.values())
+
+    @staticmethod
+    def delete_blocks(serial_num,block_nums):
+        def delete_group(server_group):
+            server, group = server_group
+            for block_num in group:
+                server.delete(File.block_key(serial_num,block_num))
+        parallel(delete_group, File.group_by_server(serial_num,block_nums))
+
+    @staticmethod
+    def checksums_key(serial_num): # the server key of the block checksums of a regular file
+        return Binary('{0}:sums'.format(serial_num))
+
+    @staticmethod
+    def pull_checksums(serial_num): # returns a dict<block number, checksum>
+        if 'pull_checksums' in File.server_methods: # kept a range of blocks to a record, see Server.update_checksums
+            return loads(rpc.pull_checksums(serial_num).data)
+        binary_value = rpc.get(File.checksums_key(serial_num))
+        return loads(binary_value.data) if binary_value else {}
+
+    @staticmethod
+    def update_checksums(serial_num,new_checksums,block_count=None):
+        """ Records the checksums of the blocks just pushed (dict<block number, checksum>) and, if
+            block_count is given, drops the checksums of the blocks from block_count on.
+            Returns the list of the checksums replaced or dropped (the chunks a content-addressed
+            file no longer references). Only the new checksums are sent: the server merges them
+            into the records of the ranges of blocks they fall in, so a flush costs the same at the
+            end of a large file as at its start. """
+        if 'update_checksums' in File.server_methods:
+            block_count = block_count if block_count is not None else -1 # XML-RPC has no None
+            return loads(rpc.update_checksums(serial_num,Binary(dumps(new_checksums)),block_count).data)
+        with File.checksums_lock: # two handles on a file may flush at once
+            checksums = File.pull_checksums(serial_num)
+            replaced = [checksums[block_num] for block_num in new_checksums if block_num in checksums]
+            checksums.update(new_checksums)
+            if block_count is not None:
+                for block_num in [block_num for block_num in checksums if block_num >= block_count]:
+                    replaced.append(checksums.pop(block_num))
+            rpc.put(File.checksums_key(serial_num),Binary(dumps(checksums)))
+        return replaced
+
+    @staticmethod
+    def resolve(path): # resolves a path on the server in one round trip, returns (file, parent dir)
+        response = rpc.resolve(Binary(path))
+        if not response:
+            dentry_cache[path] = None # remember that the path doesn't exist
+            raise FuseOSError(ENOENT)
+        serials, context_path = response['serials'], '/'
+        for name, serial_num in zip([''] + [part for part in path.split('/') if part], serials):
+            context_path = os.path.join(context_path, name)
+            dentry_cache[context_path] = serial_num
+        parent_serial = serials[-2] if len(serials) > 1 else serials[0]
+        return (File.from_record(serials[-1],loads(response['value'].data)),
+                File.from_record(parent_serial,loads(response['parent'].data)))
+
+    @staticmethod
+    def lookup_serial(path): # returns the serial number of a path, without pulling its file if it is cached
+        try:
+            serial_num = dentry_cache[path]
+        except KeyError:
+            return File.lookup(path).serial_number
+        if serial_num is None:
+            raise FuseOSError(ENOENT)
+        return serial_num
+
+    @staticmethod
+    def namespace_call(method,dir_paths,*args):
+        """ Calls an operation on directory entries of the server (see Server.create_entry) with the
+            serial numbers of the directories at dir_paths followed by args. The serial numbers may
+            come from the dentry cache, the call is retried once with fresh ones if a directory
+            turns out to be gone. Raises FuseOSError with the errno returned by the server. """
+        for attempt in (0, 1):
+            serials = [File.lookup_serial(path) for path in dir_paths]
+            result = getattr(rpc, method)(*(serials + list(args)))
+            if type(result) is not int or not result:
+                for serial_num in serials: # the server may have changed their st_nlink
+                    attr_cache.invalidate(serial_num)
+                return result
+            if attempt or result not in (ENOENT, ENOTDIR):
+                raise FuseOSError(result)
+            for path in dir_paths:
+                dentry_cache.invalidate(path)
+
+    @staticmethod
+    def lookup_properties(path): # returns (serial number, properties) of a path, from the attribute cache if possible
+        try:
+            serial_num = dentry_cache[path.rstrip('/') or '/']
+        except KeyError:
+            serial_num = None
+        properties = attr_cache.get(serial_num) if serial_num is not None else None
+        if properties is None:
+            file = File.lookup(path)
+            serial_num, properties = file.serial_number, file.properties
+            attr_cache[serial_num] = properties
+        return serial_num, dict(properties)
+
+    @staticmethod
+    def lookup_with_parent(path): # returns (file, parent dir) of a path
+        if 'resolve' in File.server_methods:
+            return File.resolve(path.rstrip('/') or '/')
+        return File.lookup(path), File.lookup(os.path.dirname(path))
+
     @staticmethod
     def lookup(path): # returns the file that corresponds to the particular path
-        root = File.pull(0) # first pull the root
-        if path == '/':
-            return root
-        path_parts = path.split("/")[1:] # [1:] to get rid of the first element ''
-        if path_parts[-1] == '': # path_parts[-1] will be '' if path ends with / (./a/b/)
-            path_parts.pop() # remove it so we won't be iterating through an empty name
-        context = root
-        for name in path_parts:
+        if path != '/':
+            path = path.rstrip('/') # ./a/b/ and ./a/b are the same entry in the dentry cache
+        try:
+            serial_num = dentry_cache[path]
+        except KeyError:
+            pass
+        else:
+            if serial_num is None: # negative entry, the path is known not to exist
+                raise FuseOSError(ENOENT)
             try:
-                serial_num = context.data[name]
-            except KeyError:
+                return File.pull(serial_num)
+            except FuseOSError: # stale entry, the file was removed behind our back
+                dentry_cache.invalidate(path)
+        if 'resolve' in File.server_methods:
+            return File.resolve(path)[0]
+        # walk the path starting from the deepest directory we have cached (or from the root).
+        # Only the directory entries are needed on the way, the metadata is pulled for the target
+        context_path, serial_num = dentry_cache.ancestor(path) or ('/', 0)
+        from_cache = context_path != '/'
+        for name in path[len(context_path):].split("/"):
+            if not name:
+                continue
+            try:
+                entries = File.pull_data(serial_num)
+            except FuseOSError:
+                if not from_cache:
+                    raise
+                dentry_cache.invalidate(context_path) # stale entry, walk again from higher up
+                return File.lookup(path)
+            from_cache = False
+            try:
+                serial_num = entries[name]
+            except (KeyError, TypeError): # TypeError: the context is a regular file or a link
+                dentry_cache[path] = None # remember that the path doesn't exist
                 raise FuseOSError(ENOENT)
-            file = File.pull(serial_num)
-            assert isinstance(file, File)
-            if file.file_type == S_IFDIR: # we have a directory
-                context = file # set the directory as the new context for the lookup
+            context_path = os.path.join(context_path, name)
+            dentry_cache[context_path] = serial_num
+        file = File.pull(serial_num)
+        dentry_cache[path] = serial_num
+        return file
+
+
+class OpenFile(object):
+    """ Client side state of an open file handle. Writes through the handle are kept in memory
+        (write-back) and pushed to the server by flush(), which FileSystem calls on flush, fsync
+        and release, or once more than its dirty limit of bytes is buffered.
+        OBJECT ATTRIBUTES:
+        self.file: the regular File the handle was opened on
+        self.size: the size of the file as seen through the handle, including buffered writes
+        self.dirty_blocks: dict<block number, str> of blocks written but not pushed yet
+        self.dirty_bytes: the number of bytes held in self.dirty_blocks
+        self.checksums: dict<block number, checksum> of the pushed blocks, pulled on first use
+    """
+    def __init__(self,file):
+        assert file.file_type == S_IFREG
+        self.file = file
+        self.size = file.properties['st_size']
+        self.dirty_blocks = {}
+        self.dirty_bytes = 0
+        self.checksums = None
+        self.lock = RLock() # FUSE may use the handle from several threads at once
+
+    block_size = property(lambda self: self.file.properties['st_blksize'])
+
+    def pull_blocks(self,block_nums):
+        compressed = self.file.properties.get('compress', False)
+        if self.checksums is None:
+            self.checksums = File.pull_checksums(self.file.serial_number)
+        try:
+            return File.pull_blocks(self.file.serial_number,block_nums,self.checksums,compressed)
+        except FuseOSError: # maybe the blocks were rewritten through another handle, check again
+            self.checksums = File.pull_checksums(self.file.serial_number)
+            return File.pull_blocks(self.file.serial_number,block_nums,self.checksums,compressed)
+
+    def block(self,block_num): # returns the current content of a block, buffered or not
+        if block_num in self.dirty_blocks:
+            return self.dirty_blocks[block_num]
+        if block_num * self.block_size >= self.size: # past the end of the file, nothing to pull
+            return bytes()
+        return self.pull_blocks([block_num])[0]
+
+    def read(self,size,offset):
+        with self.lock:
+            return self._read(size,offset)
+
+    def _read(self,size,offset):
+        block_size, end = self.block_size, min(offset + size, self.size)
+        if offset >= end:
+            return bytes()
+        block_nums = range(offset // block_size, (end - 1) // block_size + 1)
+        to_pull = [block_num for block_num in block_nums if block_num not in self.dirty_blocks]
+        blocks = dict(zip(to_pull, self.pull_blocks(to_pull)))
+        blocks.update((block_num, self.dirty_blocks[block_num])
+                      for block_num in block_nums if block_num in self.dirty_blocks)
+        content = []
+        for block_num in block_nums:
+            block_start = block_num * block_size
+            block_length = min(block_size, self.size - block_start)
+            block = blocks[block_num].ljust(block_length,'\0') # holes read back as zeros
+            content.append(block[max(offset - block_start, 0):end - block_start])
+        return bytes().join(content)
+
+    def write(self,data,offset):
+        with self.lock:
+            self._write(data,offset)
+
+    def _write(self,data,offset):
+        if not data:
+            return
+        block_size, end = self.block_size, offset + len(data)
+        for block_num in range(offset // block_size, (end - 1) // block_size + 1):
+            block_start = block_num * block_size
+            start_in_block = max(offset - block_start, 0)
+            piece = data[block_start + start_in_block - offset:block_start + block_size - offset]
+            # only fetch the old block if the write leaves some of its current content in place
+            old_length = min(max(self.size - block_start, 0), block_size)
+            if start_in_block == 0 and len(piece) >= old_length:
+                block = piece
             else:
-                return file # we have a regular file, so return it
-        # if we reached this point, it means that the requested file is a dir, so return it
-        return context
+                old_block = self.block(block_num).ljust(start_in_block,'\0')
+                block = old_block[:start_in_block] + piece + old_block[start_in_block + len(piece):]
+            self.dirty_bytes += len(block) - len(self.dirty_blocks.get(block_num, bytes()))
+            self.dirty_blocks[block_num] = block
+        self.size = max(self.size, end)
 
+    def flush(self): # pushes the buffered blocks and the new size to the server
+        with self.lock:
+            self._flush()
 
-class FileSystem(Operations):
+    def _flush(self):
+        if not self.dirty_blocks and self.size == self.file.properties['st_size']:
+            return
+        try: # pull the file again so we don't overwrite a chmod/utimens made since the open
+            file = File.pull(self.file.serial_number)
+        except FuseOSError: # the file was removed while it was open, drop the buffered data
+            self.dirty_blocks, self.dirty_bytes = {}, 0
+            return
+        dedup = file.properties.get('dedup', False)
+        blocks = File.stored_blocks(self.dirty_blocks,file.properties.get('compress', False))
+        checksums = dict((block_num, File.checksum(block,dedup)) for block_num, block in blocks.items())
+        File.push_blocks(file.serial_number,blocks,checksums if dedup else None)
+        File.release_chunks(File.update_checksums(file.serial_number,checksums))
+        if self.checksums is not None: # what the server has now, unless another handle wrote too
+            self.checksums.update(checksums)
+        self.dirty_blocks, self.dirty_bytes = {}, 0
+        file.properties['st_size'] = max(file.properties['st_size'], self.size)
+        # a new mtime tells the kernels of the mounts using auto_cache to drop the pages they cached
+        file.properties['st_mtime'] = file.properties['st_ctime'] = time()
+        File.push(file.serial_number,file)
+        self.size = file.properties['st_size']
+        self.file = file
 
-    def __init__(self):
-        self.fd = 0
-        now = time()
-        root_properties = dict(st_mode=(S_IFDIR | 0755), st_ctime=now,
-                               st_mtime=now, st_atime=now, st_nlink=2)
-        root = File('/',root_properties, {})
-        File.push(root.serial_number,root) # store in the server ht serial number -> object
+
+class FileSystem(StatsMixIn, Operations):
+
+    def __init__(self,block_size=4096,dirty_limit=4 << 20,serial_lease=1024,dedup=False,compress=False,
+                 mountpoint='.'):
+        StatsMixIn.__init__(self) # see /.fsstats in the mount
+        self.fds = count(1) # file handles, count.next() is atomic so no lock is needed
+        self.handles = {} # dict<fh, OpenFile>
+        self.block_size = block_size # the block size of the regular files created by this mount
+        self.dirty_limit = dirty_limit # max bytes buffered by a handle before it is flushed
+        self.dedup = dedup # the regular files created by this mount are content-addressed, see File.push_blocks
+        self.compress = compress # the blocks of the regular files created by this mount are compressed, see BlockCodec
+        self.mountpoint = os.path.abspath(mountpoint) # where the FS is mounted in the OS's FS, see symlink
+        try:
+            File.server_methods = set(rpc.system.listMethods())
+        except Fault: # a server without introspection only has get/put/delete
+            File.server_methods = set()
+        if dedup and 'ref_chunks' not in File.server_methods:
+            raise RuntimeError('the server does not store content-addressed chunks (see Server.ref_chunks)')
+        File._id = SerialAllocator(serial_lease)
+        if not rpc.get(Binary('0')): # the first mount of a server makes the root, the others share it
+            now = time()
+            root_properties = dict(st_mode=(S_IFDIR | 0755), st_ctime=now,
+                                   st_mtime=now, st_atime=now, st_nlink=2)
+            root = File('/',root_properties, {}, 0)
+            self.ht_update(root,action='add file') # store in the server ht serial number -> object
 
     @staticmethod
     def ht_update(file,**kwargs): # update the hash table of the server
-        if kwargs['action'] == 'add file' or kwargs['action'] == 'update file':
+        if kwargs['action'] == 'add file':
+            File.push(file.serial_number,file)
+            if file.file_type != S_IFREG:
+                File.push_data(file.serial_number,file)
+        elif kwargs['action'] == 'update file': # the metadata changed
             File.push(file.serial_number,file)
+        elif kwargs['action'] == 'update data': # the entries of a dir (or the target of a link) changed
+            File.push_data(file.serial_number,file)
         elif kwargs['action'] == 'remove file':
+            if file.properties.get('dedup'): # release the chunks of its blocks
+                File.release_chunks(File.pull_checksums(file.serial_number).values())
+            elif file.file_type == S_IFREG: # remove the content blocks together with the file
+                File.delete_blocks(file.serial_number,range(FileSystem.block_count(file)))
             File.delete(file.serial_number)
         else: raise RuntimeError
 
+    def add_entry(self, path, file):
+        """ Pushes a new file and adds it to the entries of the directory above path (whose st_nlink
+            grows if the file is a directory), in one round trip if the server has create_entry. """
+        if 'create_entry' in File.server_methods:
+            items = [(Binary(str(file.serial_number)),File.record(file))]
+            if file.file_type != S_IFREG:
+                items.append((File.data_key(file.serial_number),Binary(dumps(file.data))))
+            File.namespace_call('create_entry',[os.path.dirname(path)],Binary(file.name),file.serial_number,items)
+        else: # push the file, then pull the parent directory, add a reference to it and push it back
+            self.ht_update(file,action='add file')
+            parent_dir = File.lookup(os.path.dirname(path))
+            assert parent_dir.file_type == S_IFDIR
+            parent_dir.data[file.name] = file.serial_number
+            if file.file_type == S_IFDIR:
+                parent_dir.properties['st_nlink'] += 1
+                self.ht_update(parent_dir,action='update file')
+            self.ht_update(parent_dir,action='update data')
+        dentry_cache[path] = file.serial_number
+
+    def remove_entry(self, path):
+        """ Removes the file at path from the entries of its parent directory and deletes it,
+            in one round trip (plus the deletion of its blocks) if the server has remove_entry. """
+        if 'remove_entry' in File.server_methods:
+            removed = File.namespace_call('remove_entry',[os.path.dirname(path)],Binary(os.path.basename(path)))
+            self.delete_content(removed)
+        else:
+            file, parent_dir = File.lookup_with_parent(path)
+            assert parent_dir.file_type == S_IFDIR
+            del parent_dir.data[file.name]
+            if file.file_type == S_IFDIR:
+                parent_dir.properties['st_nlink'] -= 1
+                self.ht_update(parent_dir,action='update file')
+            self.ht_update(parent_dir,action='update data')
+            self.ht_update(file,action='remove file')
+        dentry_cache.invalidate(path)
+
+    def delete_content(self, removed): # deletes the blocks of a file removed by the server (see Server.drop_file)
+        if removed['value'].data:
+            file = File.from_record(removed['serial'],loads(removed['value'].data))
+            if file.properties.get('dedup'):
+                checksums = removed.get('sums')
+                File.release_chunks(loads(checksums.data).values() if checksums and checksums.data else [])
+            elif file.file_type == S_IFREG:
+                File.delete_blocks(file.serial_number,range(self.block_count(file)))
+
+    @staticmethod
+    def block_count(file): # number of blocks spanned by the content of a regular file
+        block_size = file.properties['st_blksize']
+        return (file.properties['st_size'] + block_size - 1) // block_size
+
     def chmod(self, path, mode):
         file = File.lookup(path)
         file.properties['st_mode'] &= 0770000
@@ -123,21 +838,59 @@ class FileSystem(Operations):
         print "create(self, {0}, {1})".format(path,mode)
         # first make a new regular file, update server ht
         new_file_propeties = dict(st_mode=(S_IFREG | mode), st_nlink=1,
-                                st_size=0, st_ctime=time(), st_mtime=time(),
-                                st_atime=time())
+                                st_size=0, st_blksize=self.block_size, st_ctime=time(),
+                                st_mtime=time(), st_atime=time())
+        if self.dedup:
+            new_file_propeties['dedup'] = True
+        if self.compress:
+            new_file_propeties['compress'] = True
         new_file = File(path,new_file_propeties,bytes()) # make am empty file
-        self.ht_update(new_file,action="add file")
-        # then, pull the parent directory, add a reference to it and push it back
-        parent_dir = File.lookup(os.path.dirname(path))
-        assert parent_dir.file_type == S_IFDIR
-        parent_dir.data[new_file.name]=new_file.serial_number
-        self.ht_update(parent_dir,action='update file')
-        self.fd += 1
-        return self.fd
+        self.add_entry(path,new_file)
+        fh = self.fds.next()
+        self.handles[fh] = OpenFile(new_file)
+        return fh
+
+    def destroy(self, path):
+        print "dentry cache: {0}".format(dentry_cache.stats())
+        print "attribute cache: {0}".format(attr_cache.stats())
+        print "block replicas: {0}".format(replica_stats)
+        print self.render_stats()
+
+    def render_stats(self): # the operation stats, with the compression and deduplication of the blocks pushed
+        text = StatsMixIn.render_stats(self)
+        if self.compress:
+            text += BlockCodec.render_stats()
+        if not dedup_stats['blocks']:
+            return text
+        with dedup_stats_lock:
+            stats = dict(dedup_stats)
+        lines = ['dedup: {0} blocks pushed, {1} bytes, {2} uploaded, {3} saved'.format(
+            stats['blocks'], stats['bytes'], stats['uploaded_bytes'], stats['bytes'] - stats['uploaded_bytes'])]
+        for number, server in enumerate(data_servers or [rpc]):
+            stored = server.dedup_stats()
+            lines.append('dedup on server {0}: {1} chunks, {2} bytes stored, {3} referenced, {4} saved, ratio {5:.2f}'.format(
+                number, stored['chunks'], stored['stored_bytes'], stored['referenced_bytes'],
+                stored['saved_bytes'], stored['ratio']))
+        return text + '\n'.join(lines) + '\n'
+
+    def flush(self, path, fh):
+        print "flush(self, {0}, {1})".format(path,fh)
+        if fh in self.handles:
+            self.handles[fh].flush()
+
+    def fsync(self, path, datasync, fh):
+        print "fsync(self, {0}, {1}, {2})".format(path,datasync,fh)
+        self.flush(path,fh)
 
     def getattr(self, path, fh=None):
         print "getattr(self, {0}, {1})".format(path,fh)
-        return File.lookup(path).properties
+        serial_num, properties = File.lookup_properties(path)
+        return self.buffered_properties(serial_num,properties)
+
+    def buffered_properties(self, serial_num, properties): # properties with the size of the buffered writes
+        for handle in self.open_handles(serial_num): # writes that were not flushed yet may grow the file
+            properties['st_size'] = max(properties['st_size'], handle.size)
+        return properties
 
     def getxattr(self, path, name, position=0):
         print "getxattr(self, {0}, {1}, {2})".format(path,name,position)
@@ -159,31 +912,49 @@ class FileSystem(Operations):
                                 st_size=0, st_ctime=time(), st_mtime=time(),
                                 st_atime=time())
         new_dir = File(path,new_dir_properties,{})
-        self.ht_update(new_dir,action='add file')
-        # then, pull the parent directory, add a reference to it and push it back
-        parent_dir = File.lookup(os.path.dirname(path))
-        assert parent_dir.file_type == S_IFDIR
-        parent_dir.data[new_dir.name]=new_dir.serial_number
-        parent_dir.properties['st_nlink'] += 1
-        self.ht_update(parent_dir,action='update file')
+        self.add_entry(path,new_dir)
 
     def open(self, path, flags):
         print "open(self, {0}, {1})".format(path,flags)
-        self.fd += 1
-        return self.fd
+        file = File.lookup(path)
+        fh = self.fds.next()
+        if file.file_type == S_IFREG:
+            self.handles[fh] = OpenFile(file)
+        return fh
+
+    def open_handles(self, serial_num): # returns the OpenFiles of all the open handles on a file
+        return [handle for handle in self.handles.values()
+                if handle.file.serial_number == serial_num]
 
     def read(self, path, size, offset, fh):
         print "read(self, {0}, {1}, {2}, {3})".format(path,size,offset,fh)
-        file = File.lookup(path)
-        assert file.file_type == S_IFREG
-        return file.data[offset:offset + size]
+        handle = self.handles.get(fh) or OpenFile(File.lookup(path))
+        return handle.read(size,offset)
 
     def readdir(self, path, fh):
         print "readdir(self, {0}, {1})".format(path,fh)
+        if 'list_entries' in File.server_methods: # large directories are listed a page at a time
+            return chain(['.', '..'], self.list_entries(path)) # with the properties of the files
         directory = File.lookup(path)
         assert directory.file_type == S_IFDIR
         return ['.', '..'] + [x for x in directory.data]
 
+    def list_entries(self, path, page_size=1024):
+        """ Yields (name, properties, 0) for the files in a directory, a page at a time with their
+            metadata records (see Server.list_entries), and caches their serial numbers and properties
+            so the getattr calls that usually follow don't go to the server. """
+        cursor = 0
+        while cursor >= 0:
+            page = File.namespace_call('list_entries',[path],cursor,page_size,True)
+            for name, serial_num, record in loads(page['entries'].data):
+                dentry_cache[os.path.join(path, name)] = serial_num
+                if record is None: # removed since the page was read
+                    continue
+                properties = loads(record)['properties']
+                attr_cache[serial_num] = properties
+                yield name, self.buffered_properties(serial_num,dict(properties)), 0
+            cursor = page['cursor']
+
     def readlink(self, path):
         print "readlink(self, {0})".format(path)
         link = File.lookup(path)
@@ -200,14 +971,29 @@ class FileSystem(Operations):
             pass        # Should return ENOATTR
         self.ht_update(file,action='update file')
 
+    def release(self, path, fh):
+        print "release(self, {0}, {1})".format(path,fh)
+        handle = self.handles.pop(fh, None)
+        if handle:
+            handle.flush()
+
     def rename(self, old, new):
         print "rename(self, {0}, {1})".format(old,new)
+        if 'rename_entry' in File.server_methods: # one round trip, see Server.rename_entry
+            result = File.namespace_call('rename_entry',[os.path.dirname(old),os.path.dirname(new)],
+                                         Binary(os.path.basename(old)),Binary(os.path.basename(new)))
+            if result['replaced']:
+                self.delete_content(result['replaced'])
+            dentry_cache.invalidate(old)
+            dentry_cache.invalidate(new)
+            dentry_cache[new] = result['serial']
+            return
         file = File.lookup(old)
         # pull old parent, remove reference, and push it back
         old_parent = File.lookup(os.path.dirname(old))
         assert old_parent.file_type == S_IFDIR
         del old_parent.data[file.name]
-        self.ht_update(old_parent,action='update file')
+        self.ht_update(old_parent,action='update data')
         # update the absolute_path property of the object, update lut, and push it back
         file.name = os.path.basename(new)
         self.ht_update(file,action='update file')
@@ -215,19 +1001,15 @@ class FileSystem(Operations):
         new_parent = File.lookup(os.path.dirname(new))
         assert new_parent.file_type == S_IFDIR
         new_parent.data[file.name] = file.serial_number
-        self.ht_update(new_parent,action='update file')
+        self.ht_update(new_parent,action='update data')
+        # every cached path under old (and under new, if it got replaced) is now wrong
+        dentry_cache.invalidate(old)
+        dentry_cache.invalidate(new)
+        dentry_cache[new] = file.serial_number
 
     def rmdir(self, path):
         print "rmdir(self, {0})".format(path)
-        # remove reference from the parent dir
-        file = File.lookup(path)
-        parent_dir = File.lookup(os.path.dirname(path))
-        parent_dir.properties['st_nlink'] -= 1
-        assert parent_dir.file_type == S_IFDIR
-        del parent_dir.data[file.name]
-        self.ht_update(parent_dir,action='update file')
-        # mark file as removed in the server ht
-        self.ht_update(file,action='remove file')
+        self.remove_entry(path)
 
     def setxattr(self, path, name, value, options, position=0):
         print "setxattr(self, {0}, {1}, {2}, {3}, {4})".format(path,name,value,options,position)
@@ -244,34 +1026,47 @@ class FileSystem(Operations):
         print "symlink(self, {0}, {1})".format(target,source)
         link_properties = dict(st_mode=(S_IFLNK | 0777), st_nlink=1,st_size=len(source),
                                st_ctime=time(), st_mtime=time(),st_atime=time())
-        file_system_os_path = os.getcwd() + '/' + argv[1] # the path of the FUSE FS relative to the OS's FS
         source_path = source
-        if file_system_os_path in source:
-            source_path = source.replace(file_system_os_path,'')
-        parent_dir = File.lookup(os.path.dirname(target))
-        full_os_path = os.getcwd() + '/' + argv[1] + source_path
+        if self.mountpoint in source:
+            source_path = source.replace(self.mountpoint,'')
+        full_os_path = self.mountpoint + source_path
         link = File(target,link_properties,full_os_path)
-        parent_dir.data[link.name] = link.serial_number
-        self.ht_update(link,action='add file')
-        self.ht_update(parent_dir,action='update file')
+        self.add_entry(target,link)
 
     def truncate(self, path, length, fh=None):
         print "truncate(self, {0}, {1}, {2})".format(path,length,fh)
         file = File.lookup(path)
         assert file.file_type == S_IFREG
-        file.data = file.data[:length]
+        handles = self.open_handles(file.serial_number)
+        for handle in handles: # push the buffered writes first, so they get truncated too
+            handle.flush()
+        file = File.pull(file.serial_number) if handles else file
+        block_size, dedup = file.properties['st_blksize'], file.properties.get('dedup', False)
+        if length < file.properties['st_size']:
+            # drop the blocks past the new end and cut the last block, so that growing the file
+            # again later reads back zeros instead of the old content
+            block_count = (length + block_size - 1) // block_size
+            if not dedup: # the chunks of a content-addressed file are released below
+                File.delete_blocks(file.serial_number,range(block_count, self.block_count(file)))
+            cut_blocks = {}
+            if length % block_size:
+                last_block = length // block_size
+                block = OpenFile(file).block(last_block)
+                cut_blocks[last_block] = block[:length % block_size]
+            cut_blocks = File.stored_blocks(cut_blocks,file.properties.get('compress', False))
+            checksums = dict((block_num, File.checksum(block,dedup)) for block_num, block in cut_blocks.items())
+            if cut_blocks:
+                File.push_blocks(file.serial_number,cut_blocks,checksums if dedup else None)
+            File.release_chunks(File.update_checksums(file.serial_number,checksums,block_count))
         file.properties['st_size'] = length
         self.ht_update(file,action='update file')
+        for handle in handles:
+            with handle.lock:
+                handle.file, handle.size, handle.checksums = file, length, None
 
     def unlink(self, path):
         print "unlink(self, {0})".format(path)
-        # remove reference from the parent dir
-        file = File.lookup(path)
-        parent_dir = File.lookup(os.path.dirname(path))
-        assert parent_dir.file_type == S_IFDIR
-        del parent_dir.data[file.name]
-        self.ht_update(parent_dir,action='update file')
-        self.ht_update(file,action='remove file')
+        self.remove_entry(path)
 
     def utimens(self, path, times=None):
         print "utimens(self, {0}, {1})".format(path,times)
@@ -283,19 +1078,65 @@ class FileSystem(Operations):
         self.ht_update(file,action='update file')
 
     def write(self, path, data, offset, fh):
-        print "write(self, {0}, {1}, {2}, {3})".format(path,data,offset,fh)
-        file = File.lookup(path)
-        assert file.file_type == S_IFREG
-        file.data = file.data[:offset] + data
-        file.properties['st_size'] = len(file.data)
-        self.ht_update(file,action='update file')
+        print "write(self, {0}, <{1} bytes>, {2}, {3})".format(path,len(data),offset,fh)
+        if fh not in self.handles: # not opened through this mount, write through
+            handle = OpenFile(File.lookup(path))
+            handle.write(data,offset)
+            handle.flush()
+            return len(data)
+        handle = self.handles[fh]
+        handle.write(data,offset)
+        if handle.dirty_bytes >= self.dirty_limit:
+            handle.flush()
         return len(data)
 
-
 if __name__ == '__main__':
-    if len(argv) != 2:
-        print('usage: %s <mountpoint>' % argv[0])
-        exit(1)
-
-    fuse = FUSE(FileSystem(), argv[1], foreground=True, debug = False)
+    parser = ArgumentParser(usage='%(prog)s <mountpoint> [options]')
+    parser.add_argument('mountpoint')
+    parser.add_argument('--dentry-cache', type=int, default=dentry_cache.capacity, metavar='N',
+                        help='max number of path -> serial number entries cached by the client')
+    parser.add_argument('--attr-cache', type=float, metavar='SECONDS',
+                        help='how long the client trusts the cached attributes of a file, 0 disables '
+                             'the attribute cache (default 1, or as set by the profile)')
+    parser.add_argument('--profile', choices=sorted(PROFILES),
+                        help='how long the kernel caches attributes, entries and file content, '
+                             'by default the FUSE defaults are used')
+    parser.add_argument('--block-size', type=int, default=4096, metavar='BYTES',
+                        help='size of the blocks the content of new regular files is stored in')
+    parser.add_argument('--dirty-limit', type=int, default=4 << 20, metavar='BYTES',
+                        help='max bytes of writes buffered by an open file before they are pushed')
+    parser.add_argument('--binary-port', type=int, metavar='PORT',
+                        help='send get/put/delete over the binary protocol the server offers on PORT '
+                             '(started with Server.py -b PORT) instead of XML-RPC')
+    parser.add_argument('--meta-port', type=int, default=8080, metavar='PORT',
+                        help='port of the server holding the metadata (e.g. started by metaserver.py)')
+    parser.add_argument('--data-ports', type=int, nargs='+', metavar='PORT',
+                        help='ports of the servers the file blocks are striped across (e.g. started by '
+                             'dataserver.py), by default the blocks are kept on the metadata server')
+    parser.add_argument('--replicas', type=int, default=1, metavar='N',
+                        help='store every block on N of the data servers')
+    parser.add_argument('--serial-lease', type=int, default=1024, metavar='N',
+                        help='serial numbers leased from the metadata server at a time (default 1024)')
+    parser.add_argument('--connections', type=int, default=8, metavar='N',
+                        help='max number of connections (and of concurrent calls) to every server (default 8)')
+    parser.add_argument('--single-threaded', action='store_true',
+                        help='serve one FUSE request at a time')
+    parser.add_argument('--dedup', action='store_true',
+                        help='store the blocks of the regular files created by this mount once per distinct '
+                             'content on the servers, and only upload the blocks they do not have yet')
+    parser.add_argument('--compress', action='store_true',
+                        help='compress the blocks of the regular files created by this mount with zlib, '
+                             'except the ones that look incompressible')
+    args = parser.parse_args()
+    dentry_cache.capacity = args.dentry_cache
+    options = apply_profile(args.profile)
+    if args.attr_cache is not None:
+        attr_cache.ttl = args.attr_cache
+    rpc = ProxyPool('http://localhost:' + str(args.meta_port), args.connections)
+    if args.binary_port:
+        rpc = BinaryProxy('localhost', args.binary_port, rpc, count_round_trip)
+    data_servers = [ProxyPool('http://localhost:' + str(port), args.connections) for port in args.data_ports or []]
+    replicas = args.replicas
 
+    fuse = StatsFUSE(FileSystem(args.block_size,args.dirty_limit,args.serial_lease,args.dedup,args.compress,args.mountpoint), args.mountpoint, foreground=True, debug = False,
+                nothreads=args.single_threaded, **options)
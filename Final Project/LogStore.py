@@ -0,0 +1,353 @@
+""" A persistent key/value store that Server can use instead of its in-memory dict.
+    The store is a directory of append-only segment files. Puts and deletes are appended to the
+    active segment as records:
+        crc32 (4 bytes), kind (1 byte), key length (4 bytes), value length (4 bytes), key, value
+    and an in-memory index maps every key to (segment number, offset, length) of its value, which
+    is read back through an mmap of the segment. Once the active segment grows past segment_size it
+    is sealed: the part of the index pointing into it is pickled at its end as a footer, so that on
+    restart the index is rebuilt from the footers, in time proportional to the number of keys.
+    Only a segment that was never sealed (after a crash) has to be scanned record by record.
+    Segments whose values are mostly overwritten or deleted are compacted in the background: their
+    live values are copied to a new file, which replaces the segment under the same number, and
+    segments left without live values are removed.
+"""
+import mmap
+import os
+import struct
+import cPickle as pickle
+from threading import Condition, Lock, Thread
+from time import sleep
+from zlib import crc32
+
+RECORD = struct.Struct('!IBII')
+TRAILER = struct.Struct('!QI8s') # footer offset, footer length, magic
+MAGIC = 'LOGSTORE'
+PUT, DELETE = 1, 2
+SYNC_POLICIES = ('always', 'group', 'periodic')
+
+
+class Segment(object):
+    """ One segment file.
+        self.live_bytes: the bytes of the records whose values are still in the index
+        self.deleted: the keys deleted by the records of this segment
+        self.records_size: the size without the footer once the segment is sealed
+    """
+    def __init__(self, directory, number, suffix=''):
+        self.number = number
+        self.path = os.path.join(directory, '{0:08d}.seg{1}'.format(number, suffix))
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0644)
+        self.size = os.fstat(self.fd).st_size
+        self.map = None
+        self.live_bytes = 0
+        self.deleted = set()
+        self.records_size = None
+
+    def append(self, data):
+        os.lseek(self.fd, self.size, os.SEEK_SET)
+        os.write(self.fd, data)
+        self.size += len(data)
+
+    def read(self, offset, length):
+        if self.map is None or offset + length > len(self.map): # the segment grew since it was mapped
+            if self.map is not None:
+                self.map.close()
+            self.map = mmap.mmap(self.fd, self.size, access=mmap.ACCESS_READ)
+        return self.map[offset:offset + length]
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+        os.close(self.fd)
+
+    def footer(self): # returns the index stored at the end of a sealed segment, or None
+        if self.size < TRAILER.size:
+            return None
+        os.lseek(self.fd, self.size - TRAILER.size, os.SEEK_SET)
+        footer_offset, footer_length, magic = TRAILER.unpack(os.read(self.fd, TRAILER.size))
+        if magic != MAGIC or footer_offset + footer_length + TRAILER.size != self.size:
+            return None
+        os.lseek(self.fd, footer_offset, os.SEEK_SET)
+        self.records_size = footer_offset
+        return pickle.loads(os.read(self.fd, footer_length))
+
+    def scan(self): # rebuilds the index of an unsealed segment from its records, drops a torn tail
+        entries, offset = {}, 0
+        while offset + RECORD.size <= self.size:
+            os.lseek(self.fd, offset, os.SEEK_SET)
+            checksum, kind, key_length, value_length = RECORD.unpack(os.read(self.fd, RECORD.size))
+            body = os.read(self.fd, key_length + value_length)
+            if len(body) < key_length + value_length or \
+                    crc32(RECORD.pack(0, kind, key_length, value_length)[4:] + body) & 0xffffffff != checksum:
+                break
+            value_offset = offset + RECORD.size + key_length
+            entries[body[:key_length]] = (value_offset, value_length) if kind == PUT else None
+            offset = value_offset + value_length
+        if offset < self.size:
+            os.ftruncate(self.fd, offset)
+            self.size = offset
+        return entries
+
+
+class LogStore(object):
+    """ Dict-like persistent store, see the module docstring.
+        sync: when appended records are fsync'ed to disk
+            'always': before every put/delete returns
+            'group': puts/deletes wait for a syncer thread that fsyncs everything appended so far
+                at once, so concurrent writers share one fsync (group commit)
+            'periodic': every sync_interval seconds, writes don't wait (the last ones may be lost)
+        compact_ratio: segments with less than this fraction of live bytes are compacted, which is
+            checked every compact_interval seconds
+    """
+    def __init__(self, directory, sync='periodic', sync_interval=1.0, segment_size=64 << 20,
+                 compact_interval=60.0, compact_ratio=0.5):
+        assert sync in SYNC_POLICIES
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self.sync_policy = sync
+        self.sync_interval = sync_interval
+        self.segment_size = segment_size
+        self.compact_ratio = compact_ratio
+        self.lock = Lock() # guards the index and the segments
+        self.index = {} # dict<key, (segment number, value offset, value length)>
+        self.segments = {} # dict<segment number, Segment>
+        self.load()
+        self.active = self.new_segment()
+        self.appended = self.synced = 0 # count of appended records, and of records known synced
+        self.sync_condition = Condition(Lock())
+        self.running = True
+        threads = [Thread(target=self.compact_periodically, args=(compact_interval,))]
+        if sync != 'always':
+            threads.append(Thread(target=self.sync_periodically))
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+    def load(self): # rebuilds the index from the segments found in the directory
+        for name in os.listdir(self.directory):
+            if name.endswith('.seg.tmp'): # a compaction that didn't finish
+                os.remove(os.path.join(self.directory, name))
+        numbers = sorted(int(name[:-4]) for name in os.listdir(self.directory) if name.endswith('.seg'))
+        for number in numbers: # later segments override earlier ones
+            segment = self.segments[number] = Segment(self.directory, number)
+            entries = segment.footer()
+            if entries is None: # not sealed, the store wasn't closed
+                entries = segment.scan()
+                self.seal(segment, entries)
+            if not entries: # no record in it, e.g. the active segment of a start without writes
+                del self.segments[number]
+                segment.close()
+                os.remove(segment.path)
+                continue
+            for key, entry in entries.items():
+                self.forget(key)
+                if entry is not None:
+                    self.index[key] = (number, entry[0], entry[1])
+                    segment.live_bytes += RECORD.size + len(key) + entry[1]
+                else:
+                    segment.deleted.add(key)
+
+    def new_segment(self):
+        number = max(self.segments) + 1 if self.segments else 1
+        segment = self.segments[number] = Segment(self.directory, number)
+        return segment
+
+    def seal(self, segment, entries): # appends the footer to a segment, it won't be written to again
+        footer = pickle.dumps(entries, pickle.HIGHEST_PROTOCOL)
+        segment.records_size = segment.size
+        segment.append(footer + TRAILER.pack(segment.size, len(footer), MAGIC))
+        os.fsync(segment.fd)
+
+    def segment_entries(self, segment): # the index entries (and deletions) that live in a segment
+        entries = {}
+        for key, (number, offset, length) in self.index.items():
+            if number == segment.number:
+                entries[key] = (offset, length)
+        entries.update((key, None) for key in segment.deleted)
+        return entries
+
+    def forget(self, key): # removes key from the index, keeping the live byte counts right
+        entry = self.index.pop(key, None)
+        if entry is not None and entry[0] in self.segments:
+            self.segments[entry[0]].live_bytes -= RECORD.size + len(key) + entry[2]
+
+    @staticmethod
+    def record(kind, key, value=''):
+        header = RECORD.pack(0, kind, len(key), len(value))[4:]
+        return struct.pack('!I', crc32(header + key + value) & 0xffffffff) + header + key + value
+
+    def append(self, kind, key, value=''):
+        """ Appends a record to the active segment (self.lock must be held), returns the record
+            number to wait for with wait_synced. """
+        value_offset = self.active.size + RECORD.size + len(key)
+        self.active.append(self.record(kind, key, value))
+        self.forget(key)
+        if kind == PUT:
+            self.index[key] = (self.active.number, value_offset, len(value))
+            self.active.live_bytes += RECORD.size + len(key) + len(value)
+            self.active.deleted.discard(key)
+        else:
+            self.active.deleted.add(key)
+        if self.active.size >= self.segment_size:
+            self.roll()
+        self.appended += 1
+        return self.appended
+
+    def roll(self): # seals the active segment and starts a new one
+        self.seal(self.active, self.segment_entries(self.active))
+        self.active = self.new_segment()
+
+    def wait_synced(self, record):
+        if self.sync_policy == 'always':
+            self.sync()
+        elif self.sync_policy == 'group':
+            with self.sync_condition:
+                self.sync_condition.notify_all() # wake the syncer up
+                while self.synced < record and self.running:
+                    self.sync_condition.wait()
+
+    def sync_periodically(self): # body of the syncer thread
+        while self.running:
+            if self.sync_policy == 'group':
+                with self.sync_condition:
+                    while self.synced == self.appended and self.running:
+                        self.sync_condition.wait(self.sync_interval)
+            else:
+                sleep(self.sync_interval)
+            self.sync()
+
+    def sync(self):
+        with self.lock:
+            if not self.running:
+                return
+            appended, fd = self.appended, os.dup(self.active.fd)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        with self.sync_condition:
+            self.synced = max(self.synced, appended)
+            self.sync_condition.notify_all()
+
+    def compact_periodically(self, interval): # body of the compaction thread
+        while self.running:
+            sleep(interval)
+            if self.running:
+                self.compact()
+
+    def compact(self):
+        """ Rewrites the sealed segments that are mostly garbage with only their live values, and
+            removes the ones that have none. Deletions are kept unless nothing older than the
+            compacted segment could still hold the key. The values are copied without holding
+            self.lock, which is only taken to snapshot a segment and to swap in its new file. """
+        with self.lock:
+            if not self.running:
+                return
+            segments = sorted([segment for segment in self.segments.values() if segment is not self.active
+                               and (segment.live_bytes == 0 or
+                                    segment.live_bytes < self.compact_ratio * segment.records_size)],
+                              key=lambda segment: segment.number)
+        for segment in segments:
+            self.compact_segment(segment)
+
+    def compact_segment(self, segment):
+        with self.lock:
+            if not self.running or self.segments.get(segment.number) is not segment:
+                return
+            entries = self.segment_entries(segment)
+            deleted = set() if segment.number == min(self.segments) else \
+                set(key for key in segment.deleted if key not in self.index)
+            if not segment.live_bytes:
+                if not deleted: # nothing in it is needed anymore
+                    del self.segments[segment.number]
+                    segment.close()
+                    os.remove(segment.path)
+                    return
+                if deleted == segment.deleted and not segment.records_size: # already only a footer
+                    return
+        copy = Segment(self.directory, segment.number, '.tmp')
+        moved = {} # dict<key, (old value offset, new value offset, length)>
+        source = mmap.mmap(segment.fd, segment.records_size, access=mmap.ACCESS_READ) if segment.records_size else None
+        try:
+            for key, entry in entries.items():
+                if entry is not None:
+                    moved[key] = (entry[0], copy.size + RECORD.size + len(key), entry[1])
+                    copy.append(self.record(PUT, key, source[entry[0]:entry[0] + entry[1]]))
+        finally:
+            if source is not None:
+                source.close()
+        with self.lock:
+            if not self.running:
+                copy.close()
+                os.remove(copy.path)
+                return
+            # only the values still pointing into the segment move, the others were overwritten or
+            # deleted by later records while they were copied
+            live = {}
+            for key, (old_offset, new_offset, length) in moved.items():
+                if self.index.get(key) == (segment.number, old_offset, length):
+                    live[key] = (new_offset, length)
+                    copy.live_bytes += RECORD.size + len(key) + length
+            if segment.number != min(self.segments):
+                copy.deleted = set(key for key in deleted if key not in self.index)
+            footer = dict(live)
+            footer.update((key, None) for key in copy.deleted)
+            self.seal(copy, footer)
+            os.rename(copy.path, segment.path)
+            copy.path = segment.path
+            self.segments[segment.number] = copy
+            for key, (offset, length) in live.items():
+                self.index[key] = (segment.number, offset, length)
+            segment.close()
+
+    def close(self): # seals the active segment so the next start doesn't need to scan it
+        with self.lock:
+            if not self.running:
+                return
+            self.running = False
+            self.seal(self.active, self.segment_entries(self.active))
+            for segment in self.segments.values():
+                segment.close()
+        with self.sync_condition:
+            self.sync_condition.notify_all()
+
+    # dict interface used by Server
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def __getitem__(self, key):
+        with self.lock:
+            number, offset, length = self.index[key]
+            return self.segments[number].read(offset, length)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __setitem__(self, key, value):
+        with self.lock:
+            record = self.append(PUT, key, value)
+        self.wait_synced(record)
+
+    def __delitem__(self, key):
+        with self.lock:
+            if key not in self.index:
+                raise KeyError(key)
+            record = self.append(DELETE, key)
+        self.wait_synced(record)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def keys(self):
+        with self.lock:
+            return self.index.keys()
+
+    def items(self):
+        return [(key, self.get(key)) for key in self.keys() if key in self]
@@ -0,0 +1,170 @@
+""" Per operation statistics of a file system, readable at runtime inside the mount.
+    StatsMixIn wraps the Operations.__call__ FUSE goes through and records, for every operation,
+    the number of calls and of errors, the bytes read or written, the requests sent to the server
+    (counted by the clients of the server through count_round_trip) and a histogram of the
+    latencies. They are served as text by the hidden, read only file /.fsstats:
+        cat fusemount/.fsstats
+    Mount with StatsFUSE instead of FUSE so the file is read with direct_io: the kernel would otherwise
+    serve it from its page cache (e.g. with kernel_cache) and cut it at the size it was given earlier.
+    The four file systems of the repository share this module, the others find it through sys.path.
+"""
+from errno import EACCES
+from itertools import count
+from math import frexp
+from stat import S_IFREG
+from threading import Lock, local
+from time import time
+from timeit import default_timer
+
+from fuse import FUSE, FuseOSError
+
+STATS_PATH = '/.fsstats'
+current = local() # current.round_trips: the list the requests of the operation being served are counted in
+
+
+def count_round_trip(): # called by the clients of the server for every request they send
+    round_trips = getattr(current, 'round_trips', None)
+    if round_trips is not None:
+        round_trips.append(None) # list.append is atomic, the threads working for one operation share the list
+
+
+def on_behalf(function): # wraps function so that the requests it sends from another thread count for the current operation
+    round_trips = getattr(current, 'round_trips', None)
+    def run(*args):
+        current.round_trips = round_trips
+        try:
+            return function(*args)
+        finally:
+            current.round_trips = None
+    return run
+
+
+class Histogram(object):
+    """ Latencies in buckets of 4 per power of two, so a percentile is known to within 19%
+        without keeping the latencies themselves. """
+    def __init__(self):
+        self.buckets = {} # dict<bucket number, count>
+
+    def add(self, seconds):
+        mantissa, exponent = frexp(seconds * 1e6) # microseconds = mantissa * 2 ** exponent, 0.5 <= mantissa < 1
+        bucket = exponent * 4 + int((mantissa - 0.5) * 8)
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+
+    def percentile(self, fraction): # the upper bound of the bucket of the fraction-th latency, in seconds
+        needed, seen = fraction * sum(self.buckets.values()), 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= needed:
+                exponent, quarter = divmod(bucket, 4)
+                return (0.5 + (quarter + 1) / 8.0) * 2 ** exponent / 1e6
+        return 0.0
+
+
+class OperationStats(object):
+    def __init__(self):
+        self.calls = self.errors = self.bytes = self.round_trips = 0
+        self.latencies = Histogram()
+
+
+class StatsMixIn(object):
+    """ Mixed in before Operations (and LoggingMixIn), see the module docstring. The subclass calls
+        StatsMixIn.__init__. The time of an operation includes everything up to its return, the
+        listing of a directory by a readdir that returns a generator included.
+        OBJECT ATTRIBUTES:
+        self.operation_stats: dict<operation name, OperationStats>
+    """
+    def __init__(self):
+        self.operation_stats = {}
+        self.stats_lock = Lock() # FUSE calls the file system from several threads
+        self.stats_started = time()
+        self.stats_handles = {} # dict<fh, content of STATS_PATH when it was opened>
+        self.stats_fds = count(1)
+
+    def __call__(self, op, path, *args):
+        if path == STATS_PATH:
+            return self.stats_file(op, *args)
+        round_trips = current.round_trips = []
+        start = default_timer()
+        try:
+            result = super(StatsMixIn, self).__call__(op, path, *args)
+            if op == 'readdir' and not isinstance(result, list): # list a generator before stopping the clock
+                result = list(result)
+        except Exception:
+            self.record(op, default_timer() - start, round_trips, failed=True)
+            raise
+        finally:
+            current.round_trips = None
+        if op == 'read':
+            transferred = len(result)
+        elif op == 'write':
+            transferred = result
+        else:
+            transferred = 0
+        self.record(op, default_timer() - start, round_trips, transferred=transferred)
+        return result
+
+    def record(self, op, seconds, round_trips, transferred=0, failed=False):
+        with self.stats_lock:
+            stats = self.operation_stats.get(op)
+            if stats is None:
+                stats = self.operation_stats[op] = OperationStats()
+            stats.calls += 1
+            stats.errors += failed
+            stats.bytes += transferred
+            stats.round_trips += len(round_trips)
+            stats.latencies.add(seconds)
+
+    def stats(self):
+        """ Returns dict<operation name, dict(calls, errors, bytes, round_trips, p50, p95, p99)>,
+            the percentiles of the latencies in seconds. """
+        with self.stats_lock:
+            return dict((op, dict(calls=stats.calls, errors=stats.errors, bytes=stats.bytes,
+                                  round_trips=stats.round_trips, p50=stats.latencies.percentile(0.5),
+                                  p95=stats.latencies.percentile(0.95), p99=stats.latencies.percentile(0.99)))
+                        for op, stats in self.operation_stats.items())
+
+    def render_stats(self): # the content of STATS_PATH
+        lines = ['uptime {0:.0f} s'.format(time() - self.stats_started),
+                 '{0:<12} {1:>9} {2:>7} {3:>12} {4:>11} {5:>9} {6:>9} {7:>9}'.format(
+                     'operation', 'calls', 'errors', 'bytes', 'round trips', 'p50 ms', 'p95 ms', 'p99 ms')]
+        for op, stats in sorted(self.stats().items()):
+            lines.append('{0:<12} {1:>9} {2:>7} {3:>12} {4:>11.2f} {5:>9.3f} {6:>9.3f} {7:>9.3f}'.format(
+                op, stats['calls'], stats['errors'], stats['bytes'], stats['round_trips'] / float(stats['calls']),
+                stats['p50'] * 1000, stats['p95'] * 1000, stats['p99'] * 1000))
+        return '\n'.join(lines) + '\n'
+
+    def stats_file(self, op, *args): # the operations on STATS_PATH, which isn't listed by readdir
+        if op == 'getattr': # the size is only indicative, the file is read with direct_io until its end
+            now = time()
+            return dict(st_mode=(S_IFREG | 0444), st_nlink=1, st_size=len(self.render_stats()),
+                        st_ctime=self.stats_started, st_mtime=now, st_atime=now)
+        elif op == 'open': # a handle reads the stats as of its open
+            fh = self.stats_fds.next()
+            self.stats_handles[fh] = self.render_stats()
+            return fh
+        elif op == 'read':
+            size, offset, fh = args
+            text = self.stats_handles.get(fh)
+            if text is None: # read without an open
+                text = self.render_stats()
+            return text[offset:offset + size]
+        elif op == 'release':
+            self.stats_handles.pop(args[-1], None)
+        elif op in ('flush', 'access'):
+            return 0
+        elif op == 'getxattr':
+            return ''
+        elif op == 'listxattr':
+            return []
+        else:
+            raise FuseOSError(EACCES)
+
+
+class StatsFUSE(FUSE):
+    """ FUSE that opens STATS_PATH with direct_io, see the module docstring. """
+    def open(self, path, fip):
+        result = FUSE.open(self, path, fip)
+        if path.decode(self.encoding) == STATS_PATH:
+            fip.contents.direct_io = 1
+            fip.contents.keep_cache = 0
+        return result
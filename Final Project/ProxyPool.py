@@ -0,0 +1,48 @@
+""" A thread safe pool of XML-RPC connections to a server, shared by FileSystem.py and
+    remoteHierarchicalFS.py. Every call is counted as a round trip, see OperationStats.py.
+        rpc = ProxyPool('http://localhost:8080', 8)
+        rpc.get(key)
+"""
+from Queue import Empty, LifoQueue
+from threading import BoundedSemaphore
+from xmlrpclib import ServerProxy
+from OperationStats import count_round_trip
+
+
+class ProxyPool(object):
+    """ Thread safe stand-in for the ServerProxy of a server, since a ServerProxy can't be used by
+        several threads at once: every call borrows one of at most size ServerProxys and gives it
+        back when it returns, so up to size calls from the FUSE threads (and from the block_pool
+        threads of FileSystem.py) run at once. A ServerProxy keeps its HTTP/1.1 connection open
+        between calls (the server keeps it open too if it has worker threads, see Server.py).
+    """
+    def __init__(self, url, size=8):
+        self.url = url
+        self.idle = LifoQueue() # the most recently used connection is the least likely to have timed out
+        self.slots = BoundedSemaphore(size)
+
+    def __getattr__(self, name):
+        return PooledMethod(self, name)
+
+    def call(self, name, args):
+        count_round_trip()
+        with self.slots:
+            try:
+                proxy = self.idle.get_nowait()
+            except Empty:
+                proxy = ServerProxy(self.url)
+            try:
+                return getattr(proxy, name)(*args) # ServerProxy handles dotted names like system.listMethods
+            finally:
+                self.idle.put(proxy)
+
+
+class PooledMethod(object): # a method of a ProxyPool, dotted names like system.listMethods included
+    def __init__(self, pool, name):
+        self.pool, self.name = pool, name
+
+    def __getattr__(self, name):
+        return PooledMethod(self.pool, self.name + '.' + name)
+
+    def __call__(self, *args):
+        return self.pool.call(self.name, args)
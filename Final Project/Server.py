@@ -1,43 +1,681 @@
 #!/usr/bin/env python
 
 import pickle
+from contextlib import contextmanager
+from errno import EEXIST, EINVAL, ENOENT, ENOTDIR, ENOTEMPTY
+from hashlib import sha1
+from heapq import heapify, heappop, heappush
+from Queue import Queue
+from stat import S_ISDIR
+from StringIO import StringIO
 from xmlrpclib import Binary
-from SimpleXMLRPCServer import SimpleXMLRPCServer
+from SimpleXMLRPCServer import SimpleXMLRPCRequestHandler, SimpleXMLRPCServer
 from sys import argv
+from threading import Lock, Thread
+from time import time
+from zlib import crc32
+from BinaryProtocol import BinaryServer
+from LogStore import LogStore, SYNC_POLICIES
+
+
+BUCKET_SIZE = 256 # average number of entries per bucket of a directory, see Server.add_to_dir
+HASH_BITS = 31 # the bits of the name hashes list_entries orders the buckets by, its cursor fits an XML-RPC int
+EXPIRE_BATCH = 64 # max keys expired by one request, see Server.expire
+SUMS_RANGE = 1024 # block checksums per record, see Server.update_checksums
+
+
+class Record(object):
+    """ Stands in for the classes of the clients (e.g. remoteHierarchicalFS.File) when the server
+        has to look inside a value, so that the server never imports client modules. """
+    pass
+
+
+class RecordUnpickler(pickle.Unpickler):
+    def find_class(self, module, name):
+        if module in ('copy_reg', '__builtin__'):
+            return pickle.Unpickler.find_class(self, module, name)
+        return Record
+
+
+def load_record(value): # unpickles a value stored by a client
+    return RecordUnpickler(StringIO(value)).load()
+
+
+class KeepAliveRequestHandler(SimpleXMLRPCRequestHandler):
+    """ Serves all the requests a client sends over a connection (HTTP/1.1 keep-alive), so clients
+        don't connect for every call. A connection idle for timeout seconds is closed, which frees
+        its worker thread; the client reconnects on its next call. """
+    protocol_version = 'HTTP/1.1'
+    timeout = 2
+
+    def log_error(self, format, *args):
+        if not format.startswith('Request timed out'): # idle connections are expected to time out
+            SimpleXMLRPCRequestHandler.log_error(self, format, *args)
+
+
+class ThreadPoolXMLRPCServer(SimpleXMLRPCServer):
+    """ SimpleXMLRPCServer that accepts connections in the thread calling handle_request and hands
+        them to a fixed pool of worker threads, so one slow client or large value doesn't
+        hold back the others. Connections are kept alive, so there should be at least as many
+        workers as client connections (see ProxyPool.py). """
+    def __init__(self, address, workers):
+        SimpleXMLRPCServer.__init__(self, address, KeepAliveRequestHandler)
+        self.requests = Queue()
+        self.workers = [Thread(target=self.work) for _ in range(workers)]
+        for worker in self.workers:
+            worker.daemon = True
+            worker.start()
+
+    def process_request(self, request, client_address):
+        self.requests.put((request, client_address))
+
+    def work(self):
+        while True:
+            request, client_address = self.requests.get()
+            if request is None: # stop_workers was called
+                return
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    def stop_workers(self): # lets the workers finish the queued requests, then stops them
+        for _ in self.workers:
+            self.requests.put((None, None))
+        for worker in self.workers:
+            worker.join()
 
 
 class Server(object):
-    def __init__(self,host_name,port,corruptible):
-        self.data = {}
+    def __init__(self,host_name,port,corruptible,binary_port=None,workers=0,lock_stripes=64,
+                 storage_dir=None,sync_policy='periodic'):
+        """ workers: the number of threads serving XML-RPC requests concurrently. With 0, the
+                requests are served one at a time by the thread that accepts them.
+            lock_stripes: self.data is guarded by this many locks, a key is guarded by the lock
+                number hash(key) % lock_stripes, so requests on different keys rarely wait on each other
+            storage_dir: keep self.data in a LogStore (see LogStore.py) in this directory, so that it
+                survives restarts, instead of in memory. sync_policy is the LogStore sync policy.
+                The ttls of the keys (see put) are not kept, the keys stay after a restart.
+        """
+        self.data = LogStore(storage_dir, sync_policy) if storage_dir else {}
         self.corruptible = corruptible
         self.continue_running = True
-        self.server = SimpleXMLRPCServer((host_name, port))
+        self.locks = [Lock() for _ in range(lock_stripes)]
+        self.expiry_lock = Lock() # guards the three below, taken after the lock of a key
+        self.expiries = {} # dict<key, time at which it expires>, for the keys put with a ttl
+        self.expiry_heap = [] # min-heap of (time, key), entries not matching self.expiries are stale
+        self.expiry_counts = dict(expired=0, touched=0, stale=0)
+        self.namespace_lock = Lock() # taken by the operations on directory entries, see create_entry
+        self.chunk_lock = Lock() # guards self.chunk_counts, taken after the lock of a chunk
+        self.chunk_counts = dict(chunks=0, stored_bytes=0, referenced_bytes=0) # see dedup_stats
+        for key in self.data.keys() if storage_dir else []: # count the chunks kept by the LogStore
+            if key.startswith('#') and key.endswith(':refs'):
+                refs, length = pickle.loads(self.data[key])
+                self.count_chunk(refs, length, 1)
+        if workers:
+            self.server = ThreadPoolXMLRPCServer((host_name, port), workers)
+            self.server.timeout = 0.5 # so the accept loop notices terminate() without a new request
+        else:
+            self.server = SimpleXMLRPCServer((host_name, port))
         self.server.register_instance(self)
+        self.server.register_introspection_functions() # lets clients check which methods we have
+        self.binary_server = None
+        if binary_port: # serve get/put/delete over the binary protocol too (see BinaryProtocol.py)
+            self.binary_server = BinaryServer((host_name, binary_port), self)
+            binary_thread = Thread(target=self.binary_server.serve_forever)
+            binary_thread.daemon = True
+            binary_thread.start()
         while self.continue_running:
             self.server.handle_request()
+        if workers:
+            self.server.stop_workers()
+        if self.binary_server:
+            self.binary_server.shutdown()
+        self.server.server_close()
+        if storage_dir:
+            self.data.close()
+
+    def lock(self, key): # returns the lock that guards a key of self.data
+        return self.locks[hash(key) % len(self.locks)]
+
+    @contextmanager
+    def locked(self, *keys): # holds the locks of several keys, taken in a fixed order so they can't deadlock
+        locks = sorted(set(self.lock(key) for key in keys), key=self.locks.index)
+        for lock in locks:
+            lock.acquire()
+        try:
+            yield
+        finally:
+            for lock in reversed(locks):
+                lock.release()
 
     def get(self, key):
-        if key.data in self.data:
-            return Binary(self.data[key.data])
+        self.expire()
+        with self.lock(key.data):
+            if key.data in self.data and not self.expired(key.data):
+                return Binary(self.data[key.data])
         return False
 
-    def put(self, key, value):
-        self.data[key.data] = value.data
+    def put(self, key, value, ttl=None):
+        """ Stores value under key. With a ttl, the key is deleted ttl seconds later unless it is
+            put again or touched before, without a ttl it stays until deleted. """
+        self.expire()
+        with self.lock(key.data):
+            self.data[key.data] = value.data
+            self.set_expiry(key.data, ttl)
         return True
 
     def delete(self, key):
-        del self.data[key.data]
+        self.expire()
+        with self.lock(key.data):
+            self.set_expiry(key.data, None)
+            if key.data in self.data:
+                del self.data[key.data]
+                return True
+        return False
+
+    def touch(self, key, ttl):
+        """ Makes key expire ttl seconds from now, or never if ttl is None, without sending its
+            value again. Returns False if there is no such key. """
+        self.expire()
+        with self.lock(key.data):
+            if key.data not in self.data or self.expired(key.data):
+                return False
+            self.set_expiry(key.data, ttl)
+            with self.expiry_lock:
+                self.expiry_counts['touched'] += 1
+        return True
+
+    # The keys put with a ttl are expired by the requests themselves: every request first deletes
+    # the keys whose time has come (at most EXPIRE_BATCH of them), found at the top of a min-heap,
+    # so expiring costs O(log n) per expired key and nothing when no key is due. Changing the
+    # expiry time of a key (put, touch, delete) leaves its old heap entry behind as stale, skipped
+    # when it reaches the top; the heap is rebuilt once it is mostly stale. A key past its time is
+    # never returned, even before it is deleted.
+
+    def set_expiry(self, key, ttl): # the lock of key must be held
+        with self.expiry_lock:
+            if ttl is None:
+                if self.expiries.pop(key, None) is not None:
+                    self.expiry_counts['stale'] += 1
+                return
+            if key in self.expiries:
+                self.expiry_counts['stale'] += 1
+            self.expiries[key] = deadline = time() + ttl
+            heappush(self.expiry_heap, (deadline, key))
+            if self.expiry_counts['stale'] > len(self.expiries) + 1024: # drop the stale entries
+                self.expiry_heap = [(when, key) for key, when in self.expiries.items()]
+                heapify(self.expiry_heap)
+                self.expiry_counts['stale'] = 0
+
+    def expired(self, key):
+        deadline = self.expiries.get(key)
+        return deadline is not None and deadline <= time()
+
+    def expire(self): # deletes the keys whose time has come, see above
+        due, now = [], time()
+        with self.expiry_lock:
+            while self.expiry_heap and self.expiry_heap[0][0] <= now and len(due) < EXPIRE_BATCH:
+                deadline, key = heappop(self.expiry_heap)
+                if self.expiries.get(key) == deadline:
+                    due.append((deadline, key))
+                else:
+                    self.expiry_counts['stale'] -= 1
+        for deadline, key in due:
+            with self.lock(key):
+                with self.expiry_lock:
+                    if self.expiries.get(key) != deadline: # put again, touched or deleted meanwhile,
+                        self.expiry_counts['stale'] -= 1 # which counted the popped entry as stale
+                        continue
+                    del self.expiries[key]
+                    self.expiry_counts['expired'] += 1
+                if key in self.data:
+                    del self.data[key]
+
+    def expiry_stats(self):
+        """ Returns dict(expiring, expired, touched, stale, heap): the keys that have a ttl, the
+            keys expired and the touch calls so far, and the stale and all the entries of the heap. """
+        with self.expiry_lock:
+            return dict(self.expiry_counts, expiring=len(self.expiries), heap=len(self.expiry_heap))
+
+    def get_many(self, keys): # returns the value (or False) of every key, in one round trip
+        return [self.get(key) for key in keys]
+
+    def put_many(self, items): # items is a list of [key, value] pairs
+        for key, value in items:
+            self.put(key, value)
+        return True
+
+    # Content-addressed chunks (see File.push_blocks in FileSystem.py): the blocks of the files written
+    # by a --dedup mount are stored once under '#<sha1 hex digest of the block>', whatever the number
+    # of blocks holding the same bytes, and '#<digest>:refs' holds (reference count, length). A client
+    # references the chunks the server has already (ref_chunks), uploads only the missing ones
+    # (put_chunks) and releases the chunks of the blocks it overwrites or deletes (unref_chunks).
+    # A chunk is deleted with its last reference.
+
+    def count_chunk(self, refs, length, chunks): # refs more references to a chunk of length bytes
+        with self.chunk_lock:
+            self.chunk_counts['chunks'] += chunks
+            self.chunk_counts['stored_bytes'] += chunks * length
+            self.chunk_counts['referenced_bytes'] += refs * length
+
+    def add_chunk_ref(self, key, value=None): # the lock of key must be held
+        """ Adds a reference to the chunk key, stored with value if it is missing. Returns False
+            if the chunk is missing and there is no value. """
+        refs_key = key + ':refs'
+        if refs_key in self.data:
+            refs, length = pickle.loads(self.data[refs_key])
+            self.data[refs_key] = pickle.dumps((refs + 1, length))
+            self.count_chunk(1, length, 0)
+            return True
+        if value is None:
+            return False
+        self.data[key] = value
+        self.data[refs_key] = pickle.dumps((1, len(value)))
+        self.count_chunk(1, len(value), 1)
+        return True
+
+    def ref_chunks(self, keys):
+        """ Adds a reference to every chunk of keys the server has. Returns the keys of the
+            missing chunks, to be sent with put_chunks. """
+        missing = []
+        for key in keys:
+            with self.lock(key.data):
+                if not self.add_chunk_ref(key.data):
+                    missing.append(key)
+        return missing
+
+    def put_chunks(self, items):
+        """ Stores the chunks of items (a list of [key, value] pairs) with one reference each, or
+            adds a reference to the ones another client stored meanwhile. Returns True, or EINVAL
+            (and stores nothing) if a key isn't the digest of its value. """
+        if any(key.data != '#' + sha1(value.data).hexdigest() for key, value in items):
+            return EINVAL
+        for key, value in items:
+            with self.lock(key.data):
+                self.add_chunk_ref(key.data, value.data)
+        return True
+
+    def unref_chunks(self, keys): # removes a reference to every chunk of keys
+        for key in keys:
+            with self.lock(key.data):
+                refs_key = key.data + ':refs'
+                if refs_key not in self.data:
+                    continue
+                refs, length = pickle.loads(self.data[refs_key])
+                if refs > 1:
+                    self.data[refs_key] = pickle.dumps((refs - 1, length))
+                    self.count_chunk(-1, length, 0)
+                else:
+                    del self.data[key.data]
+                    del self.data[refs_key]
+                    self.count_chunk(-1, length, -1)
         return True
 
+    def dedup_stats(self):
+        """ Returns dict(chunks, stored_bytes, referenced_bytes, saved_bytes, ratio): the chunks
+            stored, their bytes, the bytes of all the blocks referencing them, the bytes the
+            sharing saves and referenced_bytes / stored_bytes. """
+        with self.chunk_lock:
+            stats = dict(self.chunk_counts)
+        stats['saved_bytes'] = stats['referenced_bytes'] - stats['stored_bytes']
+        stats['ratio'] = stats['referenced_bytes'] / float(stats['stored_bytes'] or 1)
+        return stats
+
+    # Block checksums (see File.update_checksums in FileSystem.py): the checksums of the blocks of a file
+    # are kept SUMS_RANGE blocks to a record, '<serial>:sums' for the first range and '<serial>:sums<i>'
+    # for range i, with the number of ranges under '<serial>:sums:ranges' once there is more than one.
+    # A flush sends only the checksums of the blocks it wrote, so it reads and writes only the records
+    # of the ranges they fall in, however large the file. The lock of '<serial>:sums' guards them all.
+
+    @staticmethod
+    def sums_key(serial_num, index):
+        return '{0}:sums{1}'.format(serial_num, index or '')
+
+    def sums_ranges(self, serial_num): # the number of checksum records of a file
+        value = self.data.get('{0}:sums:ranges'.format(serial_num))
+        if value is not None:
+            return pickle.loads(value)
+        return 1 if self.sums_key(serial_num, 0) in self.data else 0
+
+    def all_checksums(self, serial_num): # dict<block number, checksum> of every range
+        checksums = {}
+        for index in range(self.sums_ranges(serial_num)):
+            value = self.data.get(self.sums_key(serial_num, index))
+            if value is not None:
+                checksums.update(pickle.loads(value))
+        return checksums
+
+    def pull_checksums(self, serial_num): # returns the pickled checksums of all the blocks of a file
+        with self.lock(self.sums_key(serial_num, 0)):
+            return Binary(pickle.dumps(self.all_checksums(serial_num), pickle.HIGHEST_PROTOCOL))
+
+    def update_checksums(self, serial_num, changed, block_count=-1):
+        """ Merges changed, the pickled dict<block number, checksum> of the blocks a client wrote,
+            into the checksums of a file, then drops the checksums of the blocks from block_count
+            on unless it is -1. Only the records of the ranges that change are read and written.
+            Returns the pickled list of the checksums replaced or dropped, so the client can release
+            their chunks. """
+        ranges = {}
+        for block, checksum in pickle.loads(changed.data).items():
+            ranges.setdefault(block // SUMS_RANGE, {})[block] = checksum
+        replaced = []
+        with self.lock(self.sums_key(serial_num, 0)):
+            count = self.sums_ranges(serial_num)
+            for index, checksums in ranges.items():
+                key = self.sums_key(serial_num, index)
+                stored = pickle.loads(self.data[key]) if key in self.data else {}
+                replaced.extend(stored[block] for block in checksums if block in stored)
+                stored.update(checksums)
+                self.data[key] = pickle.dumps(stored, pickle.HIGHEST_PROTOCOL)
+                count = max(count, index + 1)
+            if block_count >= 0:
+                for index in range(block_count // SUMS_RANGE, count):
+                    key = self.sums_key(serial_num, index)
+                    if key not in self.data:
+                        continue
+                    stored = pickle.loads(self.data[key])
+                    replaced.extend(stored.pop(block) for block in [b for b in stored if b >= block_count])
+                    if stored:
+                        self.data[key] = pickle.dumps(stored, pickle.HIGHEST_PROTOCOL)
+                    else:
+                        del self.data[key]
+                count = min(count, -(-block_count // SUMS_RANGE))
+            if count > 1:
+                self.data['{0}:sums:ranges'.format(serial_num)] = pickle.dumps(count)
+            elif '{0}:sums:ranges'.format(serial_num) in self.data:
+                del self.data['{0}:sums:ranges'.format(serial_num)]
+        return Binary(pickle.dumps(replaced, pickle.HIGHEST_PROTOCOL))
+
+    def entry(self, serial_num, name):
+        """ Returns the serial number of the entry name of a directory, None if it has no such entry.
+            Raises KeyError, TypeError or AttributeError if serial_num is not a directory. """
+        with self.lock('{0}:dir'.format(serial_num)):
+            header = self.dir_header(serial_num)
+            if header is not None: # FileSystem.py stores the entries in buckets, see add_to_dir
+                return self.find_entry(serial_num, header, name)
+        with self.lock(str(serial_num)):
+            if self.expired(str(serial_num)):
+                raise KeyError(serial_num)
+            value = self.data[str(serial_num)]
+        return load_record(value).data.get(name) # remoteHierarchicalFS.py pickles the whole file
+
+    def resolve(self, path):
+        """ Walks path over the directory entries, starting from the root (serial number 0).
+            Returns False if the path doesn't exist, otherwise a dict with
+            'serials': the serial numbers of the root and of every component of the path,
+            'value': the value stored for the target, 'parent': the value stored for its parent dir
+        """
+        serials = [0]
+        for name in [part for part in path.data.split('/') if part]:
+            try:
+                serial_num = self.entry(serials[-1], name)
+            except (KeyError, TypeError, AttributeError): # not a directory
+                return False
+            if serial_num is None:
+                return False
+            serials.append(int(serial_num))
+        target, parent = str(serials[-1]), str(serials[-2] if len(serials) > 1 else serials[0])
+        value, parent_value = self.get(Binary(target)), self.get(Binary(parent))
+        if not value or not parent_value:
+            return False
+        return dict(serials=serials, value=value, parent=parent_value)
+
+    # The entries of a FileSystem.py directory are spread over buckets by linear hashing: bucket 0 is
+    # stored under '<serial>:data' and bucket i under '<serial>:data<i>', each a pickled
+    # dict<name, serial number>. The header '<serial>:dir' holds the hashing level, the next bucket to
+    # split and the entry count; a directory without a header has a single bucket. One bucket is split
+    # every time the directory grows by BUCKET_SIZE entries, so adding or removing an entry rewrites
+    # one or two small buckets whatever the size of the directory.
+    # A bucket at level l holds the names whose hash ends with the l bits of its number: read backwards,
+    # these bits make the bucket a range of bit-reversed hashes, and a split cuts a range in two halves.
+    # list_entries goes through the buckets in the order of their ranges, so a listing cursor (the end of
+    # a range) stays the boundary of a range when buckets are split between two pages.
+
+    def dir_header(self, serial_num): # returns the header of a directory, None if it is not a directory
+        header_key, data_key = '{0}:dir'.format(serial_num), '{0}:data'.format(serial_num)
+        value = self.data.get(header_key) if not self.expired(header_key) else None
+        if value is not None:
+            return pickle.loads(value)
+        value = self.data.get(data_key) if not self.expired(data_key) else None
+        entries = pickle.loads(value) if value is not None else None
+        if not isinstance(entries, dict): # not a directory, or a link
+            return None
+        return dict(level=0, split=0, count=len(entries))
+
+    @staticmethod
+    def bucket_key(serial_num, index):
+        return '{0}:data{1}'.format(serial_num, index or '')
+
+    @staticmethod
+    def bucket_index(header, name): # the bucket that holds the entry name
+        hashed = crc32(name) & 0xffffffff
+        index = hashed % (1 << header['level'])
+        if index < header['split']: # that bucket was split already at this level
+            index = hashed % (2 << header['level'])
+        return index
+
+    @staticmethod
+    def bucket_count(header):
+        return (1 << header['level']) + header['split']
+
+    @staticmethod
+    def bucket_range(header, index): # the (start, end) of a bucket in the order of list_entries
+        level = header['level'] + (index < header['split'] or index >= 1 << header['level'])
+        reversed_index = int(bin(index)[2:].zfill(level)[::-1], 2) if level else 0
+        return reversed_index << (HASH_BITS - level), (reversed_index + 1) << (HASH_BITS - level)
+
+    def bucket(self, serial_num, index):
+        value = self.data.get(self.bucket_key(serial_num, index))
+        return pickle.loads(value) if value is not None else {}
+
+    def store_bucket(self, serial_num, index, bucket):
+        self.data[self.bucket_key(serial_num, index)] = pickle.dumps(bucket)
+
+    def find_entry(self, serial_num, header, name):
+        return self.bucket(serial_num, self.bucket_index(header, name)).get(name)
+
+    def add_to_dir(self, serial_num, header, name, child): # updates header in place and stores it
+        index = self.bucket_index(header, name)
+        bucket = self.bucket(serial_num, index)
+        bucket[name] = child
+        self.store_bucket(serial_num, index, bucket)
+        header['count'] += 1
+        if header['count'] > BUCKET_SIZE * self.bucket_count(header):
+            self.split_bucket(serial_num, header)
+        self.data['{0}:dir'.format(serial_num)] = pickle.dumps(header)
+
+    def remove_from_dir(self, serial_num, header, name):
+        index = self.bucket_index(header, name)
+        bucket = self.bucket(serial_num, index)
+        del bucket[name]
+        self.store_bucket(serial_num, index, bucket)
+        header['count'] -= 1
+        self.data['{0}:dir'.format(serial_num)] = pickle.dumps(header)
+
+    def split_bucket(self, serial_num, header): # moves half of the next bucket to a new one
+        old, new = header['split'], header['split'] + (1 << header['level'])
+        bucket, moved = self.bucket(serial_num, old), {}
+        for name in bucket.keys():
+            if (crc32(name) & 0xffffffff) % (2 << header['level']) == new:
+                moved[name] = bucket.pop(name)
+        self.store_bucket(serial_num, old, bucket)
+        self.store_bucket(serial_num, new, moved)
+        header['split'] += 1
+        if header['split'] == 1 << header['level']:
+            header['level'], header['split'] = header['level'] + 1, 0
+
+    def list_entries(self, serial_num, cursor, count, records=False):
+        """ Pages through the entries of a directory. Returns dict(entries, cursor): entries is a
+            pickled list of (name, serial number) pairs, the content of the buckets whose range
+            starts at cursor or later (see bucket_range) until there are at least count of them,
+            and cursor is where the next page starts, -1 after the last one. An entry is listed
+            once even if buckets are split between the pages. Returns an errno if serial_num is not
+            a directory.
+            With records, the entries are (name, serial number, metadata record) triples instead,
+            the record being None if the file is gone, so readdir gets the attributes too. """
+        with self.lock('{0}:dir'.format(serial_num)):
+            header = self.directory(serial_num)
+            if not isinstance(header, dict):
+                return header
+            entries = []
+            for (start, end), index in sorted((self.bucket_range(header, index), index)
+                                              for index in range(self.bucket_count(header))):
+                if start < cursor:
+                    continue
+                if len(entries) >= count:
+                    break
+                entries.extend(self.bucket(serial_num, index).items())
+                cursor = end
+        if cursor == 1 << HASH_BITS:
+            cursor = -1
+        if records:
+            entries = [(name, child, self.data.get(str(child))) for name, child in entries]
+        return dict(entries=Binary(pickle.dumps(entries, pickle.HIGHEST_PROTOCOL)), cursor=cursor)
+
+    # The operations on directory entries below work on the records of FileSystem.py and apply all
+    # their changes at once: they are serialized by self.namespace_lock and hold the locks of every
+    # key they touch. They return an errno (int) when they fail.
+
+    @staticmethod
+    def file_keys(serial_num): # the keys of the records of a file, apart from buckets and blocks
+        return [str(serial_num)] + ['{0}:{1}'.format(serial_num, kind)
+                                    for kind in ('data', 'dir', 'sums', 'sums:ranges')]
+
+    def directory(self, serial_num): # returns the header of a directory, or an errno
+        header = self.dir_header(serial_num)
+        if header is None:
+            return ENOENT if str(serial_num) not in self.data else ENOTDIR
+        return header
+
+    def is_dir(self, serial_num):
+        value = self.data.get(str(serial_num))
+        return value is not None and S_ISDIR(load_record(value)['properties']['st_mode'])
+
+    def has_entries(self, serial_num): # a directory that isn't empty can't be removed or replaced
+        header = self.dir_header(serial_num)
+        return header is not None and header['count'] > 0
+
+    def add_nlink(self, serial_num, count):
+        record = load_record(self.data[str(serial_num)])
+        record['properties']['st_nlink'] += count
+        self.data[str(serial_num)] = pickle.dumps(record)
+
+    def drop_file(self, serial_num): # deletes the records of a file, returns its serial number, metadata and checksums
+        value = self.data.get(str(serial_num), '')
+        checksums = self.all_checksums(serial_num)
+        checksums = pickle.dumps(checksums, pickle.HIGHEST_PROTOCOL) if checksums else ''
+        header = self.dir_header(serial_num)
+        keys = self.file_keys(serial_num)
+        keys += [self.sums_key(serial_num, index) for index in range(1, self.sums_ranges(serial_num))]
+        if header is not None:
+            keys += [self.bucket_key(serial_num, index) for index in range(1, self.bucket_count(header))]
+        for key in keys:
+            if key in self.data:
+                del self.data[key]
+        return dict(serial=serial_num, value=Binary(value), sums=Binary(checksums))
+
+    def create_entry(self, parent, name, serial_num, items):
+        """ Stores the records of a new file (items, a list of [key, value] pairs) and adds the entry
+            name -> serial_num to the directory parent, whose st_nlink grows if the file is a directory.
+            Returns 0, or EEXIST if parent already has an entry called name. """
+        with self.namespace_lock:
+            keys = self.file_keys(parent) + [key.data for key, _ in items]
+            with self.locked(*keys):
+                header = self.directory(parent)
+                if not isinstance(header, dict):
+                    return header
+                if self.find_entry(parent, header, name.data) is not None:
+                    return EEXIST
+                for key, value in items:
+                    self.data[key.data] = value.data
+                self.add_to_dir(parent, header, name.data, serial_num)
+                if self.is_dir(serial_num):
+                    self.add_nlink(parent, 1)
+        return 0
+
+    def remove_entry(self, parent, name):
+        """ Removes the entry name from the directory parent and deletes the records of its file.
+            Returns dict(serial, value, sums) with the serial number, the metadata and the block
+            checksums of the removed file, so the client can delete its blocks, or ENOTEMPTY if
+            the file is a directory that still has entries. """
+        with self.namespace_lock:
+            header = self.directory(parent)
+            if not isinstance(header, dict):
+                return header
+            serial_num = self.find_entry(parent, header, name.data)
+            if serial_num is None:
+                return ENOENT
+            with self.locked(*(self.file_keys(parent) + self.file_keys(serial_num))):
+                if self.has_entries(serial_num):
+                    return ENOTEMPTY
+                self.remove_from_dir(parent, header, name.data)
+                if self.is_dir(serial_num):
+                    self.add_nlink(parent, -1)
+                return self.drop_file(serial_num)
+
+    def rename_entry(self, old_parent, new_parent, old_name, new_name):
+        """ Moves the entry old_name of the directory old_parent to new_name in new_parent and renames
+            its file. A file that new_name referred to is deleted like by remove_entry.
+            Returns dict(serial, replaced): the serial number of the moved file, and the
+            dict(serial, value, sums) of the replaced file or False. Returns ENOTEMPTY if the
+            replaced file is a directory that still has entries. """
+        with self.namespace_lock:
+            old_header = self.directory(old_parent)
+            if not isinstance(old_header, dict):
+                return old_header
+            new_header = old_header if new_parent == old_parent else self.directory(new_parent)
+            if not isinstance(new_header, dict):
+                return new_header
+            serial_num = self.find_entry(old_parent, old_header, old_name.data)
+            if serial_num is None:
+                return ENOENT
+            replaced = self.find_entry(new_parent, new_header, new_name.data)
+            if replaced == serial_num: # renamed to itself
+                return dict(serial=serial_num, replaced=False)
+            keys = self.file_keys(old_parent) + self.file_keys(new_parent) + self.file_keys(serial_num)
+            if replaced is not None:
+                keys += self.file_keys(replaced)
+            with self.locked(*keys):
+                if replaced is not None and self.has_entries(replaced):
+                    return ENOTEMPTY
+                self.remove_from_dir(old_parent, old_header, old_name.data)
+                if replaced is not None:
+                    self.remove_from_dir(new_parent, new_header, new_name.data)
+                self.add_to_dir(new_parent, new_header, new_name.data, serial_num)
+                record = load_record(self.data[str(serial_num)])
+                record['name'] = new_name.data
+                self.data[str(serial_num)] = pickle.dumps(record)
+                if self.is_dir(serial_num) and new_parent != old_parent:
+                    self.add_nlink(old_parent, -1)
+                    self.add_nlink(new_parent, 1)
+                if replaced is not None:
+                    if self.is_dir(replaced):
+                        self.add_nlink(new_parent, -1)
+                    replaced = self.drop_file(replaced)
+        return dict(serial=serial_num, replaced=replaced if replaced is not None else False)
+
+    def lease_serials(self, count):
+        """ Reserves count serial numbers for a client and returns the first one, so that clients
+            sharing the server never give two files the same serial number. Serial number 0 is left
+            for the root. The next free serial number is kept under the key 'next serial'. """
+        with self.lock('next serial'):
+            first = pickle.loads(self.data['next serial']) if 'next serial' in self.data else 1
+            self.data['next serial'] = pickle.dumps(first + count)
+        return first
+
     def list_contents(self): # used for debugging
-        return Binary(pickle.dumps(self.data))
+        return Binary(pickle.dumps(dict(self.data)))
 
     def corrupt(self,key): # used for debugging
         if not self.corruptible:
             return False
-        if key.data in self.data:
-            self.data[key.data] = "CORRUPT!"
-            return Binary("CORRUPT!")
+        with self.lock(key.data):
+            if key.data in self.data:
+                self.data[key.data] = "CORRUPT!"
+                return Binary("CORRUPT!")
         return False
 
     def terminate(self): # used for debugging
@@ -46,9 +684,26 @@ class Server(object):
 
 
 if __name__ == "__main__":
-    if len(argv) not in (2,3):
-        print("usage: python Server.py port [-c]")
+    usage = "usage: python Server.py port [-c] [-b binary_port] [-t worker_threads] " \
+            "[-d storage_dir [-s always|group|periodic]]"
+    if len(argv) < 2:
+        print(usage)
+        exit(1)
+    port, options = argv[1], argv[2:]
+
+    def option(flag, kind=int): # returns the value given after flag, or None if flag isn't there
+        if flag not in options:
+            return None
+        try:
+            return kind(options[options.index(flag) + 1])
+        except (IndexError, ValueError):
+            print(usage)
+            exit(1)
+
+    corruptible = "-c" in options
+    sync_policy = option("-s", str) or 'periodic'
+    if sync_policy not in SYNC_POLICIES:
+        print(usage)
         exit(1)
-    port = argv[1]
-    corruptible = True if len(argv) == 3 and argv[2] == "-c" else False
-    Server("localhost",int(port),corruptible)
\ No newline at end of file
+    Server("localhost",int(port),corruptible,option("-b"),option("-t") or 0,
+           storage_dir=option("-d", str),sync_policy=sync_policy)
\ No newline at end of file
@@ -0,0 +1,151 @@
+from __future__ import print_function, division
+from collections import OrderedDict
+from timeit import default_timer
+import os, os.path, sys
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir))
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir, os.pardir, 'MongoDB File System'))
+import BlockCodec
+import FileSystem
+from benchmark_helpers import Quiet, start_server
+
+# Encodes the files of a corpus with BlockCodec, block by block, and prints per kind of file the
+# encode and decode throughput and the compression ratio, with the probe (adaptive) and without it
+# (every block goes through zlib). Then copies the corpus into FileSystem with and without --compress
+# and reads it back, and prints the throughput and the bytes sent to (and stored on) the server.
+# Last, writes files of growing size sequentially to RemoteDB_FS --compress (on the in-memory stand-in
+# of the MongoDB collection, when pymongo is installed) and prints the write throughput and the bytes
+# encoded per byte written, which stay flat since a write re-encodes only the blocks from its offset
+# (the throughput still falls with the size: ClientFS.write copies the whole content in memory).
+# The corpus is the Python standard library: sources and text, bytecode, native libraries and
+# the already compressed files (wheels, images) it comes with, up to MiB_per_kind of each.
+# usage: python test/benchmark_compression.py [port] [block_size] [MiB_per_kind]
+
+KINDS = OrderedDict([
+    ('text', ('.py', '.txt', '.html', '.xml', '.decTest', '.tmpl', '.pem', '.def')),
+    ('bytecode', ('.pyc',)),
+    ('binary', ('.so', '.exe')),
+    ('compressed', ('.whl', '.zip', '.gz', '.gif', '.png', '.jpg')),
+])
+WRITE_SIZE = 64 << 10
+MONGODB_FILE_SIZES = [1 << 20, 4 << 20, 16 << 20]
+MONGODB_WRITE_SIZE = 4096 # what FUSE sends per write without big_writes
+
+
+def corpus(limit): # returns dict<kind, list of (name, content)>, at most limit bytes of every kind
+    files = OrderedDict((kind, []) for kind in KINDS)
+    sizes = dict((kind, 0) for kind in KINDS)
+    for directory, subdirectories, names in sorted(os.walk(os.path.dirname(os.__file__))):
+        subdirectories.sort()
+        for name in sorted(names):
+            kind = next((kind for kind, extensions in KINDS.items() if name.endswith(extensions)), None)
+            path = os.path.join(directory, name)
+            if kind is None or sizes[kind] >= limit or os.path.islink(path):
+                continue
+            with open(path, 'rb') as source:
+                content = source.read(limit - sizes[kind])
+            files[kind].append(('{0}{1}'.format(kind, len(files[kind])), content))
+            sizes[kind] += len(content)
+    return files
+
+
+def codec_run(files, block_size, adaptive):
+    BlockCodec.RANDOM_BYTE_SET = 200 if adaptive else 257 # 257: no sample has that many byte values
+    blocks = [content[start:start + block_size] for _, content in files
+              for start in range(0, len(content), block_size)]
+    start = default_timer()
+    values = [BlockCodec.encode(block) for block in blocks]
+    encode_time = default_timer() - start
+    start = default_timer()
+    for value in values:
+        BlockCodec.decode(value)
+    decode_time = default_timer() - start
+    size = sum(len(block) for block in blocks)
+    return size, encode_time, decode_time, sum(len(value) for value in values)
+
+
+def filesystem_run(port, files, block_size, compress):
+    server = start_server(port, workers=4)
+    FileSystem.rpc = FileSystem.ProxyPool('http://localhost:' + str(port), 8)
+    BlockCodec.stats.update(blocks=0, bytes=0, stored_bytes=0, compressed=0, probed_raw=0)
+    fs = FileSystem.FileSystem(block_size=block_size, compress=compress)
+    start = default_timer()
+    for name, content in files:
+        fh = fs('create', '/' + name, 0644)
+        for offset in range(0, len(content), WRITE_SIZE):
+            fs('write', '/' + name, content[offset:offset + WRITE_SIZE], offset, fh)
+        fs('release', '/' + name, fh)
+    write_time = default_timer() - start
+    start = default_timer()
+    for name, content in files:
+        fh = fs('open', '/' + name, os.O_RDONLY)
+        for offset in range(0, len(content), WRITE_SIZE):
+            assert fs('read', '/' + name, WRITE_SIZE, offset, fh) == content[offset:offset + WRITE_SIZE]
+        fs('release', '/' + name, fh)
+    read_time = default_timer() - start
+    size = sum(len(content) for _, content in files)
+    sent = BlockCodec.stats['stored_bytes'] if compress else size
+    FileSystem.rpc.terminate()
+    server.terminate()
+    server.join()
+    return size, write_time, read_time, sent
+
+
+def mongodb_run(content):
+    from benchmark_variants import MemoryCollection
+    import DB_Cache_Services, RemoteDB_FS
+    storage = DB_Cache_Services.FileStorageManager(None, None, 1000, collection=MemoryCollection(), compress=True)
+    fs = RemoteDB_FS.ClientFS(storage)
+    BlockCodec.stats.update(blocks=0, bytes=0, stored_bytes=0, compressed=0, probed_raw=0)
+    fh = fs('create', '/file', 0644)
+    start = default_timer()
+    for offset in range(0, len(content), MONGODB_WRITE_SIZE):
+        fs('write', '/file', content[offset:offset + MONGODB_WRITE_SIZE], offset, fh)
+    write_time = default_timer() - start
+    assert fs('read', '/file', len(content), 0, fh) == content
+    return write_time, BlockCodec.stats['bytes']
+
+
+def main():
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8080
+    block_size = int(sys.argv[2]) if len(sys.argv) > 2 else 4096
+    limit = (int(sys.argv[3]) if len(sys.argv) > 3 else 8) << 20
+    files = corpus(limit)
+    files['all'] = [item for kind in KINDS for item in files[kind]]
+    print("BlockCodec, blocks of {0} bytes".format(block_size))
+    print("{0:<12} {1:>9} {2:<10} {3:>12} {4:>12} {5:>7}".format(
+        "kind", "MiB", "codec", "encode MiB/s", "decode MiB/s", "ratio"))
+    for kind, kind_files in files.items():
+        for adaptive in (False, True):
+            size, encode_time, decode_time, stored = codec_run(kind_files, block_size, adaptive)
+            print("{0:<12} {1:>9.1f} {2:<10} {3:>12.1f} {4:>12.1f} {5:>7.2f}".format(
+                kind, size / (1 << 20), 'adaptive' if adaptive else 'zlib', size / encode_time / (1 << 20),
+                size / decode_time / (1 << 20), size / stored))
+    BlockCodec.RANDOM_BYTE_SET = 200
+    results = []
+    stdout, sys.stdout = sys.stdout, Quiet()
+    for compress in (False, True):
+        results.append((compress,) + filesystem_run(port, files['all'], block_size, compress))
+    sys.stdout = stdout
+    print("FileSystem, all of the corpus")
+    print("{0:<22} {1:>12} {2:>12} {3:>10} {4:>7}".format("mount", "write MiB/s", "read MiB/s", "MiB sent", "ratio"))
+    for compress, size, write_time, read_time, sent in results:
+        print("{0:<22} {1:>12.1f} {2:>12.1f} {3:>10.1f} {4:>7.2f}".format(
+            'FileSystem' + (' --compress' if compress else ''), size / write_time / (1 << 20),
+            size / read_time / (1 << 20), sent / (1 << 20), size / sent))
+    try:
+        import bson
+    except ImportError:
+        print("RemoteDB_FS skipped: pymongo is not installed")
+        return
+    text = ''.join(content for _, content in files['text']) or 'text'
+    stdout, sys.stdout = sys.stdout, Quiet()
+    results = [(size,) + mongodb_run((text * (size // len(text) + 1))[:size]) for size in MONGODB_FILE_SIZES]
+    sys.stdout = stdout
+    print("RemoteDB_FS --compress, sequential writes of {0} bytes".format(MONGODB_WRITE_SIZE))
+    print("{0:>9} {1:>12} {2:>22}".format("MiB", "write MiB/s", "encoded bytes/written"))
+    for size, write_time, encoded in results:
+        print("{0:>9.1f} {1:>12.1f} {2:>22.2f}".format(size / (1 << 20), size / write_time / (1 << 20), encoded / size))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+from __future__ import print_function, division
+from timeit import default_timer
+import os, os.path, sys
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir))
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir, os.pardir,
+                             'Hierarchical File System'))
+import FileSystem
+import hierarchicalFS
+from benchmark_helpers import Quiet, start_server
+
+# Copies the same tree of files several times, like cp -r does, into FileSystem with and without --dedup
+# and into hierarchicalFS.Memory with and without dedup, and prints the time, the bytes sent to the
+# server (FileSystem) or kept in memory (hierarchicalFS) and the deduplication ratio.
+# usage: python test/benchmark_dedup.py [port]
+
+FILES = 16
+FILE_SIZE = 256 << 10
+COPIES = 8
+WRITE_SIZE = 64 << 10
+
+
+def copy_tree(fs, tree):
+    for copy in range(COPIES):
+        directory = '/copy{0}'.format(copy)
+        fs('mkdir', directory, 0755)
+        for name, content in tree:
+            path = directory + '/' + name
+            fh = fs('create', path, 0644)
+            for offset in range(0, len(content), WRITE_SIZE):
+                fs('write', path, content[offset:offset + WRITE_SIZE], offset, fh)
+            fs('release', path, fh)
+
+
+def main():
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8080
+    tree = [('file{0}'.format(number), os.urandom(FILE_SIZE)) for number in range(FILES)]
+    written = COPIES * FILES * FILE_SIZE
+    results = []
+    stdout, sys.stdout = sys.stdout, Quiet()
+    for dedup in (False, True):
+        server = start_server(port, workers=8)
+        FileSystem.rpc = FileSystem.ProxyPool('http://localhost:' + str(port), 8)
+        FileSystem.dedup_stats.update(blocks=0, bytes=0, uploaded_bytes=0)
+        fs = FileSystem.FileSystem(block_size=4096, dedup=dedup)
+        start = default_timer()
+        copy_tree(fs, tree)
+        elapsed = default_timer() - start
+        sent = FileSystem.dedup_stats['uploaded_bytes'] if dedup else written
+        ratio = FileSystem.rpc.dedup_stats()['ratio'] if dedup else 1.0
+        results.append(('FileSystem' + (' --dedup' if dedup else ''), elapsed, 'sent', sent, ratio))
+        FileSystem.rpc.terminate()
+        server.terminate()
+        server.join()
+        fs = hierarchicalFS.Memory(dedup=dedup)
+        start = default_timer()
+        copy_tree(fs, tree)
+        elapsed = default_timer() - start
+        ratio = fs.pager.dedup_stats()['ratio'] if dedup else 1.0
+        results.append(('hierarchicalFS' + (' dedup' if dedup else ''), elapsed, 'kept', fs.pager.resident, ratio))
+    sys.stdout = stdout
+    print("{0} copies of {1} files of {2} KiB: {3:.1f} MiB written".format(
+        COPIES, FILES, FILE_SIZE >> 10, written / (1 << 20)))
+    print("{0:<24} {1:>9} {2:>14} {3:>7}".format("file system", "seconds", "MiB", "ratio"))
+    for name, elapsed, kind, size, ratio in results:
+        print("{0:<24} {1:>9.2f} {2:>9.1f} {3:<4} {4:>7.2f}".format(name, elapsed, size / (1 << 20), kind, ratio))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,48 @@
+from __future__ import print_function
+from timeit import default_timer
+from xmlrpclib import Binary, ServerProxy
+import os.path, sys
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir))
+import FileSystem
+from benchmark_helpers import Quiet, start_server
+
+# Measures getattr on files of growing size. Since the metadata of a file is stored apart from
+# its content, neither the time of a getattr nor the bytes it transfers should grow with the file.
+# Every getattr goes to the server: the client's attribute cache is turned off.
+# usage: python test/benchmark_getattr.py [port]
+
+FILE_SIZES = [0, 64 << 10, 1 << 20, 16 << 20]
+CALLS = 200
+
+
+def main():
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8080
+    server = start_server(port)
+    FileSystem.rpc = ServerProxy('http://localhost:' + str(port))
+    FileSystem.attr_cache.ttl = 0 # otherwise all but the first getattr of a file are served from the cache
+    stdout, sys.stdout = sys.stdout, Quiet()
+    fs = FileSystem.FileSystem(block_size=64 << 10)
+    results = []
+    for size in FILE_SIZES:
+        path = '/file_' + str(size)
+        fh = fs.create(path, 0644)
+        chunk = 'x' * (64 << 10)
+        for offset in range(0, size, len(chunk)):
+            fs.write(path, chunk[:size - offset], offset, fh)
+        fs.release(path, fh)
+        start = default_timer()
+        for _ in range(CALLS):
+            fs.getattr(path)
+        elapsed = default_timer() - start
+        serial = FileSystem.dentry_cache[path]
+        metadata_bytes = len(FileSystem.rpc.get(Binary(str(serial))).data)
+        results.append((size, elapsed / CALLS * 1000, metadata_bytes))
+    sys.stdout = stdout
+    print("{0:>12} {1:>14} {2:>16}".format("file size", "getattr (ms)", "metadata bytes"))
+    for size, millis, metadata_bytes in results:
+        print("{0:>12} {1:>14.3f} {2:>16}".format(size, millis, metadata_bytes))
+    server.terminate()
+
+
+if __name__ == "__main__":
+    main()
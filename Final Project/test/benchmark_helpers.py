@@ -0,0 +1,44 @@
+from multiprocessing import Process
+import os, os.path, socket, sys, time
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir))
+from Server import Server
+
+# What the benchmarks share: silencing the file systems, and starting a Server in a child process.
+#   server = start_server(port, workers=4) # returns once the server accepts connections
+#   stdout, sys.stdout = sys.stdout, Quiet()
+
+SERVER_START_TIMEOUT = 10 # seconds
+
+
+class Quiet(object): # swallows the per operation prints of the file systems
+    def write(self, text): pass
+    def flush(self): pass
+
+
+def serve(port, corruptible=False, binary_port=None, workers=0): # the requests logged by the server would drown the results
+    sys.stderr = open(os.devnull, 'w')
+    Server("localhost", port, corruptible, binary_port, workers)
+
+
+def wait_for_port(port, process=None, timeout=SERVER_START_TIMEOUT):
+    deadline = time.time() + timeout
+    while True:
+        try:
+            socket.create_connection(('localhost', port), 1).close()
+            return
+        except socket.error:
+            if process is not None and not process.is_alive():
+                raise RuntimeError('the server on port {0} exited'.format(port))
+            if time.time() > deadline:
+                raise RuntimeError('the server on port {0} did not start in {1} s'.format(port, timeout))
+            time.sleep(0.01)
+
+
+def start_server(port, corruptible=False, binary_port=None, workers=0):
+    server = Process(target=serve, args=(port, corruptible, binary_port, workers))
+    server.daemon = True
+    server.start()
+    for listening_port in (port, binary_port):
+        if listening_port is not None:
+            wait_for_port(listening_port, server)
+    return server
@@ -0,0 +1,54 @@
+#!/bin/bash
+# Counts the requests the kernel sends to FileSystem.py (upcalls) for `ls -R` and `find` over a deep
+# tree, without a profile and with every profile of --profile. Every operation of the file system
+# prints a line, the counts are taken from its output. Needs FUSE:
+#   bash test/benchmark_profiles.sh [port]
+cd "$(dirname "$0")/.."
+port=${1:-8090}
+mnt=$(mktemp -d)
+log=$(mktemp)
+python Server.py $port > /dev/null 2>&1 &
+server=$!
+trap 'fusermount -uz "$mnt" 2> /dev/null; kill $server; rm -rf "$mnt" "$log"' EXIT
+until python -c "import socket; socket.create_connection(('localhost', $port)).close()" 2> /dev/null; do
+    sleep 0.1 # until the server accepts connections
+done
+
+mount_fs(){ # mount_fs [profile]
+    python -u FileSystem.py "$mnt" --meta-port $port ${1:+--profile $1} > "$log" 2>&1 &
+    fs=$!
+    while ! mountpoint -q "$mnt"; do sleep 0.2; done
+}
+
+unmount_fs(){
+    fusermount -u "$mnt"
+    wait $fs
+}
+
+upcalls(){ # upcalls command [args]: runs the command in the mount, prints the operations it caused
+    before=$(grep -c '(self' "$log")
+    (cd "$mnt" && "$@" > /dev/null)
+    echo $(( $(grep -c '(self' "$log") - before ))
+}
+
+make_tree(){ # make_tree dir depth: 3 files and 2 sub directories per directory, depth levels deep
+    for i in 1 2 3; do echo $i > "$1/file$i"; done
+    if [ $2 -gt 0 ]; then
+        for i in 1 2; do
+            mkdir "$1/dir$i"
+            make_tree "$1/dir$i" $(( $2 - 1 ))
+        done
+    fi
+}
+
+echo "Building the tree..."
+mount_fs
+make_tree "$mnt" 6
+unmount_fs
+
+printf "%-14s %10s %12s %10s %12s\n" profile "ls -R" "ls -R again" find "find again"
+for profile in none conservative read-mostly single-writer; do
+    mount_fs $([ $profile = none ] || echo $profile)
+    printf "%-14s %10s %12s %10s %12s\n" $profile $(upcalls ls -R) $(upcalls ls -R) $(upcalls find .) $(upcalls find .)
+    unmount_fs
+done
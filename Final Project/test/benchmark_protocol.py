@@ -0,0 +1,61 @@
+from __future__ import print_function
+from timeit import default_timer
+from xmlrpclib import Binary, ServerProxy, dumps
+import os.path, sys
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir))
+from BinaryProtocol import BinaryProxy
+from benchmark_helpers import start_server
+
+# Compares XML-RPC with the binary protocol on the same server: put + get of values of several
+# sizes, reporting operations per second and bytes on the wire per operation. For XML-RPC only
+# the request and response documents are counted, not the HTTP headers.
+# usage: python test/benchmark_protocol.py [port] [binary port]
+
+VALUE_SIZES = [64, 4096, 65536]
+OPS = 1000
+
+
+def xmlrpc_bytes(method, params, result): # size of the XML documents of one call
+    return len(dumps(params, method)) + len(dumps((result,), methodresponse=True))
+
+
+def run(proxy, value_size, count_bytes):
+    value = Binary('x' * value_size)
+    keys = [Binary('bench:{0}:{1}'.format(value_size, i)) for i in range(OPS // 2)]
+    start = default_timer()
+    for key in keys:
+        proxy.put(key, value)
+    for key in keys:
+        proxy.get(key)
+    elapsed = default_timer() - start
+    return OPS / elapsed, count_bytes(keys, value) / float(OPS)
+
+
+def main():
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8080
+    binary_port = int(sys.argv[2]) if len(sys.argv) > 2 else port + 1
+    server = start_server(port, binary_port=binary_port)
+    xml_proxy = ServerProxy('http://localhost:' + str(port))
+    binary_proxy = BinaryProxy('localhost', binary_port, xml_proxy)
+
+    def xml_count(keys, value):
+        return sum(xmlrpc_bytes('put', (key, value), True) + xmlrpc_bytes('get', (key,), value)
+                   for key in keys)
+
+    def binary_count(keys, value):
+        total = binary_proxy.bytes_sent + binary_proxy.bytes_received
+        binary_proxy.bytes_sent = binary_proxy.bytes_received = 0
+        return total
+
+    print("{0:>10} {1:>10} {2:>12} {3:>14}".format("value size", "protocol", "ops/s", "bytes/op"))
+    for value_size in VALUE_SIZES:
+        for name, proxy, count_bytes in (("xml-rpc", xml_proxy, xml_count),
+                                         ("binary", binary_proxy, binary_count)):
+            ops_per_second, bytes_per_op = run(proxy, value_size, count_bytes)
+            print("{0:>10} {1:>10} {2:>12.0f} {3:>14.1f}".format(
+                value_size, name, ops_per_second, bytes_per_op))
+    server.terminate()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+from __future__ import print_function
+from threading import Thread
+from timeit import default_timer
+import os, os.path, random, sys
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir))
+import FileSystem
+from benchmark_helpers import Quiet, start_server
+
+# Reads with 1 to 16 threads calling FileSystem at once, like FUSE does when it isn't single threaded,
+# every thread reading random blocks of its own file through its own handle.
+# usage: python test/benchmark_readers.py [port]
+
+READER_COUNTS = [1, 2, 4, 8, 16]
+FILE_SIZE = 1 << 20
+BLOCK_SIZE = 4096
+READS = 200 # per reader
+
+
+def reader(fs, path, fh):
+    for _ in range(READS):
+        fs.read(path, BLOCK_SIZE, random.randrange(0, FILE_SIZE, BLOCK_SIZE), fh)
+
+
+def main():
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8080
+    server = start_server(port, workers=max(READER_COUNTS))
+    FileSystem.rpc = FileSystem.ProxyPool('http://localhost:' + str(port), max(READER_COUNTS))
+    stdout, sys.stdout = sys.stdout, Quiet()
+    fs = FileSystem.FileSystem(block_size=BLOCK_SIZE)
+    paths = ['/reader_' + str(number) for number in range(max(READER_COUNTS))]
+    for path in paths:
+        fh = fs.create(path, 0644)
+        fs.write(path, os.urandom(FILE_SIZE), 0, fh)
+        fs.release(path, fh)
+    results = []
+    for count in READER_COUNTS:
+        handles = [fs.open(path, os.O_RDONLY) for path in paths[:count]]
+        threads = [Thread(target=reader, args=(fs, path, fh)) for path, fh in zip(paths, handles)]
+        start = default_timer()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = default_timer() - start
+        for path, fh in zip(paths, handles):
+            fs.release(path, fh)
+        results.append((count, count * READS / elapsed))
+    sys.stdout = stdout
+    print("{0:>8} {1:>12} {2:>10}".format("readers", "reads/s", "speedup"))
+    for count, rate in results:
+        print("{0:>8} {1:>12.0f} {2:>9.2f}x".format(count, rate, rate / results[0][1]))
+    server.terminate()
+
+
+if __name__ == "__main__":
+    main()
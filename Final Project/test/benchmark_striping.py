@@ -0,0 +1,52 @@
+from __future__ import print_function
+from timeit import default_timer
+from xmlrpclib import ServerProxy
+import os, os.path, sys
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir))
+import FileSystem
+from benchmark_helpers import Quiet, start_server
+
+# Writes and reads back a large file with its blocks striped across 1, 2 and 4 data servers.
+# usage: python test/benchmark_striping.py [first port]
+
+FILE_SIZE = 16 << 20
+READ_SIZE = 1 << 20 # bytes asked for by every read call
+DATA_SERVER_COUNTS = [1, 2, 4]
+
+
+def main():
+    first_port = int(sys.argv[1]) if len(sys.argv) > 1 else 8080
+    servers = [start_server(first_port, False)]
+    data_ports = range(first_port + 1, first_port + 1 + max(DATA_SERVER_COUNTS))
+    servers += [start_server(port, True) for port in data_ports]
+    FileSystem.rpc = ServerProxy('http://localhost:' + str(first_port))
+    content = os.urandom(FILE_SIZE)
+    results = []
+    for count in DATA_SERVER_COUNTS:
+        FileSystem.data_servers = [FileSystem.ProxyPool('http://localhost:' + str(port))
+                                   for port in data_ports[:count]]
+        FileSystem.block_pool = None
+        stdout, sys.stdout = sys.stdout, Quiet()
+        fs = FileSystem.FileSystem(block_size=64 << 10, dirty_limit=FILE_SIZE)
+        path = '/striped_' + str(count)
+        start = default_timer()
+        fh = fs.create(path, 0644)
+        fs.write(path, content, 0, fh)
+        fs.release(path, fh)
+        write_time = default_timer() - start
+        start = default_timer()
+        for offset in range(0, FILE_SIZE, READ_SIZE):
+            fs.read(path, READ_SIZE, offset, 0)
+        read_time = default_timer() - start
+        fs.unlink(path)
+        sys.stdout = stdout
+        results.append((count, FILE_SIZE / write_time / (1 << 20), FILE_SIZE / read_time / (1 << 20)))
+    print("{0:>12} {1:>14} {2:>14}".format("data servers", "write (MiB/s)", "read (MiB/s)"))
+    for count, write_speed, read_speed in results:
+        print("{0:>12} {1:>14.1f} {2:>14.1f}".format(count, write_speed, read_speed))
+    for server in servers:
+        server.terminate()
+
+
+if __name__ == "__main__":
+    main()
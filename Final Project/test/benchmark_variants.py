@@ -0,0 +1,332 @@
+from __future__ import print_function, division
+from argparse import ArgumentParser
+from collections import OrderedDict, namedtuple
+from copy import deepcopy
+from timeit import default_timer
+import json, os, os.path, platform, random, subprocess, sys, time
+TEST_DIR = os.path.dirname(os.path.realpath(__file__))
+REPO_DIR = os.path.join(TEST_DIR, os.pardir, os.pardir)
+sys.path.append(os.path.join(TEST_DIR, os.pardir))
+for variant_dir in ('Hierarchical File System', 'RPC File System', 'MongoDB File System'):
+    sys.path.append(os.path.join(REPO_DIR, variant_dir))
+from benchmark_helpers import Quiet, start_server
+try:
+    from bson.objectid import ObjectId
+except ImportError: # pymongo isn't installed, the MongoDB file system is skipped
+    ObjectId = None
+
+# Calls the operations of the four file systems directly, the way FUSE would but without the kernel:
+#   hierarchical   hierarchicalFS.Memory, everything in memory
+#   rpc            remoteHierarchicalFS.Memory, a pickled File per serial number on a Server
+#   final          FileSystem.FileSystem on a Server
+#   mongodb        RemoteDB_FS.ClientFS, on an in-memory stand-in of the MongoDB collection (needs pymongo)
+# Every variant gets a new file system (and server) and runs the scenarios in the same order, with the
+# same random offsets, --repeat times; the median of the repetitions is reported, so that the results
+# of two runs can be compared:
+#   python test/benchmark_variants.py --output before.json
+#   python test/benchmark_variants.py --compare before.json
+# usage: python test/benchmark_variants.py [--port PORT] [--scale X] [--repeat N] [--variants NAME ...]
+#        [--output FILE] [--compare FILE]
+
+CREATES = 500
+DEPTH = 32
+GETATTRS = 1000
+FILE_SIZE = 1 << 20
+CHUNK_SIZE = 64 << 10 # bytes per read/write call of the sequential scenarios
+RANDOM_IOS = 200
+IO_SIZE = 4096 # bytes per read/write call of the random scenarios
+DIR_SIZE = 1000
+SEED = 1
+
+
+InsertOneResult = namedtuple('InsertOneResult', 'inserted_id')
+UpdateResult = namedtuple('UpdateResult', 'matched_count')
+
+
+class MemoryCollection(object):
+    """ Stand-in for the pymongo collection used by FSMongoClient, holding the documents in a dict.
+        Documents are copied in and out, as they would be serialized for mongod. """
+    def __init__(self):
+        self.documents = {} # dict<_id, document>
+
+    def find(self, query):
+        if '_id' in query:
+            ids = query['_id']['$in'] if isinstance(query['_id'], dict) else [query['_id']]
+            found = [self.documents[_id] for _id in ids if _id in self.documents]
+        else:
+            found = [document for document in self.documents.values()
+                     if all(document.get(key) == value for key, value in query.items())]
+        return [deepcopy(document) for document in found]
+
+    def find_one(self, query):
+        found = self.find(query)
+        return found[0] if found else None
+
+    def insert_one(self, document):
+        document['_id'] = ObjectId() # like pymongo, sets the _id of the inserted dict
+        self.documents[document['_id']] = deepcopy(document)
+        return InsertOneResult(document['_id'])
+
+    def update_one(self, query, update): # the queries and $set keys FSMongoClient uses: _id, $size, data.<index>
+        document = self.documents.get(query['_id'])
+        if document is None or any(not isinstance(document.get(key), list) or len(document[key]) != value['$size']
+                                   for key, value in query.items() if key != '_id'):
+            return UpdateResult(0)
+        for key, value in deepcopy(update['$set']).items():
+            if '.' in key:
+                key, index = key.split('.')
+                document[key][int(index):int(index) + 1] = [value] # sets the element, or appends it
+            else:
+                document[key] = value
+        return UpdateResult(1)
+
+    def delete_one(self, query):
+        self.documents.pop(query['_id'], None)
+
+
+def hierarchical(port):
+    import hierarchicalFS
+    return hierarchicalFS.Memory(), None
+
+
+def rpc(port):
+    import remoteHierarchicalFS
+    server = start_server(port, workers=4)
+    remoteHierarchicalFS.rpc = remoteHierarchicalFS.ProxyPool('http://localhost:' + str(port))
+    return remoteHierarchicalFS.Memory(), server
+
+
+def final(port):
+    import FileSystem
+    server = start_server(port, workers=4)
+    FileSystem.rpc = FileSystem.ProxyPool('http://localhost:' + str(port))
+    return FileSystem.FileSystem(), server
+
+
+def mongodb(port):
+    if ObjectId is None:
+        raise ImportError('pymongo is not installed')
+    import DB_Cache_Services, RemoteDB_FS
+    storage = DB_Cache_Services.FileStorageManager(None, None, 1000, collection=MemoryCollection())
+    return RemoteDB_FS.ClientFS(storage), None
+
+
+VARIANTS = [('hierarchical', hierarchical), ('rpc', rpc), ('final', final), ('mongodb', mongodb)]
+
+
+# every scenario calls the file system and returns (number of operations, bytes read or written)
+
+def create_storm(fs, scale):
+    fs('mkdir', '/storm', 0755)
+    count = int(CREATES * scale)
+    for number in range(count):
+        path = '/storm/file' + str(number)
+        fs('release', path, fs('create', path, 0644))
+    return count + 1, 0
+
+
+def deep_getattr(fs, scale):
+    path = ''.join('/level' + str(level) for level in range(DEPTH))
+    calls = int(GETATTRS * scale)
+    for _ in range(calls):
+        fs('getattr', path)
+    return calls, 0
+
+
+def make_deep_path(fs, scale):
+    path = ''
+    for level in range(DEPTH):
+        path += '/level' + str(level)
+        fs('mkdir', path, 0755)
+
+
+def sequential_write(fs, scale):
+    size = int(FILE_SIZE * scale)
+    chunk = os.urandom(CHUNK_SIZE)
+    fh = fs('create', '/sequential', 0644)
+    for offset in range(0, size, CHUNK_SIZE):
+        fs('write', '/sequential', chunk, offset, fh)
+    fs('release', '/sequential', fh)
+    return len(range(0, size, CHUNK_SIZE)) + 2, size
+
+
+def sequential_read(fs, scale):
+    size, transferred = int(FILE_SIZE * scale), 0
+    fh = fs('open', '/sequential', os.O_RDONLY)
+    for offset in range(0, size, CHUNK_SIZE):
+        transferred += len(fs('read', '/sequential', CHUNK_SIZE, offset, fh))
+    fs('release', '/sequential', fh)
+    return len(range(0, size, CHUNK_SIZE)) + 2, transferred
+
+
+def random_offsets(scale): # the same offsets in every run
+    generator = random.Random(SEED)
+    return [generator.randrange(0, int(FILE_SIZE * scale) - IO_SIZE, IO_SIZE) for _ in range(int(RANDOM_IOS * scale))]
+
+
+def random_write(fs, scale):
+    block = os.urandom(IO_SIZE)
+    fh = fs('open', '/sequential', os.O_WRONLY)
+    offsets = random_offsets(scale)
+    for offset in offsets:
+        fs('write', '/sequential', block, offset, fh)
+    fs('release', '/sequential', fh)
+    return len(offsets) + 2, len(offsets) * IO_SIZE
+
+
+def random_read(fs, scale):
+    fh = fs('open', '/sequential', os.O_RDONLY)
+    offsets, transferred = random_offsets(scale), 0
+    for offset in offsets:
+        transferred += len(fs('read', '/sequential', IO_SIZE, offset, fh))
+    fs('release', '/sequential', fh)
+    return len(offsets) + 2, transferred
+
+
+def make_large_dir(fs, scale):
+    fs('mkdir', '/large', 0755)
+    for number in range(int(DIR_SIZE * scale)):
+        path = '/large/file' + str(number)
+        fs('release', path, fs('create', path, 0644))
+
+
+def list_large_dir(fs, scale): # ls -l
+    names = [entry if isinstance(entry, basestring) else entry[0] for entry in fs('readdir', '/large', 0)]
+    for name in names[2:]: # skip . and ..
+        fs('getattr', '/large/' + name)
+    return len(names) - 1, 0
+
+
+def remove_large_dir(fs, scale): # rm -r
+    names = [entry if isinstance(entry, basestring) else entry[0] for entry in fs('readdir', '/large', 0)]
+    for name in names[2:]:
+        fs('unlink', '/large/' + name)
+    fs('rmdir', '/large')
+    return len(names) - 1, 0
+
+
+# (name, setup, scenario): only the scenario is timed
+SCENARIOS = [
+    ('create storm', None, create_storm),
+    ('deep getattr', make_deep_path, deep_getattr),
+    ('sequential write', None, sequential_write),
+    ('sequential read', None, sequential_read),
+    ('random write', None, random_write),
+    ('random read', None, random_read),
+    ('large dir ls -l', make_large_dir, list_large_dir),
+    ('large dir rm -r', None, remove_large_dir),
+]
+
+
+def round_trips(fs): # the requests sent to the server so far, see OperationStats.py
+    return sum(stats['round_trips'] for stats in fs.stats().values())
+
+
+def run_variant(name, make, port, scale):
+    """ Runs every scenario on a new file system of a variant, returns the list of results. A
+        scenario that fails gets a result with its error, the following ones still run. """
+    try:
+        fs, server = make(port)
+    except Exception as error: # a single result for the variant, without scenario
+        return [dict(variant=name, scenario=None, error=repr(error))]
+    results = []
+    try:
+        for scenario, setup, function in SCENARIOS:
+            result = dict(variant=name, scenario=scenario)
+            try:
+                if setup:
+                    setup(fs, scale)
+                before, start = round_trips(fs), default_timer()
+                operations, transferred = function(fs, scale)
+                seconds = default_timer() - start
+                result.update(operations=operations, seconds=seconds, ops_per_second=operations / seconds,
+                              mib_per_second=transferred / seconds / (1 << 20),
+                              round_trips_per_op=(round_trips(fs) - before) / operations)
+            except Exception as error:
+                result.update(error=repr(error))
+            results.append(result)
+    finally:
+        if server:
+            server.terminate()
+    return results
+
+
+def median_results(runs):
+    """ Merges the results of several runs of a variant: the median result of every scenario by
+        ops_per_second, with the number of runs that succeeded and the slowest and fastest. """
+    attempts = OrderedDict()
+    for results in runs:
+        for result in results:
+            attempts.setdefault((result['variant'], result['scenario']), []).append(result)
+    merged = []
+    for results in attempts.values():
+        good = sorted((result for result in results if 'error' not in result),
+                      key=lambda result: result['ops_per_second'])
+        if not good: # report the first error
+            merged.append(results[0])
+            continue
+        result = dict(good[len(good) // 2])
+        result.update(runs=len(good), min_ops_per_second=good[0]['ops_per_second'],
+                      max_ops_per_second=good[-1]['ops_per_second'])
+        merged.append(result)
+    return merged
+
+
+def environment(scale, repeat):
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=TEST_DIR).strip()
+    except Exception:
+        commit = None
+    return dict(time=time.time(), commit=commit, python=platform.python_version(),
+                machine=platform.platform(), scale=scale, repeat=repeat)
+
+
+def print_results(results, previous=None):
+    baseline = dict(((result['variant'], result['scenario']), result.get('ops_per_second'))
+                    for result in previous or [])
+    print("{0:<13} {1:<17} {2:>10} {3:>8} {4:>12}{5}".format(
+        "variant", "scenario", "ops/s", "MiB/s", "round trips", " {0:>10}".format("vs before") if previous else ""))
+    for result in results:
+        if 'error' in result:
+            print("{0:<13} {1:<17} {2}".format(result['variant'], result['scenario'] or '-', result['error'][:60]))
+            continue
+        change = ""
+        if previous:
+            before = baseline.get((result['variant'], result['scenario']))
+            change = " {0:>9.2f}x".format(result['ops_per_second'] / before) if before else " {0:>10}".format("-")
+        print("{0:<13} {1:<17} {2:>10.1f} {3:>8.2f} {4:>12.2f}{5}".format(
+            result['variant'], result['scenario'], result['ops_per_second'], result['mib_per_second'],
+            result['round_trips_per_op'], change))
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--port', type=int, default=8080, help='first port of the servers started')
+    parser.add_argument('--scale', type=float, default=1.0, help='multiplies the number of files, calls and bytes')
+    parser.add_argument('--repeat', type=int, default=3, help='runs of every variant, the median is reported')
+    parser.add_argument('--variants', nargs='+', choices=[name for name, _ in VARIANTS],
+                        default=[name for name, _ in VARIANTS])
+    parser.add_argument('--output', metavar='FILE', help='write the results to FILE as JSON')
+    parser.add_argument('--compare', metavar='FILE', help='compare with the results of an earlier --output')
+    args = parser.parse_args()
+    results = []
+    stdout, sys.stdout = sys.stdout, Quiet()
+    try:
+        for number, (name, make) in enumerate(VARIANTS):
+            if name in args.variants:
+                runs = [run_variant(name, make, args.port + number, args.scale) for _ in range(args.repeat)]
+                results += median_results(runs)
+    finally:
+        sys.stdout = stdout
+    previous = None
+    if args.compare:
+        with open(args.compare) as previous_file:
+            previous = json.load(previous_file)['results']
+    print_results(results, previous)
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(dict(environment=environment(args.scale, args.repeat), results=results), output, indent=1, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+from __future__ import print_function
+from errno import ENOENT
+from multiprocessing import Pipe, Process
+import os.path, sys
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir))
+from benchmark_helpers import Quiet, start_server
+
+# Two mounts of FileSystem on one server, A and B, each in its own process with the caches of a profile.
+# A creates and renames files and directories, and after every step B looks the paths up: a path that
+# doesn't exist is ENOENT. With the conservative profile B must agree with A at once, with the others it
+# may lag until its dentry and attribute caches expire. Exits with 1 if the conservative mounts disagree.
+# usage: python test/check_coherence.py [port]
+
+# (what A does, then the paths B looks up)
+STEPS = [
+    ([], ['/file', '/dir/file']), # B remembers that they don't exist
+    ([('create', '/file', 0644)], ['/file']),
+    ([('rename', '/file', '/renamed')], ['/file', '/renamed']),
+    ([('mkdir', '/dir', 0755), ('create', '/dir/file', 0644)], ['/dir/file']),
+    ([('rename', '/dir', '/moved')], ['/dir/file', '/moved/file']),
+    ([('unlink', '/renamed')], ['/renamed']),
+]
+PROFILE_NAMES = ['conservative', 'read-mostly', 'single-writer']
+
+
+def mount(port, profile, connection): # serves the calls sent over connection until it gets None
+    sys.stdout = Quiet()
+    import FileSystem
+    FileSystem.apply_profile(profile)
+    FileSystem.rpc = FileSystem.ProxyPool('http://localhost:' + str(port), 2)
+    fs = FileSystem.FileSystem()
+    for call in iter(connection.recv, None):
+        try:
+            result = fs(*call)
+            if call[0] == 'create':
+                fs('release', call[1], result)
+            connection.send('exists' if call[0] == 'getattr' else 'ok')
+        except OSError as error:
+            connection.send('ENOENT' if error.errno == ENOENT else os.strerror(error.errno))
+
+
+def start_mount(port, profile):
+    connection, child_connection = Pipe()
+    process = Process(target=mount, args=(port, profile, child_connection))
+    process.daemon = True
+    process.start()
+    return process, connection
+
+
+def call(connection, *args):
+    connection.send(args)
+    return connection.recv()
+
+
+def check(port, profile): # returns the lookups of B that disagree with A, as (step, path, A, B)
+    server = start_server(port)
+    (process_a, a), (process_b, b) = start_mount(port, profile), start_mount(port, profile)
+    disagreements = []
+    for number, (calls, paths) in enumerate(STEPS):
+        for args in calls:
+            call(a, *args)
+        for path in paths:
+            seen_by_a, seen_by_b = call(a, 'getattr', path), call(b, 'getattr', path)
+            if seen_by_a != seen_by_b:
+                disagreements.append((number, path, seen_by_a, seen_by_b))
+    for connection, process in ((a, process_a), (b, process_b)):
+        connection.send(None)
+        process.join()
+    server.terminate()
+    server.join()
+    return disagreements
+
+
+def main():
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8080
+    coherent = True
+    for profile in PROFILE_NAMES:
+        disagreements = check(port, profile)
+        print("{0:<14} {1}".format(profile, 'A and B agree' if not disagreements else
+                                   '{0} stale lookups in B (until its caches expire)'.format(len(disagreements))))
+        for number, path, seen_by_a, seen_by_b in disagreements:
+            print("    step {0}: {1} {2} for A, {3} for B".format(number, path, seen_by_a, seen_by_b))
+        coherent &= profile != 'conservative' or not disagreements
+    sys.exit(0 if coherent else 1)
+
+
+if __name__ == "__main__":
+    main()
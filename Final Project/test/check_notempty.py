@@ -0,0 +1,52 @@
+from __future__ import print_function
+from errno import ENOTEMPTY
+from xmlrpclib import ServerProxy
+import os, os.path, sys
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir))
+import FileSystem
+from benchmark_helpers import Quiet, start_server
+
+# Removing a directory that still has entries, with rmdir or by renaming another directory over it,
+# must fail with ENOTEMPTY and leave the directory and its files alone; once it is empty it goes.
+# Exits with 1 if a check fails.
+# usage: python test/check_notempty.py [port]
+
+
+def errno_of(call, *args): # the errno call fails with, 0 if it succeeds
+    try:
+        call(*args)
+        return 0
+    except OSError as error:
+        return error.errno
+
+
+def main():
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8080
+    server = start_server(port)
+    FileSystem.rpc = ServerProxy('http://localhost:' + str(port))
+    stdout, sys.stdout = sys.stdout, Quiet()
+    fs = FileSystem.FileSystem()
+    fs.mkdir('/full', 0755)
+    fs.mkdir('/other', 0755)
+    fs.release('/full/file', fs.create('/full/file', 0644))
+    checks = [
+        ('rmdir of a non-empty directory', errno_of(fs.rmdir, '/full'), ENOTEMPTY),
+        ('rename over a non-empty directory', errno_of(fs.rename, '/other', '/full'), ENOTEMPTY),
+        ('its file is still there', errno_of(fs.getattr, '/full/file'), 0),
+        ('the renamed directory is still there', errno_of(fs.getattr, '/other'), 0),
+        ('unlink of the file', errno_of(fs.unlink, '/full/file'), 0),
+        ('rename over the empty directory', errno_of(fs.rename, '/other', '/full'), 0),
+        ('rmdir of the empty directory', errno_of(fs.rmdir, '/full'), 0),
+    ]
+    sys.stdout = stdout
+    failed = False
+    for name, got, expected in checks:
+        print("{0:<40} {1}".format(name, 'ok' if got == expected else 'expected {0}, got {1}'.format(
+            os.strerror(expected) if expected else 'success', os.strerror(got) if got else 'success')))
+        failed |= got != expected
+    server.terminate()
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -12,6 +12,9 @@ def show_content(server):
     for key,val in content.items():
         if val == "CORRUPT!":
             print("("+str(key)+", "+"CORRUPT!"+")")
+        elif (key.split(":")[-1].isdigit() and ":" in key) or (key.startswith("#") and ":" not in key):
+            # a block of a regular file and a deduplicated block are stored raw
+            print("("+str(key)+", "+repr(val)+")")
         else:
             print("("+str(key)+", "+str(pickle.loads(val))+")")
     print("~~~~~~~~~~~ End content ~~~~~~~~~~~")
@@ -20,7 +23,7 @@ def show_content(server):
 def main():
     rpc = ServerProxy('http://localhost:'+sys.argv[1])
     print("Referencing server on port 8080...")
-    commands = ["show","get <key number>","corrupt < key number>","terminate","quit"]
+    commands = ["show","get <key number>","corrupt < key number>","terminate","quit","expiry","dedup"]
     while True:
         print("Commands:")
         for com in commands: print(" " + com)
@@ -45,6 +48,12 @@ def main():
                 rpc.terminate()
             elif choice == 4: # quit
                 break
+            elif choice == 5: # expiry
+                for name, value in sorted(rpc.expiry_stats().items()):
+                    print(" " + name + ": " + str(value))
+            elif choice == 6: # dedup
+                for name, value in sorted(rpc.dedup_stats().items()):
+                    print(" " + name + ": " + str(value))
             else: raise ValueError
         except socket.error:
             print("Server is down.")
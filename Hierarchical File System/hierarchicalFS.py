@@ -1,57 +1,574 @@
 #!/usr/bin/env python
 import os
 import logging
-
-from collections import defaultdict
-from errno import ENOENT
+import mmap
+import struct
+import sys
+import cPickle as pickle
+
+from argparse import ArgumentParser
+from collections import defaultdict, OrderedDict
+from errno import EEXIST, EISDIR, ENOENT, ENOSPC, ENOTDIR, ENOTEMPTY, EPERM
+from hashlib import sha1
 from stat import S_IFDIR, S_IFLNK, S_IFREG
-from sys import argv, exit
-from time import time
+from sys import argv
+from threading import Lock, RLock, Thread
+from time import sleep, time
 
-from fuse import FUSE, FuseOSError, Operations, LoggingMixIn
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir, 'Final Project')) # OperationStats
+from fuse import FuseOSError, Operations, LoggingMixIn
+from OperationStats import StatsFUSE, StatsMixIn
 
 
 if not hasattr(__builtins__, 'bytes'):
     bytes = str
 
+CHUNK_SIZE = 64 << 10 # the content of regular files is kept in chunks of this size, see Content
+ROOT_INO = 1 # the inode number of the root directory, the others follow it
+STATFS_BLOCK = 4096 # the block size statfs counts the space in
+SPILL_GROWTH = 64 # chunks the spill file grows by at least
+TRAILER = struct.Struct('!QQ8s') # the end of a checkpoint: table offset, table length, magic
+MAGIC = 'HFSIMAGE'
+
 
 class File(object):
-    """ Represents a file (regular file, directory, or soft link) on the file system.
+    """ Represents an inode (regular file, directory, or soft link) of the file system. A file
+        doesn't know its path: it is reached through the names the directories give to its inode
+        number, and a regular file can have several of them (hard links).
         PROPERTIES OF THE OBJECT:
-        self.absolute_path: the absolute path of the file.
-            The following properties depend on the absolute_path and are read-only
-            self.name: the name of the file (str)
-            self.context_name: the name of the directory that contains the file (str)
-
         self.properties: contains all the attr and xattr the OS uses to categorize the files,
-            this includes their type too (dict).
+            this includes their type and inode number (st_ino) too (dict).
 
         self.data:
-            Directory file: self.data is a dict <name,File>
-            Regular file: self.data contains the content of the file as str
+            Directory file: self.data is a dict <name,inode number>
+            Regular file: self.data contains the content of the file as a Content
             Link file: self.data contains a FULL path (from the OS root) stored as a str
     """
-    def __init__(self,absolute_path,properties,data):
-        self.absolute_path = absolute_path
+    __slots__ = ('properties', 'data') # there is one per inode, keep them small
+
+    def __init__(self,properties,data):
         self.properties = properties
         self.data = data
 
     def get_type(self): # check if the file is a directory or a regular file
         return self.properties['st_mode'] & 0770000
 
-    name = property(lambda self: os.path.basename(self.absolute_path))
-    context_name = property(lambda self: os.path.dirname(self.absolute_path))
+    ino = property(lambda self: self.properties['st_ino'])
+
+
+class Spilled(object):
+    """ Stands in Content.chunks for a chunk the Pager moved to the spill file. """
+    __slots__ = ('slot', 'length')
 
+    def __init__(self, slot, length):
+        self.slot = slot
+        self.length = length
 
-class Memory(LoggingMixIn, Operations):
-    def __init__(self):
+
+class Stored(object):
+    """ Stands in Content.chunks for a chunk still in the checkpoint the file system was restored
+        from, at offset of the mmap of the checkpoint (Pager.image). The chunks that were Interned
+        share one extent of the checkpoint, refs is their number: a shared extent is never cut,
+        a truncate copies it first. """
+    __slots__ = ('offset', 'length', 'refs')
+
+    def __init__(self, offset, length):
+        self.offset = offset
+        self.length = length
+        self.refs = 1
+
+
+class Interned(object):
+    """ Stands in Content.chunks for a chunk whose bytes are kept once for all the chunks holding
+        the same bytes (see Pager.intern), refs is their number. It is never changed, a write
+        to one of the chunks copies it first. Its bytes are in data, or in slot of the spill
+        file once the Pager spilled it (data is None then). """
+    __slots__ = ('digest', 'data', 'length', 'refs', 'slot')
+
+    def __init__(self, digest, data):
+        self.digest = digest
+        self.data = data
+        self.length = len(data)
+        self.refs = 0
+        self.slot = None
+
+
+class Pager(object):
+    """ Accounts for the bytes held by the chunks of all the Content of a file system and, when
+        it is given a budget, keeps them within it: once the chunks in memory take more than
+        budget bytes, the least recently used ones are moved to the spill file (mapped in memory
+        with mmap, so the OS pages them out) and they are read back the next time they are used.
+        Without a spill file, a write that would go over the budget fails with ENOSPC.
+        The chunks of a restored checkpoint stay Stored in it until they are written to.
+        With dedup, the chunks written to a file are interned when it is closed: the chunks with
+        the same bytes (same sha1) share one Interned copy, counted once in self.resident (or
+        self.spilled) and spilled like the other chunks, under the key (Interned, None) of
+        self.recency.
+        OBJECT ATTRIBUTES:
+        self.resident: bytes of the chunks in memory
+        self.spilled: bytes of the chunks in the spill file
+        self.stored: bytes of the chunks in the checkpoint mapped in self.image, a shared extent once
+        self.recency: OrderedDict<(Content, chunk index) or (Interned, None), None> of the chunks in
+            memory, least recently used first (only kept when there is a budget)
+        self.spill_map: the mmap of the spill file, made by the first spill, cut in CHUNK_SIZE slots
+        self.free_slots: list of the slots of the spill file that hold no chunk
+        self.interned: dict<sha1 digest, Interned>, and self.referenced: the bytes of all the
+            chunks they stand for
+        self.pins: the number of checkpoints being written, which read the spill file: the slots
+            freed meanwhile are kept in self.pinned_slots instead of being reused
+    """
+    def __init__(self, budget=None, spill_path=None, dedup=False):
+        assert budget is None or budget >= 2 * CHUNK_SIZE, 'the budget has to hold a couple of chunks'
+        self.budget = budget
+        self.spill_path = spill_path
+        self.dedup = dedup
+        self.interned = {}
+        self.referenced = 0
+        self.resident = self.spilled = self.stored = 0
+        self.recency = OrderedDict()
+        self.spill_file = self.spill_map = None
+        self.free_slots = []
+        self.pins = 0
+        self.pinned_slots = []
+        self.image = None
+
+    def used(self):
+        return self.resident + self.spilled + self.stored
+
+    def capacity(self): # the bytes the chunks can take: the budget (or the RAM) and the space of the spill file
+        if self.budget is None:
+            return os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE') + self.stored
+        if self.spill_path is None:
+            return self.budget + self.stored
+        disk = os.statvfs(os.path.dirname(os.path.abspath(self.spill_path)))
+        return self.budget + self.stored + (len(self.spill_map) if self.spill_map else 0) + \
+               disk.f_bavail * disk.f_frsize
+
+    def reserve(self, growth): # called before the chunks of a write grow by growth bytes
+        if self.budget is not None and self.spill_path is None and self.resident + growth > self.budget:
+            raise FuseOSError(ENOSPC)
+
+    def touch(self, content, index): # chunk index of content was just used
+        if self.budget is not None:
+            key = (content, index)
+            self.recency.pop(key, None)
+            self.recency[key] = None
+
+    def resize(self, content, index, delta): # chunk index of content, in memory, grew by delta bytes
+        self.resident += delta
+        self.touch(content, index)
+        if self.budget is not None and self.spill_path is not None:
+            while self.resident > self.budget and len(self.recency) > 1:
+                self.evict()
+
+    def load(self, content, index): # returns chunk index of content in memory, to be written to
+        chunk = content.chunks[index]
+        if isinstance(chunk, (Spilled, Stored, Interned)):
+            loaded = content.chunks[index] = bytearray(self.peek(chunk))
+            self.release_extent(chunk)
+            self.resize(content, index, chunk.length)
+            return loaded
+        if chunk is not None:
+            self.touch(content, index)
+        return chunk
+
+    def peek(self, chunk, start=0, length=CHUNK_SIZE): # the bytes of a chunk from start, without loading it
+        end = start + length
+        if isinstance(chunk, Spilled):
+            base = chunk.slot * CHUNK_SIZE
+            return self.spill_map[base + start:base + min(end, chunk.length)]
+        if isinstance(chunk, Stored):
+            return self.image[chunk.offset + start:chunk.offset + min(end, chunk.length)]
+        if isinstance(chunk, Interned):
+            data = chunk.data
+            if data is None: # spilled, see evict
+                base = chunk.slot * CHUNK_SIZE
+                return self.spill_map[base + start:base + min(end, chunk.length)]
+            return data[start:end]
+        return bytes(chunk[start:end])
+
+    def release_extent(self, chunk): # a Spilled, Stored or Interned chunk doesn't need its bytes anymore
+        if isinstance(chunk, Spilled):
+            self.free_slot(chunk.slot)
+            self.spilled -= chunk.length
+        elif isinstance(chunk, Interned):
+            chunk.refs -= 1
+            self.referenced -= chunk.length
+            if not chunk.refs:
+                del self.interned[chunk.digest]
+                if chunk.data is None:
+                    self.free_slot(chunk.slot)
+                    self.spilled -= chunk.length
+                else:
+                    self.resident -= chunk.length
+                    self.recency.pop((chunk, None), None)
+        else:
+            chunk.refs -= 1
+            if not chunk.refs:
+                self.stored -= chunk.length
+
+    def truncate_extent(self, chunk, length): # a Spilled or Stored chunk only keeps length bytes
+        if isinstance(chunk, Spilled):
+            self.spilled -= chunk.length - length
+        else:
+            self.stored -= chunk.length - length
+        chunk.length = length
+
+    def release(self, content, index): # chunk index of content is dropped
+        chunk = content.chunks[index]
+        if isinstance(chunk, (Spilled, Stored, Interned)):
+            self.release_extent(chunk)
+        elif chunk is not None:
+            self.resident -= len(chunk)
+            self.recency.pop((content, index), None)
+
+    def intern(self, content): # share the chunks content changed with the chunks holding the same bytes
+        for index in content.changed:
+            chunk = content.chunks[index] if index < len(content.chunks) else None
+            if not isinstance(chunk, bytearray) or not chunk:
+                continue
+            digest = sha1(chunk).digest()
+            interned = self.interned.get(digest)
+            if interned is None: # the first copy, it keeps its place in self.resident
+                interned = self.interned[digest] = Interned(digest, bytes(chunk))
+                self.touch(interned, None)
+            else:
+                self.resident -= len(chunk)
+            interned.refs += 1
+            self.referenced += len(chunk)
+            self.recency.pop((content, index), None)
+            content.shared.discard(index) # a checkpoint being written still has the bytearray
+            content.chunks[index] = interned
+        content.changed.clear()
+
+    def dedup_stats(self):
+        """ Returns dict(chunks, stored_bytes, referenced_bytes, saved_bytes, ratio) of the
+            Interned chunks. """
+        stored = sum(interned.length for interned in self.interned.values())
+        return dict(chunks=len(self.interned), stored_bytes=stored, referenced_bytes=self.referenced,
+                    saved_bytes=self.referenced - stored, ratio=self.referenced / float(stored or 1))
+
+    def pin(self): # a checkpoint starts reading the spill file
+        self.pins += 1
+
+    def unpin(self):
+        self.pins -= 1
+        if not self.pins:
+            self.free_slots.extend(self.pinned_slots)
+            self.pinned_slots = []
+
+    def evict(self): # move the least recently used chunk to the spill file
+        (content, index), _ = self.recency.popitem(last=False)
+        if isinstance(content, Interned): # all the chunks standing for it read it from the spill file
+            interned = content
+            start = self.allocate_slot() * CHUNK_SIZE
+            self.spill_map[start:start + interned.length] = interned.data
+            interned.slot = start // CHUNK_SIZE # before dropping data, a checkpoint may be peeking at it
+            interned.data = None
+            self.resident -= interned.length
+            self.spilled += interned.length
+            return
+        content.shared.discard(index) # the bytes are copied to the spill file, not changed
+        chunk = content.chunks[index]
+        if chunk:
+            start = self.allocate_slot() * CHUNK_SIZE
+            self.spill_map[start:start + len(chunk)] = str(chunk)
+            content.chunks[index] = Spilled(start // CHUNK_SIZE, len(chunk))
+            self.spilled += len(chunk)
+        else: # nothing to keep, an empty chunk reads as a hole
+            content.chunks[index] = None
+        self.resident -= len(chunk)
+
+    def free_slot(self, slot):
+        (self.pinned_slots if self.pins else self.free_slots).append(slot)
+
+    def allocate_slot(self):
+        if not self.free_slots:
+            slots = len(self.spill_map) // CHUNK_SIZE if self.spill_map else 0
+            growth = max(SPILL_GROWTH, slots) # double the file, so growing it costs O(1) per chunk
+            try:
+                if self.spill_map is None:
+                    self.spill_file = open(self.spill_path, 'w+b')
+                    self.spill_file.truncate(growth * CHUNK_SIZE)
+                    self.spill_map = mmap.mmap(self.spill_file.fileno(), growth * CHUNK_SIZE)
+                else:
+                    self.spill_map.resize((slots + growth) * CHUNK_SIZE)
+            except EnvironmentError:
+                raise FuseOSError(ENOSPC)
+            self.free_slots.extend(range(slots + growth - 1, slots - 1, -1))
+        return self.free_slots.pop()
+
+    def close(self): # the spill file only lives as long as the mount
+        if self.spill_map is not None:
+            self.spill_map.close()
+            self.spill_file.close()
+            os.remove(self.spill_path)
+            self.spill_file = self.spill_map = None
+
+
+class Content(object):
+    """ The content of a regular file, kept in a list of chunks of up to CHUNK_SIZE bytes
+        (bytearrays) so that writes and truncates only touch the chunks they cover instead of
+        copying the whole file. A chunk holds the bytes written to it so far, the bytes past its
+        end (up to the size of the file) and the chunks that were never written (None) are holes,
+        read back as zeros. The pager accounts for the chunks and can move the cold ones to its
+        spill file (they are then Spilled in self.chunks), they are read back when written to.
+        The chunks in self.shared are also referenced by a checkpoint being written, they are
+        copied before they are changed. self.changed holds the chunks written since the pager
+        last interned them, with dedup.
+    """
+    def __init__(self, pager):
+        self.pager = pager
+        self.chunks = []
+        self.size = 0
+        self.shared = set()
+        self.changed = set()
+
+    def __len__(self):
+        return self.size
+
+    def read(self, offset, size):
+        end, parts = min(offset + size, self.size), []
+        while offset < end:
+            index, start = divmod(offset, CHUNK_SIZE)
+            length = min(CHUNK_SIZE - start, end - offset)
+            chunk = self.chunks[index] if index < len(self.chunks) else None
+            if isinstance(chunk, bytearray):
+                self.pager.touch(self, index)
+            elif isinstance(chunk, Interned) and chunk.data is not None:
+                self.pager.touch(chunk, None)
+            part = self.pager.peek(chunk, start, length) if chunk is not None else bytes()
+            parts.append(part + '\0' * (length - len(part)))
+            offset += length
+        return ''.join(parts)
+
+    def write(self, offset, data):
+        self.pager.reserve(self.growth(offset, len(data)))
+        position = 0
+        while position < len(data):
+            index, start = divmod(offset + position, CHUNK_SIZE)
+            length = min(CHUNK_SIZE - start, len(data) - position)
+            if index >= len(self.chunks):
+                self.chunks.extend([None] * (index + 1 - len(self.chunks)))
+            chunk = self.pager.load(self, index)
+            if chunk is None:
+                chunk = self.chunks[index] = bytearray()
+            elif index in self.shared:
+                chunk = self.own(index)
+            before = len(chunk)
+            if len(chunk) < start: # fill the hole before the write
+                chunk.extend('\0' * (start - len(chunk)))
+            chunk[start:start + length] = data[position:position + length]
+            self.pager.resize(self, index, len(chunk) - before)
+            if self.pager.dedup:
+                self.changed.add(index)
+            position += length
+        self.size = max(self.size, offset + len(data))
+
+    def own(self, index): # copy the chunk a checkpoint references, so it can be changed
+        self.shared.discard(index)
+        chunk = self.chunks[index] = bytearray(self.chunks[index])
+        return chunk
+
+    def growth(self, offset, length): # the bytes the chunks grow by when length bytes are written at offset
+        growth, end = 0, offset + length
+        while offset < end:
+            index, start = divmod(offset, CHUNK_SIZE)
+            written = min(CHUNK_SIZE - start, end - offset)
+            chunk = self.chunks[index] if index < len(self.chunks) else None
+            held = chunk.length if isinstance(chunk, (Spilled, Stored, Interned)) else len(chunk or '')
+            growth += max(0, start + written - held)
+            offset += written
+        return growth
+
+    def truncate(self, length):
+        if length < self.size: # drop the bytes past length, so growing the file again reads zeros
+            kept = (length + CHUNK_SIZE - 1) // CHUNK_SIZE # the chunks that still hold some of the file
+            for dropped in range(kept, len(self.chunks)):
+                self.pager.release(self, dropped)
+                self.shared.discard(dropped)
+                self.changed.discard(dropped)
+            del self.chunks[kept:]
+            index, end = kept - 1, length - (kept - 1) * CHUNK_SIZE # the last chunk keeps end bytes
+            if 0 <= index < len(self.chunks):
+                chunk = self.chunks[index]
+                shared = isinstance(chunk, Interned) or isinstance(chunk, Stored) and chunk.refs > 1
+                if shared and chunk.length > end: # cut a copy of it
+                    chunk = self.pager.load(self, index)
+                if isinstance(chunk, (Spilled, Stored)):
+                    if chunk.length > end: # the slot or the checkpoint keeps the rest
+                        self.pager.truncate_extent(chunk, end)
+                elif isinstance(chunk, bytearray) and len(chunk) > end:
+                    if index in self.shared:
+                        chunk = self.own(index)
+                    self.pager.resize(self, index, end - len(chunk))
+                    del chunk[end:]
+                    if self.pager.dedup:
+                        self.changed.add(index)
+        self.size = length
+
+
+class Memory(StatsMixIn, LoggingMixIn, Operations):
+    """ The file system is a flat table of inodes, the directories map names to inode numbers.
+        A path is resolved from the root once, the inode it resolves to is then kept in an index
+        of paths, so getattr and the other operations on the same path don't walk the tree again.
+        The operations that remove or move a name (unlink, rmdir, rename) bump a generation
+        number instead of looking for the paths they affect: an entry of the index made in an
+        older generation is resolved again. So renaming a directory doesn't depend on the size
+        of the subtree it carries.
+        The operations run one at a time (self.lock). A checkpoint takes a consistent cut of the
+        inodes under the lock, then writes it while the operations go on: the chunks of the
+        content it refers to are copied on write (Content.shared) and the slots of the spill
+        file it reads aren't reused until it is done (Pager.pin). A checkpoint is a file of:
+            the content: the chunks one after the other
+            the table: a pickled list of (properties, data) for every inode, where the data of a
+                regular file is (size, list of (offset, length) of its chunks or None for a hole)
+            the trailer: the offset and the length of the table, and MAGIC
+        It is restored through an mmap: the chunks are only read when they are used.
+        OBJECT ATTRIBUTES:
+        self.inodes: dict<inode number, File>
+        self.paths: dict<path, (inode number, generation)>, the index of the resolved paths
+        self.generation: bumped by every operation that makes some path of the index wrong
+        self.pager: the Pager of the content of all the regular files, see memory_budget,
+            spill_path and dedup (the chunks of a file are interned when it is released) in Pager
+        self.checkpoint_path: the checkpoint restored when the file system is made (if it exists)
+            and written when it is unmounted, and every checkpoint_interval seconds if given
+    """
+    def __init__(self, memory_budget=None, spill_path=None, checkpoint_path=None, checkpoint_interval=None,
+                 dedup=False):
+        StatsMixIn.__init__(self) # see /.fsstats in the mount
+        self.pager = Pager(memory_budget, spill_path, dedup)
+        self.lock = RLock()
+        self.checkpoint_lock = Lock() # one checkpoint at a time
+        self.checkpoint_path = checkpoint_path
+        self.checkpoint_interval = checkpoint_interval
         self.fd = 0
-        now = time()
-        root_properties = dict(st_mode=(S_IFDIR | 0755), st_ctime=now,
-                               st_mtime=now, st_atime=now, st_nlink=2)
-        self.root = File('/', root_properties, {})
+        self.next_ino = ROOT_INO
+        self.inodes = {}
+        self.paths = {}
+        self.generation = 0
+        if checkpoint_path and os.path.exists(checkpoint_path):
+            self.restore(checkpoint_path)
+        else:
+            now = time()
+            root_properties = dict(st_mode=(S_IFDIR | 0755), st_ctime=now,
+                                   st_mtime=now, st_atime=now, st_nlink=2)
+            self.root = self.allocate(root_properties, {})
+
+    def __call__(self, op, path, *args):
+        if op == 'destroy': # takes the lock when it needs it, a periodic checkpoint may be waiting for it
+            return super(Memory, self).__call__(op, path, *args)
+        with self.lock: # FUSE calls from several threads
+            return super(Memory, self).__call__(op, path, *args)
+
+    def allocate(self, properties, data): # add a new inode to the table and return it
+        properties['st_ino'] = self.next_ino
+        self.next_ino += 1
+        file = self.inodes[properties['st_ino']] = File(properties, data)
+        return file
+
+    def checkpoint(self, path):
+        """ Writes the file system to path (through path.tmp, renamed once complete), the
+            operations can go on meanwhile, see the class docstring. """
+        with self.checkpoint_lock:
+            with self.lock:
+                table, contents = self.cut()
+            try:
+                self.write_checkpoint(path, table)
+            finally:
+                with self.lock:
+                    for content in contents:
+                        content.shared.clear()
+                    self.pager.unpin()
+
+    def cut(self): # returns the (properties, data) of all the inodes and the Content they share chunks with
+        table, contents = [], []
+        for file in self.inodes.values():
+            properties = dict(file.properties)
+            if 'attrs' in properties:
+                properties['attrs'] = dict(properties['attrs'])
+            data = file.data
+            if file.get_type() == S_IFDIR:
+                data = dict(data)
+            elif file.get_type() == S_IFREG:
+                data.shared.update(index for index, chunk in enumerate(data.chunks) if isinstance(chunk, bytearray))
+                contents.append(data)
+                data = (data.size, [Spilled(chunk.slot, chunk.length) if isinstance(chunk, Spilled) else
+                                    Stored(chunk.offset, chunk.length) if isinstance(chunk, Stored) else chunk
+                                    for chunk in data.chunks])
+            table.append((properties, data))
+        self.pager.pin()
+        return table, contents
+
+    def write_checkpoint(self, path, table):
+        offset = 0
+        with open(path + '.tmp', 'wb') as checkpoint:
+            entries = []
+            written = {} # dict<digest or offset, (offset, length)> of the Interned and Stored chunks, written once
+            for properties, data in table:
+                if properties['st_mode'] & 0770000 == S_IFREG:
+                    size, chunks = data
+                    extents = []
+                    for chunk in chunks:
+                        if chunk is None:
+                            extents.append(None)
+                            continue
+                        if isinstance(chunk, (Interned, Stored)): # several chunks may stand for the same bytes
+                            key = chunk.digest if isinstance(chunk, Interned) else chunk.offset
+                            if key in written:
+                                extents.append(written[key])
+                                continue
+                            written[key] = (offset, chunk.length)
+                        chunk = chunk if isinstance(chunk, bytearray) else self.pager.peek(chunk)
+                        checkpoint.write(chunk)
+                        extents.append((offset, len(chunk)))
+                        offset += len(chunk)
+                    data = (size, extents)
+                entries.append((properties, data))
+            table = pickle.dumps(entries, pickle.HIGHEST_PROTOCOL)
+            checkpoint.write(table)
+            checkpoint.write(TRAILER.pack(offset, len(table), MAGIC))
+            checkpoint.flush()
+            os.fsync(checkpoint.fileno())
+        os.rename(path + '.tmp', path)
+
+    def restore(self, path): # load a checkpoint into a new file system, its content stays in the file
+        with open(path, 'rb') as checkpoint:
+            image = mmap.mmap(checkpoint.fileno(), 0, access=mmap.ACCESS_READ)
+        table_offset, table_length, magic = TRAILER.unpack(image[-TRAILER.size:])
+        if magic != MAGIC:
+            raise ValueError('{0} is not a checkpoint'.format(path))
+        self.pager.image = image
+        stored = {} # dict<offset, Stored>, the extents written once for several chunks are shared again
+        for properties, data in pickle.loads(image[table_offset:table_offset + table_length]):
+            if properties['st_mode'] & 0770000 == S_IFREG:
+                size, extents = data
+                data = Content(self.pager)
+                data.size = size
+                for extent in extents:
+                    chunk = stored.get(extent[0]) if extent else None
+                    if chunk is not None:
+                        chunk.refs += 1
+                    elif extent:
+                        chunk = stored[extent[0]] = Stored(*extent)
+                        self.pager.stored += chunk.length
+                    data.chunks.append(chunk)
+            self.inodes[properties['st_ino']] = File(properties, data)
+        self.root = self.inodes[ROOT_INO]
+        self.next_ino = max(self.inodes) + 1
+
+    def checkpoint_periodically(self):
+        while True:
+            sleep(self.checkpoint_interval)
+            try:
+                self.checkpoint(self.checkpoint_path)
+            except EnvironmentError as error:
+                print "checkpoint of {0} failed: {1}".format(self.checkpoint_path, error)
 
     def lookup(self,path):
+        entry = self.paths.get(path)
+        if entry is not None and entry[1] == self.generation:
+            return self.inodes[entry[0]]
         if path == '/':
             return self.root
         path_parts = path.split("/")[1:] # [1:] to get rid of the first element ''
@@ -59,18 +576,41 @@ class Memory(LoggingMixIn, Operations):
             path_parts.pop() # remove it so we won't be iterating through an empty name
         context = self.root
         for name in path_parts:
+            if context.get_type() != S_IFDIR: # a regular file or a link in the middle of the path
+                raise FuseOSError(ENOTDIR)
             try:
-                file = context.data[name]
+                context = self.inodes[context.data[name]]
             except KeyError:
                 raise FuseOSError(ENOENT)
-            assert isinstance(file, File)
-            if file.get_type() == S_IFDIR: # we have a directory
-                context = file # set the directory as the new context for the lookup
-            else:
-                return file # we have a regular file, so return it
-        # if we reached this point, it means that the requested file is a dir, so return it
+        if len(self.paths) > 2 * len(self.inodes) + 1024: # drop the entries of the older generations
+            self.paths = dict((key, value) for key, value in self.paths.items()
+                              if value[1] == self.generation)
+        self.paths[path] = (context.ino, self.generation)
         return context
 
+    def add_entry(self, path, file): # give the name of path in its parent directory to file
+        parent_dir = self.lookup(os.path.dirname(path))
+        assert parent_dir.get_type() == S_IFDIR
+        name = os.path.basename(path)
+        if name in parent_dir.data:
+            raise FuseOSError(EEXIST)
+        parent_dir.data[name] = file.ino # include a reference to the new file in the parent dir
+        return parent_dir
+
+    def remove_entry(self, path): # remove the name of path from its parent and return its File
+        parent_dir = self.lookup(os.path.dirname(path))
+        file = self.lookup(path)
+        del parent_dir.data[os.path.basename(path)]
+        self.generation += 1 # path, and every path below it, now resolve to something else
+        return parent_dir, file
+
+    def release_link(self, file): # one name less for file, free the inode when it was the last
+        file.properties['st_nlink'] -= 1
+        if file.properties['st_nlink'] <= 0 or file.get_type() == S_IFDIR:
+            del self.inodes[file.ino]
+            if file.get_type() == S_IFREG:
+                file.data.truncate(0) # give the space of the content back to the pager
+
     def chmod(self, path, mode):
         self.lookup(path).properties['st_mode'] &= 0770000
         self.lookup(path).properties['st_mode'] |= mode
@@ -85,17 +625,30 @@ class Memory(LoggingMixIn, Operations):
         new_file_propeties = dict(st_mode=(S_IFREG | mode), st_nlink=1,
                                 st_size=0, st_ctime=time(), st_mtime=time(),
                                 st_atime=time())
-        new_file = File(path,new_file_propeties,bytes()) # make am empty file
-        parent_dir = self.lookup(os.path.dirname(path))
-        assert parent_dir.get_type() == S_IFDIR
-        parent_dir.data[new_file.name] = new_file # include a reference to the new file in the parent dir
+        new_file = self.allocate(new_file_propeties,Content(self.pager)) # make am empty file
+        try:
+            self.add_entry(path, new_file)
+        except FuseOSError:
+            del self.inodes[new_file.ino]
+            raise
         self.fd += 1
         return self.fd
 
+    def destroy(self, path):
+        if self.checkpoint_path:
+            self.checkpoint(self.checkpoint_path)
+        self.pager.close()
+
     def getattr(self, path, fh=None):
         print "getattr(self, {0}, {1})".format(path,fh)
         return self.lookup(path).properties
 
+    def init(self, path):
+        if self.checkpoint_path and self.checkpoint_interval:
+            checkpointer = Thread(target=self.checkpoint_periodically)
+            checkpointer.daemon = True
+            checkpointer.start()
+
     def getxattr(self, path, name, position=0):
         print "getxattr(self, {0}, {1}, {2})".format(path,name,position)
         attrs = self.lookup(path).properties.get('attrs', {})
@@ -104,6 +657,15 @@ class Memory(LoggingMixIn, Operations):
         except KeyError:
             return ''       # Should return ENOATTR
 
+    def link(self, target, source):
+        print "link(self, {0}, {1})".format(target,source)
+        file = self.lookup(source)
+        if file.get_type() == S_IFDIR: # no hard links to directories
+            raise FuseOSError(EPERM)
+        self.add_entry(target, file)
+        file.properties['st_nlink'] += 1
+        file.properties['st_ctime'] = time()
+
     def listxattr(self, path):
         print "listxattr(self, {0}".format(path)
         attrs = self.lookup(path).properties.get('attrs', {})
@@ -114,10 +676,12 @@ class Memory(LoggingMixIn, Operations):
         new_dir_properties = dict(st_mode=(S_IFDIR | mode), st_nlink=2,
                                 st_size=0, st_ctime=time(), st_mtime=time(),
                                 st_atime=time())
-        new_dir = File(path,new_dir_properties,{})
-        parent_dir = self.lookup(os.path.dirname(path))
-        assert parent_dir.get_type() == S_IFDIR
-        parent_dir.data[new_dir.name] = new_dir # include a reference to the new dir in the parent dir
+        new_dir = self.allocate(new_dir_properties,{})
+        try:
+            parent_dir = self.add_entry(path, new_dir)
+        except FuseOSError:
+            del self.inodes[new_dir.ino]
+            raise
         parent_dir.properties['st_nlink'] += 1
 
     def open(self, path, flags):
@@ -129,7 +693,26 @@ class Memory(LoggingMixIn, Operations):
         print "read(self, {0}, {1}, {2}, {3})".format(path,size,offset,fh)
         file = self.lookup(path)
         assert file.get_type() == S_IFREG
-        return file.data[offset:offset + size]
+        return file.data.read(offset,size)
+
+    def release(self, path, fh):
+        print "release(self, {0}, {1})".format(path,fh)
+        if self.pager.dedup:
+            try:
+                file = self.lookup(path)
+            except FuseOSError: # unlinked while open, nothing to share
+                return 0
+            if file.get_type() == S_IFREG:
+                self.pager.intern(file.data)
+        return 0
+
+    def render_stats(self): # the operation stats, with the deduplication of the chunks
+        text = StatsMixIn.render_stats(self)
+        if not self.pager.dedup:
+            return text
+        stats = self.pager.dedup_stats()
+        return text + 'dedup: {0} chunks, {1} bytes stored, {2} referenced, {3} saved, ratio {4:.2f}\n'.format(
+            stats['chunks'], stats['stored_bytes'], stats['referenced_bytes'], stats['saved_bytes'], stats['ratio'])
 
     def readdir(self, path, fh):
         print "readdir(self, {0}, {1})".format(path,fh)
@@ -154,16 +737,34 @@ class Memory(LoggingMixIn, Operations):
     def rename(self, old, new):
         print "rename(self, {0}, {1})".format(old,new)
         relocated_file = self.lookup(old)
-        old_parent = self.lookup(os.path.dirname(old))
-        del old_parent.data[relocated_file.name] # pop the File from the old location
-        relocated_file.absolute_path = new # change the name and the context_name of the file.
-        self.lookup(os.path.dirname(new)).data[relocated_file.name] = relocated_file
+        try:
+            replaced_file = self.lookup(new)
+        except FuseOSError:
+            replaced_file = None
+        if replaced_file is relocated_file: # both names are links to the same file
+            return
+        if replaced_file is not None: # rename replaces new
+            if replaced_file.get_type() == S_IFDIR:
+                if relocated_file.get_type() != S_IFDIR:
+                    raise FuseOSError(EISDIR)
+                if replaced_file.data:
+                    raise FuseOSError(ENOTEMPTY)
+                self.rmdir(new)
+            else:
+                self.unlink(new)
+        old_parent, relocated_file = self.remove_entry(old) # only the name moves, the subtree stays
+        new_parent = self.add_entry(new, relocated_file)
+        if relocated_file.get_type() == S_IFDIR: # the '..' of the dir now counts for new_parent
+            old_parent.properties['st_nlink'] -= 1
+            new_parent.properties['st_nlink'] += 1
 
     def rmdir(self, path):
         print "rmdir(self, {0})".format(path)
-        dir, parent_dir = self.lookup(path), self.lookup(os.path.dirname(path))
-        del parent_dir.data[dir.name]
+        if self.lookup(path).data:
+            raise FuseOSError(ENOTEMPTY)
+        parent_dir, dir = self.remove_entry(path)
         parent_dir.properties['st_nlink'] -= 1
+        self.release_link(dir)
 
     def setxattr(self, path, name, value, options, position=0):
         print "setxattr(self, {0}, {1}, {2}, {3}, {4})".format(path,name,value,options,position)
@@ -172,7 +773,11 @@ class Memory(LoggingMixIn, Operations):
         attrs[name] = value
 
     def statfs(self, path):
-        return dict(f_bsize=512, f_blocks=4096, f_bavail=2048)
+        blocks = self.pager.capacity() // STATFS_BLOCK
+        free = max(0, blocks - (self.pager.used() + STATFS_BLOCK - 1) // STATFS_BLOCK)
+        return dict(f_bsize=STATFS_BLOCK, f_frsize=STATFS_BLOCK, f_blocks=blocks, f_bfree=free,
+                    f_bavail=free, f_files=len(self.inodes) + free, f_ffree=free, f_favail=free,
+                    f_namemax=255)
 
     def symlink(self, target, source):
         print "symlink(self, {0}, {1})".format(target,source)
@@ -182,24 +787,26 @@ class Memory(LoggingMixIn, Operations):
         source_path = source
         if file_system_os_path in source:
             source_path = source.replace(file_system_os_path,'')
-        source_file = self.lookup(source_path)
-        parent_dir = self.lookup(os.path.dirname(target))
-        full_os_path = os.getcwd() + '/' + argv[1] + source_file.absolute_path
-        link = File(target,link_properties,full_os_path)
-        parent_dir.data[link.name] = link
+        self.lookup(source_path) # the source has to exist
+        full_os_path = os.getcwd() + '/' + argv[1] + source_path
+        link = self.allocate(link_properties,full_os_path)
+        try:
+            self.add_entry(target, link)
+        except FuseOSError:
+            del self.inodes[link.ino]
+            raise
 
     def truncate(self, path, length, fh=None):
         print "truncate(self, {0}, {1}, {2})".format(path,length,fh)
         file = self.lookup(path)
         assert file.get_type() == S_IFREG
-        file.data = file.data[:length]
+        file.data.truncate(length)
         file.properties['st_size'] = length
 
     def unlink(self, path):
         print "unlink(self, {0})".format(path)
-        parent_dir = self.lookup(os.path.dirname(path))
-        file = self.lookup(path)
-        parent_dir.data.pop(file.name)
+        parent_dir, file = self.remove_entry(path)
+        self.release_link(file)
 
     def utimens(self, path, times=None):
         print "utimens(self, {0}, {1})".format(path,times)
@@ -210,19 +817,38 @@ class Memory(LoggingMixIn, Operations):
         file.properties['st_mtime'] = mtime
 
     def write(self, path, data, offset, fh):
-        print "write(self, {0}, {1}, {2}, {3})".format(path,data,offset,fh)
+        print "write(self, {0}, <{1} bytes>, {2}, {3})".format(path,len(data),offset,fh)
         file = self.lookup(path)
         assert file.get_type() == S_IFREG
-        file.data = file.data[:offset] + data
+        file.data.write(offset,data) # overwrites in place, the bytes after the write stay
         file.properties['st_size'] = len(file.data)
         return len(data)
 
 
 if __name__ == '__main__':
-    if len(argv) != 2:
-        print('usage: %s <mountpoint>' % argv[0])
-        exit(1)
+    parser = ArgumentParser(usage='%(prog)s <mountpoint> [options]') # symlink expects the mountpoint in argv[1]
+    parser.add_argument('mountpoint')
+    parser.add_argument('--memory', type=int, metavar='MiB',
+                        help='max MiB of file content kept in memory, by default there is no limit')
+    parser.add_argument('--spill', metavar='FILE',
+                        help='with --memory, move the least recently used content to FILE instead of '
+                             'refusing the writes that go over the limit')
+    parser.add_argument('--dedup', action='store_true',
+                        help='keep the chunks of file content that hold the same bytes once, they are '
+                             'compared when a file is closed')
+    parser.add_argument('--checkpoint', metavar='FILE',
+                        help='restore the file system from FILE if it exists, and save it to FILE when '
+                             'it is unmounted')
+    parser.add_argument('--checkpoint-every', type=float, metavar='SECONDS',
+                        help='with --checkpoint, also save the file system every SECONDS while mounted')
+    args = parser.parse_args()
+    if args.spill and args.memory is None:
+        parser.error('--spill needs --memory')
+    if args.checkpoint_every and not args.checkpoint:
+        parser.error('--checkpoint-every needs --checkpoint')
 
     logging.getLogger().setLevel(logging.DEBUG)
-    fuse = FUSE(Memory(), argv[1], foreground=True, debug = False)
+    memory_budget = args.memory << 20 if args.memory is not None else None
+    memory = Memory(memory_budget, args.spill, args.checkpoint, args.checkpoint_every, args.dedup)
+    fuse = StatsFUSE(memory, args.mountpoint, foreground=True, debug = False, use_ino=True) # use_ino: keep our st_ino
     # fusermount -uz ./fusemount
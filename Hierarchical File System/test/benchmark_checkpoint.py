@@ -0,0 +1,60 @@
+from __future__ import print_function, division
+from timeit import default_timer
+import os, os.path, sys, tempfile
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir))
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir, os.pardir, 'Final Project', 'test'))
+import hierarchicalFS
+from benchmark_helpers import Quiet
+
+# Fills a hierarchicalFS.Memory with files, then compares rebuilding it through create/write (what a
+# reload without a checkpoint does) with writing a checkpoint of it and restoring it, and times the
+# first read of every file of the restored file system (its content is only read from the checkpoint then).
+# usage: python test/benchmark_checkpoint.py [total_MiB]
+
+FILE_SIZE = 256 << 10
+DIRECTORY_SIZE = 100 # files per directory
+
+
+def fill(fs, paths, content):
+    for number, path in enumerate(paths):
+        if number % DIRECTORY_SIZE == 0:
+            fs('mkdir', os.path.dirname(path), 0755)
+        fh = fs('create', path, 0644)
+        for offset in range(0, FILE_SIZE, 64 << 10):
+            fs('write', path, content, offset, fh)
+
+
+def main():
+    total = (int(sys.argv[1]) if len(sys.argv) > 1 else 256) << 20
+    paths = ['/dir{0}/file{1}'.format(number // DIRECTORY_SIZE, number) for number in range(total // FILE_SIZE)]
+    content = os.urandom(64 << 10)
+    checkpoint_path = os.path.join(tempfile.mkdtemp(), 'checkpoint')
+    stdout, sys.stdout = sys.stdout, Quiet()
+    start = default_timer()
+    fs = hierarchicalFS.Memory()
+    fill(fs, paths, content)
+    rebuild = default_timer() - start
+    start = default_timer()
+    fs.checkpoint(checkpoint_path)
+    checkpoint = default_timer() - start
+    del fs
+    start = default_timer()
+    restored = hierarchicalFS.Memory(checkpoint_path=checkpoint_path)
+    restore = default_timer() - start
+    start = default_timer()
+    for path in paths:
+        restored('read', path, 4096, 0, 0)
+    first_reads = default_timer() - start
+    sys.stdout = stdout
+    print("{0} files, {1} MiB, checkpoint of {2:.1f} MiB".format(
+        len(paths), total >> 20, os.path.getsize(checkpoint_path) / (1 << 20)))
+    print("{0:<34} {1:>9.3f} s".format("rebuild through create/write", rebuild))
+    print("{0:<34} {1:>9.3f} s".format("write the checkpoint", checkpoint))
+    print("{0:<34} {1:>9.3f} s".format("restore the checkpoint", restore))
+    print("{0:<34} {1:>9.3f} s".format("first 4 KiB read of every file", first_reads))
+    os.remove(checkpoint_path)
+    os.rmdir(os.path.dirname(checkpoint_path))
+
+
+if __name__ == "__main__":
+    main()
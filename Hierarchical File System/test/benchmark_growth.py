@@ -0,0 +1,50 @@
+from __future__ import print_function, division
+from timeit import default_timer
+import os, os.path, sys
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir))
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir, os.pardir, 'Final Project', 'test'))
+import hierarchicalFS
+from benchmark_helpers import Quiet
+
+# Appends to a file of hierarchicalFS.Memory in 64 KiB writes up to 32 MiB, then overwrites 4 KiB at
+# random places of it, and prints the throughput of every 4 MiB of the file: it should not drop as
+# the file grows. With a memory limit, the content over it is spilled to spill_file (see hierarchicalFS.Pager).
+# usage: python test/benchmark_growth.py [memory_MiB spill_file]
+
+FILE_SIZE = 32 << 20
+WRITE_SIZE = 64 << 10
+SLICE_SIZE = 4 << 20 # the throughput is reported per slice of the file
+OVERWRITES = 1000
+
+
+def main():
+    memory_budget = int(sys.argv[1]) << 20 if len(sys.argv) > 1 else None
+    spill_path = sys.argv[2] if len(sys.argv) > 2 else None
+    stdout, sys.stdout = sys.stdout, Quiet()
+    fs = hierarchicalFS.Memory(memory_budget, spill_path)
+    chunk = os.urandom(WRITE_SIZE)
+    fh = fs('create', '/growing', 0644)
+    speeds = []
+    for slice_start in range(0, FILE_SIZE, SLICE_SIZE):
+        start = default_timer()
+        for offset in range(slice_start, slice_start + SLICE_SIZE, WRITE_SIZE):
+            fs('write', '/growing', chunk, offset, fh)
+        speeds.append(SLICE_SIZE / (default_timer() - start) / (1 << 20))
+    start = default_timer()
+    for number in range(OVERWRITES):
+        fs('write', '/growing', chunk[:4096], number * 7919 * 4096 % (FILE_SIZE - 4096), fh)
+    overwrite_time = default_timer() - start
+    size = fs('getattr', '/growing')['st_size']
+    spilled = fs.pager.spilled
+    fs('destroy', '/')
+    sys.stdout = stdout
+    print("{0:>14} {1:>14}".format("file size", "write (MiB/s)"))
+    for number, speed in enumerate(speeds):
+        print("{0:>11} MiB {1:>14.1f}".format((number + 1) * SLICE_SIZE >> 20, speed))
+    print("4 KiB overwrites: {0:.0f}/s, size after them: {1} bytes".format(OVERWRITES / overwrite_time, size))
+    if memory_budget is not None:
+        print("spilled at the end: {0:.1f} MiB".format(spilled / (1 << 20)))
+
+
+if __name__ == "__main__":
+    main()
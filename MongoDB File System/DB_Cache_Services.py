@@ -1,10 +1,19 @@
+import os, sys
 from pymongo import MongoClient
+from bson.binary import Binary
 from bson.objectid import ObjectId
 from stat import S_IFDIR, S_IFLNK, S_IFREG
 from time import time
 from collections import OrderedDict
 from fuse import FuseOSError
 from errno import ENOENT
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir, 'Final Project')) # OperationStats, BlockCodec
+from OperationStats import count_round_trip
+import BlockCodec
+
+BLOCK_SIZE = 64 << 10 # compressed content is stored as a list of blocks of this size, each encoded on its own
+# A write only changes the content from its offset on, so update_content re-encodes and sends only the
+# blocks from the one holding the offset: the blocks before it stay as they are in the document.
 
 
 class FSMongoClient(object):
@@ -14,10 +23,13 @@ class FSMongoClient(object):
     self.fs_collection: stores a reference to the MongoDB collection
         in which all the files are stored
     self.root_id: stores the ObjectId of the document representing the root
+    self.compress: whether the content of regular files and links is sent and stored compressed
+        (see _encode_content). Compressed and raw content can be read either way.
     """
-    def __init__(self,url,port):
-        # retrieve the collection FUSEPY_FS from the FS_DB database
-        self.fs_collection = MongoClient(url,port).FS_DB.FUSEPY_FS
+    def __init__(self,url,port,collection=None,compress=False):
+        # retrieve the collection FUSEPY_FS from the FS_DB database, unless another collection
+        # (e.g. an in-memory stand-in used by the benchmarks) is given
+        self.fs_collection = collection if collection is not None else MongoClient(url,port).FS_DB.FUSEPY_FS
         fs_root = self.fs_collection.find_one({"name": '/'})
         if fs_root:     # File system root exists already
             print 'Root exists. loading existing root...'
@@ -29,6 +41,7 @@ class FSMongoClient(object):
                                st_mtime=now, st_atime=now, st_nlink=2)
             fs_root = dict(name='/',type='dir',meta=meta_data,data={})
             self.root_id = self.fs_collection.insert_one(fs_root).inserted_id
+        self.compress = compress
     
     @staticmethod
     def _encode_dict(data_dict):
@@ -48,19 +61,47 @@ class FSMongoClient(object):
             decoded_dict[decoded_name] = _id
         return decoded_dict
 
+    @staticmethod
+    def _encode_content(content):
+        # the content of a regular file or a link as a list of blocks, compressed by BlockCodec unless
+        # they look incompressible
+        return [Binary(BlockCodec.encode(content[start:start + BLOCK_SIZE]))
+                for start in range(0, len(content), BLOCK_SIZE)]
+
+    @staticmethod
+    def _decode_content(blocks):
+        return ''.join(BlockCodec.decode(bytes(block)) for block in blocks)
+
+    def _decode_file(self,file_dict):
+        # restores the data of a file as retrieved from the DB
+        if file_dict['type'] == 'dir':
+            file_dict['data'] = self._decode_dict(file_dict['data'])
+        elif type(file_dict['data']) == list: # compressed content
+            file_dict['data'] = self._decode_content(file_dict['data'])
+        return file_dict
+
     def id_lookup(self,file_id):
         # Retrieve a file from the DB using its _id. the _id must be an object of type ObjectId
         assert type(file_id) == ObjectId
+        count_round_trip()
         file_dict = self.fs_collection.find_one({'_id': file_id})
-        if file_dict['type'] == 'dir':
-            file_dict['data'] = self._decode_dict(file_dict['data'])
-        return file_dict
+        return self._decode_file(file_dict)
+
+    def id_lookup_many(self,file_ids):
+        # Retrieve several files from the DB in a single query. Returns a dict mapping the _id of
+        # every file found to the file. The _ids must be objects of type ObjectId
+        found = {}
+        count_round_trip()
+        for file_dict in self.fs_collection.find({'_id': {'$in': list(file_ids)}}):
+            found[file_dict['_id']] = self._decode_file(file_dict)
+        return found
 
     def insert_file(self,new_file_dict):
         # Insert a file to the DB. all the file contents should be in new_file_dict.
         # This method will modify new_file_dict provided to
         # include a new property '_id' since the dict now represent a file that was inserted into the database.
         assert {'name','type','meta','data'} == set(new_file_dict.keys())
+        count_round_trip()
         self.fs_collection.insert_one(new_file_dict)
 
     def update_file(self,file_id,field_to_update,field_content):
@@ -70,14 +111,36 @@ class FSMongoClient(object):
         #assert type(field_content) = type(dict)
         if field_to_update == 'data' and type(field_content) == dict: # means we have a dir
             field_content = self._encode_dict(field_content)
+        elif field_to_update == 'data' and self.compress: # the content of a regular file or a link
+            field_content = self._encode_content(field_content)
         elif field_to_update == 'name':
             field_content = '_'.join([str(format(ord(x),'x')) for x in field_content])
+        count_round_trip()
         self.fs_collection.update_one({"_id":file_id},
                                       {"$set": {field_to_update:field_content}})
 
+    def update_content(self,file_id,content,offset,old_size):
+        # Update the content of a regular file of which only the part from offset on changed (old_size is
+        # the size of the content it replaces). With compress, only the blocks from the one holding offset
+        # are encoded and set, provided the document holds the old content as a list of blocks; otherwise
+        # (raw content, e.g. written by a mount without --compress, or content that shrank) the whole
+        # content is written by update_file
+        first = offset // BLOCK_SIZE
+        blocks = self._encode_content(content[first * BLOCK_SIZE:]) if self.compress else []
+        old_count = (old_size + BLOCK_SIZE - 1) // BLOCK_SIZE
+        if blocks and offset <= old_size and old_count <= first + len(blocks):
+            count_round_trip()
+            result = self.fs_collection.update_one(
+                {"_id": file_id, "data": {"$size": old_count}}, # the old content, as a list of blocks
+                {"$set": dict(('data.{0}'.format(first + index), block) for index, block in enumerate(blocks))})
+            if result.matched_count:
+                return
+        self.update_file(file_id,'data',content)
+
     def remove_file(self,file_id):
         # Remove a file from the DB by supplying its _id
         assert type(file_id) == ObjectId
+        count_round_trip()
         self.fs_collection.delete_one({'_id' : file_id})
 
     def print_db(self): # used for debugging
@@ -144,8 +207,8 @@ class FileStorageManager(object):
     A class to manage both the database and the cache. It uses the cache for fast 'get' accesses
     and synchronizes the cache and database whenever data is changed.
     """
-    def __init__(self,db_url,db_port,cache_size):
-        self.db = FSMongoClient(db_url,db_port)
+    def __init__(self,db_url,db_port,cache_size,collection=None,compress=False):
+        self.db = FSMongoClient(db_url,db_port,collection,compress)
         self.cache = LRUCache(cache_size)
 
     def _retrieve_file(self,file_id):
@@ -163,6 +226,28 @@ class FileStorageManager(object):
             self.cache[file_id] = db_output
             return db_output
 
+    def retrieve_files(self,file_ids):
+        """
+        Retrieves several files by id, from the cache when possible and from the database in a single
+        query otherwise. The files retrieved from the database are stored in the cache.
+        :param file_ids: list of the ObjectIds of the files
+        :return: dict mapping every ObjectId to the dict of its file, or to None if the file doesn't exist
+        """
+        files, missing = {}, []
+        for file_id in file_ids:
+            try:
+                files[file_id] = self.cache[file_id]
+            except KeyError:
+                missing.append(file_id)
+            except FuseOSError: # cached as removed
+                files[file_id] = None
+        if missing:
+            db_output = self.db.id_lookup_many(missing)
+            for file_id in missing:
+                files[file_id] = db_output.get(file_id)
+                self.cache[file_id] = files[file_id]
+        return files
+
     def lookup(self,path):
         """
         Retrieves a file from the DB or cache using its path. Raises a FuseOSError(ENOENT)
@@ -206,6 +291,21 @@ class FileStorageManager(object):
         self.cache[file_dict['_id']] = file_dict  # update the cache
         self.db.update_file(file_dict['_id'],field_to_update,field_content)  # update the db
 
+    def update_content(self,file_dict,content,offset):
+        """
+        Replaces the content of a regular file of which only the part from offset on changed, in both
+        the cache and the database (see FSMongoClient.update_content).
+        :param file_dict: a dictionary represents a regular file (as stored in the db and cache)
+        :param content: the new content (str)
+        :param offset: the content before offset is the same as before
+        """
+        assert set(file_dict.keys()) == {'_id','name','type','meta','data'}
+        old_size = len(file_dict['data'])
+        del self.cache[file_dict['_id']]
+        file_dict['data'] = content
+        self.cache[file_dict['_id']] = file_dict
+        self.db.update_content(file_dict['_id'],content,offset,old_size)
+
     def update_dir_data(self,dir_dict,**kwargs):
         """
         Updates the data of a directory, which represents the contents of this particular dir.
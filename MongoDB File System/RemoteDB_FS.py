@@ -1,24 +1,30 @@
 #!/usr/bin/env python
 #
 # To start MongoDB: mongod --port 27027
-# To mount FS:      python RemoteDB_FS.py fusemount 27027 233
+# To mount FS:      python RemoteDB_FS.py fusemount 27027 233 [--compress]
 # To unmount FS:    fusermount -uz ./fusemount
 
 import os
+import sys
+from argparse import ArgumentParser
 from stat import S_IFDIR, S_IFLNK, S_IFREG
-from sys import argv, exit
+from sys import argv
 from time import time
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir, 'Final Project')) # OperationStats, BlockCodec
 from DB_Cache_Services import FileStorageManager
-from fuse import FUSE, FuseOSError, Operations
+import BlockCodec
+from fuse import FuseOSError, Operations
+from OperationStats import StatsFUSE, StatsMixIn
 
 
 if not hasattr(__builtins__, 'bytes'):
     bytes = str
 
 
-class ClientFS(Operations):
+class ClientFS(StatsMixIn, Operations):
 
     def __init__(self,storage_manager):
+        StatsMixIn.__init__(self) # see /.fsstats in the mount
         self.fd = 0
         self.storage = storage_manager
 
@@ -50,6 +56,12 @@ class ClientFS(Operations):
         self.fd += 1
         return self.fd
 
+    def render_stats(self): # the operation stats, with the compression of the content stored
+        text = StatsMixIn.render_stats(self)
+        if self.storage.db.compress:
+            text += BlockCodec.render_stats()
+        return text
+
     def getattr(self, path, fh=None):
         print "getattr(self, {0}, {1})".format(path,fh)
         file_dict = self.storage.lookup(path)
@@ -96,7 +108,11 @@ class ClientFS(Operations):
         print "readdir(self, {0}, {1})".format(path,fh)
         dir_dict = self.storage.lookup(path)
         assert dir_dict['type'] == 'dir'
-        return ['.', '..'] + [x for x in dir_dict['data']]
+        # fetch the files in one query and return their attributes with their names, the getattr
+        # calls that follow find them in the cache
+        files = self.storage.retrieve_files(dir_dict['data'].values())
+        return ['.', '..'] + [(name, files[file_id]['meta'], 0) if files[file_id] else name
+                              for name, file_id in dir_dict['data'].items()]
 
     def readlink(self, path):
         print "readlink(self, {0})".format(path)
@@ -185,11 +201,10 @@ class ClientFS(Operations):
         self.storage.update_file(file_dict,'meta',file_dict['meta'])
 
     def write(self, path, data, offset, fh):
-        print "write(self, {0}, {1}, {2}, {3})".format(path,data,offset,fh)
+        print "write(self, {0}, <{1} bytes>, {2}, {3})".format(path,len(data),offset,fh)
         file_dict = self.storage.lookup(path)
         assert file_dict['type'] == 'reg'
-        file_dict['data'] = file_dict['data'][:offset] + data
-        self.storage.update_file(file_dict,'data',file_dict['data'])
+        self.storage.update_content(file_dict,file_dict['data'][:offset] + data,offset)
         file_dict['meta']['st_size'] = len(file_dict['data'])
         self.storage.update_file(file_dict,'meta',file_dict['meta'])
         return len(data)
@@ -197,13 +212,13 @@ class ClientFS(Operations):
 
 if __name__ == '__main__':
     print "argv: ",argv
-    if len(argv) != 4:
-        print('usage: %s <mountpoint> <port number> <cache size>' % argv[0])
-        exit(1)
-    mount_point, port_num, cache_size = argv[1:]
-    try:
-        port_num, cache_size = int(port_num), int(cache_size)
-    except TypeError:
-        print('usage: %s <mountpoint> <port number> <cache size>' % argv[0])
-        exit(1)
-    fuse = FUSE(ClientFS(FileStorageManager('localhost',int(port_num),cache_size)), argv[1], foreground=True, debug = False)
+    parser = ArgumentParser(usage='%(prog)s <mountpoint> <port number> <cache size> [options]')
+    parser.add_argument('mountpoint')
+    parser.add_argument('port', type=int, help='port of mongod')
+    parser.add_argument('cache_size', type=int, help='max number of files cached by the client')
+    parser.add_argument('--compress', action='store_true',
+                        help='compress the content of the regular files written by this mount with zlib, '
+                             'except the blocks of it that look incompressible')
+    args = parser.parse_args()
+    storage = FileStorageManager('localhost',args.port,args.cache_size,compress=args.compress)
+    fuse = StatsFUSE(ClientFS(storage), args.mountpoint, foreground=True, debug = False)
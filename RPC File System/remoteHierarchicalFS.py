@@ -1,5 +1,6 @@
 #!/usr/bin/env python
 import os
+import sys
 import logging
 
 from itertools import count
@@ -8,14 +9,18 @@ from stat import S_IFDIR, S_IFLNK, S_IFREG
 from sys import argv, exit
 from time import time
 from pickle import dumps, loads
-from xmlrpclib import Binary, ServerProxy
+from xmlrpclib import Binary, Fault
 
-from fuse import FUSE, FuseOSError, Operations, LoggingMixIn
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir, 'Final Project')) # OperationStats, ProxyPool
+from fuse import FuseOSError, Operations, LoggingMixIn
+from OperationStats import StatsFUSE, StatsMixIn
+from ProxyPool import ProxyPool
 
 if not hasattr(__builtins__, 'bytes'):
     bytes = str
 
-rpc = ServerProxy('http://localhost:8080')
+
+rpc = ProxyPool('http://localhost:8080')
 
 class File(object):
     """ Represents a file (regular file, directory, or soft link) on the file system.
@@ -30,6 +35,7 @@ class File(object):
             Link file: self.data contains a FULL path (from the OS root) stored as a str
     """
     _id = count(0) # used for serial number generation
+    server_methods = set() # the methods the server offers besides get/put
 
     def __init__(self,absolute_path,properties,data):
         if absolute_path == '/': self.name = absolute_path
@@ -47,14 +53,20 @@ class File(object):
 
     @staticmethod
     def push(serial_num,file): # pushes a file to the rpc server and associates it with a serial number in ht
-        rpc.put(Binary(str(serial_num)),Binary(dumps(file)),3000)
+        # without a ttl: the root is only pushed once, and every file must stay until it is removed
+        rpc.put(Binary(str(serial_num)),Binary(dumps(file)))
+
+    @staticmethod
+    def get(key): # returns the Binary value of a key, None if the server doesn't have it
+        response = rpc.get(key)
+        if isinstance(response, dict): # simpleht.py wraps the value, Server.py returns it or False
+            response = response.get("value")
+        return response or None
 
     @staticmethod
     def pull(serial_num): # returns the file that corresponds to the serial number
-        try:
-            response_dict = rpc.get(Binary(str(serial_num)))
-            binary_value = response_dict["value"]
-        except:
+        binary_value = File.get(Binary(str(serial_num)))
+        if binary_value is None:
             raise FuseOSError(ENOENT)
         pickled_obj = binary_value.data
         file = loads(pickled_obj)
@@ -63,8 +75,25 @@ class File(object):
             raise FuseOSError(ENOENT)
         return file
 
+    @staticmethod
+    def pull_many(serial_nums): # returns the files of several serial numbers in one round trip, None for removed ones
+        files = []
+        for response in rpc.get_many([Binary(str(serial_num)) for serial_num in serial_nums]):
+            if isinstance(response, dict): # the value is wrapped, see File.get
+                response = response.get("value")
+            files.append(loads(response.data) if response else None)
+        return files
+
     @staticmethod
     def lookup(path): # returns the file that corresponds to the particular path
+        if 'resolve' in File.server_methods: # let the server walk the path, in one round trip
+            response = rpc.resolve(Binary(path))
+            if not response:
+                raise FuseOSError(ENOENT)
+            file = loads(response['value'].data)
+            if file == None: # File has been removed
+                raise FuseOSError(ENOENT)
+            return file
         root = File.pull(0) # first pull the root
         if path == '/':
             return root
@@ -87,22 +116,27 @@ class File(object):
         return context
 
 
-class Memory(LoggingMixIn, Operations):
+class Memory(StatsMixIn, LoggingMixIn, Operations):
 
     def __init__(self):
-        self.fd = 0
+        StatsMixIn.__init__(self) # see /.fsstats in the mount
+        self.fds = count(1) # file handles, count.next() is atomic so FUSE threads can share it
         now = time()
         root_properties = dict(st_mode=(S_IFDIR | 0755), st_ctime=now,
                                st_mtime=now, st_atime=now, st_nlink=2)
         root = File('/',root_properties, {})
         File.push(root.serial_number,root) # store in the server ht serial number -> object
+        try:
+            File.server_methods = set(rpc.system.listMethods())
+        except Fault: # a server without introspection only has get/put
+            File.server_methods = set()
 
     def show_server_content(self): # function used for debugging
         print "**************** Server Contents ***************************"
         max_serial_num = 10
         for index in range(max_serial_num+1):
             try:
-                file = loads(rpc.get(Binary(str(index)))['value'].data)
+                file = loads(File.get(Binary(str(index))).data)
                 if file == None: # File has been removed
                     print index,": ","The file at node {0} has been removed.".format(index)
                 else:
@@ -145,8 +179,7 @@ class Memory(LoggingMixIn, Operations):
         assert parent_dir.file_type == S_IFDIR
         parent_dir.data[new_file.name]=new_file.serial_number
         self.ht_update(parent_dir,action='update file')
-        self.fd += 1
-        return self.fd
+        return self.fds.next()
 
     def getattr(self, path, fh=None):
         print "getattr(self, {0}, {1})".format(path,fh)
@@ -183,8 +216,7 @@ class Memory(LoggingMixIn, Operations):
 
     def open(self, path, flags):
         print "open(self, {0}, {1})".format(path,flags)
-        self.fd += 1
-        return self.fd
+        return self.fds.next()
 
     def read(self, path, size, offset, fh):
         print "read(self, {0}, {1}, {2}, {3})".format(path,size,offset,fh)
@@ -196,7 +228,12 @@ class Memory(LoggingMixIn, Operations):
         print "readdir(self, {0}, {1})".format(path,fh)
         directory = File.lookup(path)
         assert directory.file_type == S_IFDIR
-        return ['.', '..'] + [x for x in directory.data]
+        if 'get_many' not in File.server_methods:
+            return ['.', '..'] + [x for x in directory.data]
+        # return the attributes of the files with their names, fetched together in one round trip
+        names = directory.data.keys()
+        files = File.pull_many([directory.data[name] for name in names])
+        return ['.', '..'] + [(name, file.properties, 0) if file else name for name, file in zip(names, files)]
 
     def readlink(self, path):
         print "readlink(self, {0})".format(path)
@@ -298,7 +335,7 @@ class Memory(LoggingMixIn, Operations):
         self.ht_update(file,action='update file')
 
     def write(self, path, data, offset, fh):
-        print "write(self, {0}, {1}, {2}, {3})".format(path,data,offset,fh)
+        print "write(self, {0}, <{1} bytes>, {2}, {3})".format(path,len(data),offset,fh)
         file = File.lookup(path)
         assert file.file_type == S_IFREG
         file.data = file.data[:offset] + data
@@ -313,6 +350,6 @@ if __name__ == '__main__':
         exit(1)
 
     logging.getLogger().setLevel(logging.DEBUG)
-    fuse = FUSE(Memory(), argv[1], foreground=True, debug = False)
+    fuse = StatsFUSE(Memory(), argv[1], foreground=True, debug = False)
     # fusermount -uz ./fusemount
 